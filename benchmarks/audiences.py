@@ -0,0 +1,45 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+Compare get_audience using the audience index with the previous linear scan
+of BROWSERID_AUDIENCES, for 1, 50 and 500 audiences. The request matches the
+last audience, the worst case for the scan.
+
+Usage: python benchmarks/audiences.py [iterations]
+"""
+import sys
+
+from utils import report, setup_django, time_calls
+
+
+def main(iterations=20000):
+    setup_django(ALLOWED_HOSTS=['*'])
+
+    from django.conf import settings
+    from django.test.client import RequestFactory
+
+    from django_browserid.base import get_audience
+    from django_browserid.util import same_origin
+
+    def linear_get_audience(request):
+        protocol = 'https' if request.is_secure() else 'http'
+        host = '{0}://{1}'.format(protocol, request.get_host())
+        for audience in settings.BROWSERID_AUDIENCES:
+            if same_origin(host, audience):
+                return audience
+
+    for count in (1, 50, 500):
+        settings.BROWSERID_AUDIENCES = ['https://site{0}.example.com'.format(i)
+                                        for i in range(count)]
+        request = RequestFactory().get('/', secure=True,
+                                       HTTP_HOST='site{0}.example.com'.format(count - 1))
+
+        for name, func in (('scan', linear_get_audience), ('index', get_audience)):
+            assert func(request) == settings.BROWSERID_AUDIENCES[-1]
+            samples = time_calls(lambda: func(request), iterations)
+            report('{0} audiences={1}'.format(name, count), samples, unit='us')
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,35 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+Compare rendering login and logout buttons through the browserid/button.html
+template with rendering them directly.
+
+Usage: python benchmarks/buttons.py [iterations]
+"""
+import sys
+
+from mock import patch
+
+from utils import report, setup_django, time_calls
+
+
+def main(iterations=20000):
+    setup_django()
+
+    from django_browserid.helpers import browserid_login, browserid_logout
+
+    def buttons():
+        browserid_login(next='/home')
+        browserid_logout()
+
+    with patch('django_browserid.helpers.button_template_overridden', return_value=True):
+        buttons()
+        report('login + logout, template', time_calls(buttons, iterations), unit='us')
+
+    buttons()
+    report('login + logout, direct', time_calls(buttons, iterations), unit='us')
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
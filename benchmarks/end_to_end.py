@@ -0,0 +1,170 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+Measure the login, logout and CSRF token views and a page rendering the
+template helpers end to end, through the middleware stack.
+
+Requests are made first with Django's test client, and then over HTTP to a
+threaded WSGI server by several concurrent clients, each fetching a CSRF
+token, logging in, fetching a new token and logging out, as the JavaScript
+API does. Logins are verified with MockVerifier and, for the HTTP scenarios,
+with RemoteVerifier against the local stand-in verification service.
+
+The HTTP clients share the server's process, so results are for comparing
+revisions on the same machine rather than for estimating capacity.
+
+Usage: python benchmarks/end_to_end.py [iterations] [concurrency] [latency_ms]
+"""
+from __future__ import print_function
+
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer
+
+from utils import report, setup_django, time_calls
+
+
+class QuietHandler(WSGIRequestHandler):
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+
+def start_wsgi_server(application):
+    from django.utils.six.moves import socketserver
+
+    class ThreadedWSGIServer(socketserver.ThreadingMixIn, WSGIServer):
+        daemon_threads = True
+
+    server = ThreadedWSGIServer(('127.0.0.1', 0), QuietHandler)
+    server.set_app(application)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def run_clients(base_url, iterations, concurrency):
+    """
+    Run the login flow iterations times in each of concurrency threads and
+    return a dict of latency samples per view, and the elapsed time.
+    """
+    import requests
+
+    samples = {'csrf': [], 'login': [], 'logout': [], 'page': []}
+    lock = threading.Lock()
+
+    def timed(name, local, method, path, **kwargs):
+        start = time.time()
+        response = method(base_url + path, **kwargs)
+        local[name].append(time.time() - start)
+        if response.status_code != 200:
+            raise AssertionError('{0} returned {1}'.format(path, response.status_code))
+        return response
+
+    def client():
+        session = requests.Session()
+        local = dict((name, []) for name in samples)
+        for i in range(iterations):
+            token = timed('csrf', local, session.get, '/browserid/csrf/').text
+            timed('login', local, session.post, '/browserid/login/',
+                  data={'assertion': 'bench@example.com'}, headers={'X-CSRFToken': token})
+            timed('page', local, session.get, '/')
+            token = timed('csrf', local, session.get, '/browserid/csrf/').text
+            timed('logout', local, session.post, '/browserid/logout/',
+                  headers={'X-CSRFToken': token})
+        with lock:
+            for name, values in local.items():
+                samples[name].extend(values)
+
+    threads = [threading.Thread(target=client) for i in range(concurrency)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return samples, time.time() - start
+
+
+def main(iterations=200, concurrency=8, latency_ms=20):
+    directory = tempfile.mkdtemp()
+    setup_django(
+        DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3',
+                               'NAME': os.path.join(directory, 'bench.db')}},
+        INSTALLED_APPS=('django_browserid', 'django_browserid.tests', 'django.contrib.auth',
+                        'django.contrib.contenttypes', 'django.contrib.sessions',
+                        'django.contrib.staticfiles'),
+        SESSION_ENGINE='django.contrib.sessions.backends.signed_cookies',
+        ROOT_URLCONF='urls',
+        ALLOWED_HOSTS=['*'],
+        DEBUG=False,
+    )
+
+    from django.core.management import call_command
+    from django.core.wsgi import get_wsgi_application
+    from django.test.client import Client
+    from django.test.utils import override_settings
+
+    from django_browserid.base import close_session
+    from django_browserid.tests import mock_browserid
+    from django_browserid.standin import StandInServer
+
+    call_command('migrate', verbosity=0, run_syncdb=True)
+
+    try:
+        # Test client: no network, no CSRF checks.
+        client = Client()
+        with mock_browserid('bench@example.com'):
+            for name, func in (
+                    ('client: csrf', lambda: client.get('/browserid/csrf/')),
+                    ('client: login', lambda: client.post('/browserid/login/',
+                                                          {'assertion': 'asdf'})),
+                    ('client: page', lambda: client.get('/')),
+                    ('client: logout', lambda: client.post('/browserid/logout/'))):
+                func()
+                report(name, time_calls(func, iterations * 5))
+
+        # Real WSGI server with concurrent HTTP clients.
+        server = start_wsgi_server(get_wsgi_application())
+        base_url = 'http://127.0.0.1:{0}'.format(server.server_address[1])
+        standin = StandInServer(latency=latency_ms / 1000.0).start()
+        scenarios = (
+            ('MockVerifier', mock_browserid('bench@example.com'), {}),
+            ('stand-in {0}ms'.format(latency_ms), None,
+             {'BROWSERID_VERIFICATION_URLS': [standin.url]}),
+        )
+        try:
+            for label, patcher, overrides in scenarios:
+                with override_settings(BROWSERID_AUDIENCES=[base_url], **overrides):
+                    if patcher is not None:
+                        patcher.__enter__()
+                    try:
+                        run_clients(base_url, 2, concurrency)  # Warm up.
+                        samples, elapsed = run_clients(base_url, iterations, concurrency)
+                    finally:
+                        if patcher is not None:
+                            patcher.__exit__(None, None, None)
+
+                total = sum(len(values) for values in samples.values())
+                print('{0}: {1} requests from {2} clients, {3:.1f} req/s'.format(
+                    label, total, concurrency, total / elapsed))
+                for name in ('csrf', 'login', 'page', 'logout'):
+                    report('wsgi {0}: {1}'.format(label, name), samples[name],
+                           elapsed=elapsed)
+        finally:
+            standin.stop()
+            server.shutdown()
+            server.server_close()
+            close_session()
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
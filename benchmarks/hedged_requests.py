@@ -0,0 +1,57 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+Compare RemoteVerifier tail latency against a single verification endpoint
+and with requests hedged across three stand-in replicas, where 5% of
+requests to each replica are slow. A second scenario makes one replica
+consistently slow to show health-weighted endpoint selection.
+
+Usage: python benchmarks/hedged_requests.py [iterations]
+"""
+import sys
+
+from utils import report, setup_django, time_calls
+
+
+def run(name, servers, iterations):
+    from django.conf import settings
+    from django_browserid.base import RemoteVerifier
+    from django_browserid.hedging import get_endpoint_set
+
+    settings.BROWSERID_VERIFICATION_URLS = [server.url for server in servers]
+    verifier = RemoteVerifier()
+    for i in range(50):
+        verifier.verify('a@example.com', 'http://testserver')  # Warm up.
+
+    samples = time_calls(lambda: verifier.verify('a@example.com', 'http://testserver'),
+                         iterations)
+    report(name, samples)
+    if len(servers) > 1:
+        endpoints = get_endpoint_set(settings.BROWSERID_VERIFICATION_URLS).endpoints
+        print('    weights: ' + ', '.join('{0:.0f}'.format(e.weight) for e in endpoints))
+
+
+def main(iterations=1000):
+    setup_django(BROWSERID_HEDGE_PERCENTILE=90, BROWSERID_HEDGE_DELAY=0.01)
+
+    from django_browserid.base import close_session
+    from django_browserid.standin import StandInServer
+
+    def replica(latency=0.002):
+        return StandInServer(latency=latency, slow_rate=0.05, slow_latency=0.1).start()
+
+    servers = [replica(), replica(), replica()]
+    degraded = [replica(), replica(), replica(latency=0.05)]
+    try:
+        run('single endpoint', servers[:1], iterations)
+        run('hedged, 3 replicas', servers, iterations)
+        run('hedged, 1 degraded replica', degraded, iterations)
+    finally:
+        close_session()
+        for server in servers + degraded:
+            server.stop()
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,37 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+Compare serializing typical Verify and Logout response payloads with
+json.dumps and LazyEncoder against json_dumps, which reuses one encoder (or
+orjson, if installed) instead of creating one per call.
+
+Usage: python benchmarks/json_encoding.py [iterations]
+"""
+import json
+import sys
+
+from utils import report, setup_django, time_calls
+
+
+def main(iterations=100000):
+    setup_django()
+
+    from django.core.urlresolvers import reverse_lazy
+
+    from django_browserid.util import json_dumps, LazyEncoder
+
+    payloads = (
+        ('verify', {'email': 'bob@example.com', 'redirect': reverse_lazy('browserid.logout')}),
+        ('verify failure', {'redirect': '/'}),
+        ('logout', {'redirect': reverse_lazy('browserid.login')}),
+    )
+    for name, payload in payloads:
+        for variant, func in (('LazyEncoder', lambda: json.dumps(payload, cls=LazyEncoder)),
+                              ('json_dumps', lambda: json_dumps(payload))):
+            func()
+            report('{0}, {1}'.format(name, variant), time_calls(func, iterations), unit='us')
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,63 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+Compare LocalVerifier throughput when verifying inline and in a process pool,
+with 1, 4 and 16 threads verifying at once. Requires PyBrowserID.
+
+Usage: python benchmarks/local_verifier.py [assertions per caller] [processes]
+"""
+import multiprocessing
+import sys
+import threading
+import time
+
+from utils import report, setup_django
+
+
+def run_callers(verifier, assertion, audience, callers, per_caller):
+    """Verify from several threads at once, returning per-call durations."""
+    samples = []
+
+    def caller():
+        for i in range(per_caller):
+            start = time.time()
+            verifier.verify(assertion, audience)
+            samples.append(time.time() - start)
+
+    threads = [threading.Thread(target=caller) for i in range(callers)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return samples, time.time() - start
+
+
+def main(per_caller=20, processes=multiprocessing.cpu_count()):
+    setup_django()
+
+    from browserid.tests.support import make_assertion
+    from django.conf import settings
+
+    from django_browserid.base import close_process_pool, LocalVerifier
+    from django_browserid.tests import patch_supportdoc_fetching
+
+    audience = 'http://testserver'
+    assertion = make_assertion('a@example.com', audience)
+
+    with patch_supportdoc_fetching():
+        for mode, pool_processes in (('inline', 0), ('pool', processes)):
+            settings.BROWSERID_LOCAL_VERIFIER_PROCESSES = pool_processes
+            settings.BROWSERID_LOCAL_VERIFIER_MAX_PENDING = 64
+            verifier = LocalVerifier()
+            verifier.verify(assertion, audience)  # Warm up.
+
+            for callers in (1, 4, 16):
+                samples, elapsed = run_callers(verifier, assertion, audience, callers, per_caller)
+                report('{0} callers={1}'.format(mode, callers), samples, elapsed=elapsed)
+            close_process_pool()
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
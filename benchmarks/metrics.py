@@ -0,0 +1,57 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+Measure the per-call cost of recording metrics with metrics disabled and
+enabled, and of recording from several threads at once.
+
+Usage: python benchmarks/metrics.py [iterations]
+"""
+from __future__ import print_function
+
+import sys
+import threading
+import time
+
+from utils import report, setup_django, time_calls
+
+
+def main(iterations=100000):
+    setup_django()
+
+    from django.test.utils import override_settings
+
+    from django_browserid import metrics
+
+    for enabled in (False, True):
+        with override_settings(BROWSERID_METRICS=enabled):
+            label = 'enabled' if enabled else 'disabled'
+            for name, func in (('incr, ' + label, lambda: metrics.incr('login.success')),
+                               ('observe, ' + label,
+                                lambda: metrics.observe('verification.duration', 0.0123))):
+                func()
+                report(name, time_calls(func, iterations), unit='us')
+
+    with override_settings(BROWSERID_METRICS=True):
+        for num_threads in (1, 4):
+            samples = []
+
+            def record():
+                samples.extend(time_calls(lambda: metrics.observe('latency', 0.01), iterations))
+
+            threads = [threading.Thread(target=record) for i in range(num_threads)]
+            start = time.time()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            report('observe, {0} threads'.format(num_threads), samples, unit='us',
+                   elapsed=time.time() - start)
+
+        start = time.time()
+        metrics.get_registry().snapshot()
+        print('snapshot: {0:.3f}ms'.format((time.time() - start) * 1000))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,35 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+Compare the per-call cost of same_origin when both URLs are parsed on every
+call with the memoized origin() helper.
+
+Usage: python benchmarks/origin.py [iterations]
+"""
+import sys
+
+from utils import report, setup_django, time_calls
+
+
+def main(iterations=100000):
+    setup_django()
+
+    from django.utils.six.moves.urllib.parse import urlparse
+
+    from django_browserid.util import origin, same_origin
+
+    def parsing_same_origin(url1, url2):
+        p1, p2 = urlparse(url1), urlparse(url2)
+        return (p1.scheme, p1.hostname, p1.port) == (p2.scheme, p2.hostname, p2.port)
+
+    url1, url2 = 'https://example.com', 'https://example.com:443/login'
+    for name, func in (('same_origin, parsing', lambda: parsing_same_origin(url1, url2)),
+                       ('same_origin, memoized', lambda: same_origin(url1, url2)),
+                       ('origin, memoized', lambda: origin(url1))):
+        func()
+        report(name, time_calls(func, iterations), unit='us')
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,48 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+Compare RemoteVerifier latency with and without the pooled session.
+
+Usage: python benchmarks/remote_verifier.py [iterations]
+"""
+from __future__ import print_function
+
+import sys
+
+from utils import report, setup_django, time_calls
+
+
+def main(iterations=500):
+    setup_django()
+
+    import requests
+
+    from django_browserid.base import RemoteVerifier, close_session
+    from django_browserid.standin import StandInServer
+
+    server = StandInServer().start()
+    try:
+        class UnpooledVerifier(RemoteVerifier):
+            verification_service_url = server.url
+
+            @property
+            def session(self):
+                # Equivalent to the old module-level requests.post call.
+                return requests
+
+        class PooledVerifier(RemoteVerifier):
+            verification_service_url = server.url
+
+        for verifier in (UnpooledVerifier(), PooledVerifier()):
+            verifier.verify('a@example.com', 'http://testserver')  # Warm up.
+            samples = time_calls(lambda: verifier.verify('a@example.com', 'http://testserver'),
+                                 iterations)
+            report(verifier.__class__.__name__, samples)
+    finally:
+        close_session()
+        server.stop()
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
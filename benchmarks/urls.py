@@ -0,0 +1,30 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+"""URLconf for the end-to-end benchmarks: django-browserid's views and a page using its helpers."""
+from django.conf.urls import include, url
+from django.http import HttpResponse
+from django.template import engines
+
+
+page_template = engines['django'].from_string("""
+{% load browserid %}
+<html>
+<head>{% browserid_css %}</head>
+<body>
+  {% browserid_info %}
+  {% if user.is_authenticated %}{% browserid_logout %}{% else %}{% browserid_login %}{% endif %}
+  {% browserid_js %}
+</body>
+</html>
+""")
+
+
+def page(request):
+    return HttpResponse(page_template.render(request=request))
+
+
+urlpatterns = [
+    url(r'', include('django_browserid.urls')),
+    url(r'^$', page, name='page'),
+]
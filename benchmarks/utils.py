@@ -0,0 +1,58 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+"""Shared helpers for the django-browserid benchmark scripts."""
+from __future__ import print_function
+
+import os
+import sys
+import time
+
+
+def setup_django(**overrides):
+    """
+    Configure Django using the test suite's settings so benchmarks can run
+    without a project. Keyword arguments override individual settings.
+    """
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'django_browserid.tests.settings')
+
+    import django
+    from django.conf import settings
+
+    for name, value in overrides.items():
+        setattr(settings, name, value)
+    django.setup()
+
+
+def percentile(samples, pct):
+    """Return the pct-th percentile of a list of samples."""
+    ordered = sorted(samples)
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def time_calls(func, iterations):
+    """Call func repeatedly and return a list of per-call durations in seconds."""
+    samples = []
+    for i in range(iterations):
+        start = time.time()
+        func()
+        samples.append(time.time() - start)
+    return samples
+
+
+def report(name, samples, unit='ms', elapsed=None):
+    """
+    Print a one-line latency summary for the given samples. Throughput is
+    calculated from elapsed, the wall-clock time taken by all samples, if
+    given, or else from the sum of the samples.
+    """
+    scale = {'ms': 1e3, 'us': 1e6}[unit]
+    total = elapsed if elapsed is not None else sum(samples)
+    rate = len(samples) / total if total else float('inf')
+    print('{0:<40} n={1:<6} p50={2:9.3f}{5} p99={3:9.3f}{5} ops/s={4:10.1f}'.format(
+        name, len(samples), percentile(samples, 50) * scale, percentile(samples, 99) * scale,
+        rate, unit))
@@ -13,6 +13,7 @@ from django_browserid.auth import (
 )  # NOQA
 from django_browserid.base import (
     BrowserIDException,
+    CachedVerifier,
     get_audience,
     MockVerifier,
     RemoteVerifier,
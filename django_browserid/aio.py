@@ -0,0 +1,481 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+Asynchronous verification and login, for use under asyncio.
+
+This module uses async/await syntax and requires Python 3.5 or above.
+Asynchronous remote verification additionally requires aiohttp.
+"""
+import asyncio
+import contextlib
+import functools
+import json
+import logging
+import os
+import ssl
+import time
+import weakref
+
+from django.conf import settings
+from django.contrib import auth
+
+from django_browserid import metrics, timing
+from django_browserid.base import (
+    BrowserIDException,
+    CachedVerifier,
+    get_audience,
+    RemoteVerifier,
+    VerificationResult
+)
+from django_browserid.compat import aiohttp_found
+from django_browserid.hedging import get_endpoint_set
+from django_browserid.replay import get_replay_store, mark_assertion_used
+from django_browserid.util import assertion_digest
+from django_browserid.views import Verify
+
+if aiohttp_found:
+    import aiohttp
+
+
+logger = logging.getLogger(__name__)
+
+# asyncio.current_task replaced Task.current_task in Python 3.7.
+_current_task = getattr(asyncio, 'current_task', None) or asyncio.Task.current_task
+
+# Traces of the logins being timed, keyed by the task handling them. This
+# stands in for the thread-local current trace of django_browserid.timing,
+# since one thread runs many logins under asyncio.
+_task_traces = weakref.WeakKeyDictionary()
+
+
+def run_in_executor(func, *args, **kwargs):
+    """
+    Run a blocking function in the event loop's default executor, returning
+    an awaitable for its result.
+    """
+    loop = asyncio.get_event_loop()
+    return loop.run_in_executor(None, functools.partial(func, *args, **kwargs))
+
+
+@contextlib.contextmanager
+def _trace_login(name):
+    """
+    Asynchronous version of :func:`django_browserid.timing.trace`. The
+    trace is the current trace of the running task rather than thread.
+    """
+    with timing.trace(name, bind=False) as trace:
+        task = _current_task()
+        _task_traces[task] = trace
+        try:
+            yield trace
+        finally:
+            _task_traces.pop(task, None)
+
+
+def _current_trace():
+    """
+    Return the trace of the login handled by the running task, or a stand-in
+    that times nothing if the login isn't being timed.
+    """
+    task = _current_task()
+    trace = _task_traces.get(task) if task is not None else None
+    return trace if trace is not None else timing.NullPhase()
+
+
+async def call_hedged(endpoint_set, func):
+    """
+    Asynchronous version of
+    :meth:`django_browserid.hedging.EndpointSet.call`.
+
+    :param func:
+        Coroutine function taking a URL and returning a ``(value, failed)``
+        tuple.
+
+    Unlike the synchronous version, requests that lose the race are
+    cancelled, and are not recorded for the endpoints' health statistics.
+    """
+    candidates = endpoint_set.choose()[:endpoint_set.max_requests]
+    delay = endpoint_set.hedge_delay()
+
+    async def send(endpoint):
+        start = time.time()
+        try:
+            answer = await func(endpoint.url)
+        except asyncio.CancelledError:
+            # Another endpoint answered first.
+            raise
+        except Exception:
+            endpoint_set.record(endpoint, time.time() - start, True)
+            raise
+        endpoint_set.record(endpoint, time.time() - start, answer[1])
+        return answer
+
+    tasks = []
+    pending = set()
+    last_answer = last_error = None
+    try:
+        while True:
+            # Send to the next endpoint on start, after each failure, and
+            # each time the hedge delay passes without an answer.
+            if len(tasks) < len(candidates):
+                task = asyncio.ensure_future(send(candidates[len(tasks)]))
+                tasks.append(task)
+                pending.add(task)
+
+            if not pending:
+                break
+
+            timeout = delay if len(tasks) < len(candidates) else None
+            done, pending = await asyncio.wait(pending, timeout=timeout,
+                                               return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is not None:
+                    last_error = task.exception()
+                elif task.result()[1]:
+                    last_answer = task.result()
+                else:
+                    return task.result()
+    finally:
+        # Cancel the requests that lost the race, and wait for every request
+        # so that asyncio doesn't log their exceptions as unhandled.
+        for task in pending:
+            task.cancel()
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    if last_answer is not None:
+        return last_answer
+    raise last_error
+
+
+class AsyncBulkVerificationMixin(object):
+    """
+    Asynchronous version of
+    :class:`django_browserid.base.BulkVerificationMixin`, for verifiers
+    whose ``verify`` method is a coroutine.
+    """
+    verify_many_concurrency = 10
+
+    async def verify_many(self, assertions, audience, concurrency=None, **kwargs):
+        """
+        Verify several assertions for the same audience concurrently.
+
+        Accepts the same arguments and returns the same results as
+        :meth:`django_browserid.base.BulkVerificationMixin.verify_many`,
+        but must be awaited. At most ``concurrency`` assertions are
+        verified at once.
+        """
+        semaphore = asyncio.Semaphore(concurrency or self.verify_many_concurrency)
+
+        async def verify(assertion):
+            async with semaphore:
+                try:
+                    return await self.verify(assertion, audience, **kwargs)
+                except Exception as err:
+                    return err
+
+        return list(await asyncio.gather(*[verify(assertion) for assertion in assertions]))
+
+
+class AsyncCachedVerifier(AsyncBulkVerificationMixin, CachedVerifier):
+    """
+    Asynchronous version of :class:`django_browserid.base.CachedVerifier`,
+    wrapping a verifier whose ``verify`` method is a coroutine. The cache is
+    accessed in the event loop's default executor.
+    """
+    async def verify(self, assertion, audience, **kwargs):
+        """
+        Verify an assertion, returning a cached result if the same assertion
+        was recently verified for the same audience.
+
+        Accepts the same arguments and returns the same results as
+        :meth:`django_browserid.base.CachedVerifier.verify`, but must be
+        awaited.
+        """
+        if kwargs:
+            return await self.verifier.verify(assertion, audience, **kwargs)
+
+        key = self.key_prefix + assertion_digest(assertion, audience)
+        response = await run_in_executor(self.cache.get, key)
+        if response is not None:
+            metrics.incr('verification_cache.hits')
+            return VerificationResult(response)
+
+        metrics.incr('verification_cache.misses')
+        result = await self.verifier.verify(assertion, audience)
+        timeout = self.get_timeout(result)
+        if timeout is not None:
+            await run_in_executor(self.cache.set, key, result._response, timeout)
+        return result
+
+
+class AsyncRemoteVerifier(AsyncBulkVerificationMixin, RemoteVerifier):
+    """
+    Verifies BrowserID assertions using a remote verification service
+    without blocking the event loop.
+
+    Uses the same verification service URLs as
+    :class:`django_browserid.RemoteVerifier`, hedging requests across them
+    if BROWSERID_VERIFICATION_URLS lists several. Of
+    ``requests_parameters``, ``timeout``, ``verify`` and ``cert`` are
+    supported; other parameters are ignored. Each event loop gets its own
+    aiohttp connection pool, limited to BROWSERID_ASYNC_HTTP_LIMIT
+    simultaneous connections.
+    """
+    cached_verifier_class = AsyncCachedVerifier
+
+    def __init__(self):
+        if not aiohttp_found:
+            raise RuntimeError('You\'re attempting to use asynchronous assertion verification '
+                               'without aiohttp installed. Please install aiohttp in order to '
+                               'enable asynchronous assertion verification.')
+        self._client_sessions = weakref.WeakKeyDictionary()
+
+    def get_client_session(self):
+        """
+        Return the :class:`aiohttp.ClientSession` for the running event
+        loop, creating it if needed.
+        """
+        loop = asyncio.get_event_loop()
+        client_session = self._client_sessions.get(loop)
+        if client_session is None or client_session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=getattr(settings, 'BROWSERID_ASYNC_HTTP_LIMIT', 100),
+                ssl=self.get_ssl_context())
+            timeout = aiohttp.ClientTimeout(total=self.requests_parameters.get('timeout'))
+            client_session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+            self._client_sessions[loop] = client_session
+        return client_session
+
+    def get_ssl_context(self):
+        """
+        Return the value for aiohttp's ``ssl`` argument equivalent to the
+        ``verify`` and ``cert`` entries of ``requests_parameters``.
+        """
+        verify = self.requests_parameters.get('verify', True)
+        cert = self.requests_parameters.get('cert')
+        if verify is False:
+            if cert is None:
+                return False
+            context = ssl.create_default_context()
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+        elif isinstance(verify, str):
+            if os.path.isdir(verify):
+                context = ssl.create_default_context(capath=verify)
+            else:
+                context = ssl.create_default_context(cafile=verify)
+        elif cert is not None:
+            context = ssl.create_default_context()
+        else:
+            return None
+
+        if cert is not None:
+            if isinstance(cert, str):
+                context.load_cert_chain(cert)
+            else:
+                context.load_cert_chain(*cert)
+        return context
+
+    async def close(self):
+        """Close the connection pool for the running event loop."""
+        client_session = self._client_sessions.pop(asyncio.get_event_loop(), None)
+        if client_session is not None:
+            await client_session.close()
+
+    async def verify(self, assertion, audience, **kwargs):
+        """
+        Verify an assertion using a remote verification service.
+
+        Accepts the same arguments and returns the same results as
+        :meth:`django_browserid.RemoteVerifier.verify`, but must be
+        awaited.
+        """
+        breaker = self.circuit_breaker
+        if breaker is not None and not breaker.allow():
+            fallback = breaker.fallback
+            if fallback is not None and asyncio.iscoroutinefunction(fallback.verify):
+                return await fallback.verify(assertion, audience, **kwargs)
+            return await run_in_executor(self.verify_circuit_open, assertion, audience, **kwargs)
+
+        data = dict(kwargs, assertion=assertion, audience=audience)
+
+        urls = self.get_verification_urls()
+        start = time.time()
+        failed = True
+        try:
+            if len(urls) == 1:
+                result, failed = await self._apost(urls[0], data)
+            else:
+                result, failed = await call_hedged(get_endpoint_set(urls),
+                                                   functools.partial(self._apost, data=data))
+            return result
+        finally:
+            if breaker is not None:
+                breaker.record(time.time() - start, failed)
+
+    async def _apost(self, url, data):
+        """
+        Send a verification request to url.
+
+        :returns:
+            A tuple of the :class:`.VerificationResult` and whether the
+            response could not be parsed.
+        """
+        try:
+            async with self.get_client_session().post(url, data=data) as response:
+                content = await response.text()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+            raise BrowserIDException(err)
+
+        try:
+            return VerificationResult(json.loads(content)), False
+        except (ValueError, TypeError) as err:
+            # If the returned JSON is invalid, log a warning and return a failure result.
+            logger.warning('Failed to parse remote verifier response: `{0}`'.format(content))
+            return VerificationResult({
+                'status': 'failure',
+                'reason': 'Could not parse verifier response: {0}'.format(err)
+            }), True
+
+
+class AsyncBackendMixin(object):
+    """
+    Adds an asynchronous authentication path to
+    :class:`django_browserid.auth.BrowserIDBackend`.
+    """
+    def get_async_verifier(self):
+        """
+        Return the verifier used by :meth:`aauthenticate`. Defaults to a
+        shared :class:`AsyncRemoteVerifier`, wrapped in an
+        :class:`AsyncCachedVerifier` if BROWSERID_VERIFICATION_CACHE is
+        True, or to the verifier returned by
+        ``get_verifier`` if the BROWSERID_VERIFIER_CLASS setting is set or
+        the backend sets its own ``verifier_class``.
+        Verifiers whose ``verify`` method is not a coroutine are run in the
+        event loop's default executor.
+        """
+        from django_browserid.auth import BrowserIDBackend, get_shared_verifier  # Circular import.
+        if (getattr(settings, 'BROWSERID_VERIFIER_CLASS', None) or
+                self.verifier_class is not BrowserIDBackend.verifier_class):
+            return self.get_verifier()
+
+        return get_shared_verifier(AsyncRemoteVerifier,
+                                   cached=getattr(settings, 'BROWSERID_VERIFICATION_CACHE', False))
+
+    async def averify(self, assertion=None, audience=None, request=None, **kwargs):
+        """
+        Asynchronous version of ``verify``. See ``authenticate`` for
+        accepted arguments.
+        """
+        trace = _current_trace()
+        if audience is None and request:
+            with trace.phase('get_audience'):
+                audience = get_audience(request)
+
+        if audience is None or assertion is None:
+            return None
+
+        verifier = self.get_async_verifier()
+        with trace.phase('verify') as verify_phase:
+            try:
+                with metrics.timer('verification.duration'):
+                    if asyncio.iscoroutinefunction(verifier.verify):
+                        result = await verifier.verify(assertion, audience, **kwargs)
+                    else:
+                        result = await run_in_executor(verifier.verify, assertion, audience,
+                                                       **kwargs)
+            except Exception as e:
+                result = None
+                verify_phase.outcome = 'error'
+                metrics.incr('verification.error')
+                logger.warn('Error while verifying assertion %s with audience %s.', assertion,
+                            audience)
+                logger.warn(e)
+            else:
+                if not result:
+                    verify_phase.outcome = 'failure'
+                metrics.incr('verification.ok' if result else 'verification.failure')
+
+        if not result:
+            return None
+        with trace.phase('replay_check') as replay_phase:
+            if (get_replay_store() is not None and
+                    not await run_in_executor(mark_assertion_used, assertion, audience, result)):
+                replay_phase.outcome = 'failure'
+                metrics.incr('verification.replay')
+                logger.warning('Rejected replayed assertion for %s.', result.email)
+                return None
+        return result.email
+
+    async def aauthenticate(self, assertion=None, audience=None, request=None, **kwargs):
+        """
+        Asynchronous version of ``authenticate``. The verification request
+        is awaited, while database access is run in the event loop's
+        default executor.
+        """
+        email = await self.averify(assertion, audience, request, **kwargs)
+        return await run_in_executor(_current_trace().call, self.get_user_for_email, email)
+
+
+async def aauthenticate(**credentials):
+    """
+    Asynchronous version of :func:`django.contrib.auth.authenticate`.
+
+    Only backends that define an ``aauthenticate`` method are consulted.
+    """
+    for backend_path in settings.AUTHENTICATION_BACKENDS:
+        backend = auth.load_backend(backend_path)
+        if not hasattr(backend, 'aauthenticate'):
+            continue
+
+        user = await backend.aauthenticate(**credentials)
+        if user is not None:
+            # Annotate the user object with the path of the backend, like
+            # django.contrib.auth.authenticate does.
+            user.backend = backend_path
+            return user
+    return None
+
+
+class AsyncVerify(Verify):
+    """
+    Asynchronous version of :class:`django_browserid.views.Verify`.
+
+    Requires a Django version and server that support asynchronous views.
+    Enable it with ``BROWSERID_VERIFY_CLASS = 'django_browserid.aio.AsyncVerify'``.
+    """
+    async def dispatch(self, request, *args, **kwargs):
+        response = super(AsyncVerify, self).dispatch(request, *args, **kwargs)
+        if asyncio.iscoroutine(response):
+            response = await response
+        return response
+
+    async def http_method_not_allowed(self, *args, **kwargs):
+        return super(AsyncVerify, self).http_method_not_allowed(*args, **kwargs)
+
+    async def post(self, *args, **kwargs):
+        """
+        Verify the given assertion without blocking the event loop and,
+        depending on the result, trigger login success or failure.
+        """
+        with _trace_login('browserid.login') as trace:
+            assertion = self.request.POST.get('assertion')
+            if not assertion:
+                trace.outcome = 'failure'
+                metrics.incr('login.failure')
+                return self.login_failure()
+
+            with trace.phase('authenticate'):
+                self.user = await aauthenticate(request=self.request, assertion=assertion)
+            if self.user and self.user.is_active:
+                trace.outcome = 'success'
+                metrics.incr('login.success')
+                return await run_in_executor(trace.call, self.login_success)
+
+            if self.user:
+                metrics.incr('login.inactive')
+            trace.outcome = 'failure'
+            metrics.incr('login.failure')
+            return self.login_failure()
@@ -1,20 +1,36 @@
 # This Source Code Form is subject to the terms of the Mozilla Public
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
+import atexit
 import base64
 import hashlib
+import inspect
 import logging
+import os
+import threading
 
 from django.conf import settings
+from django.utils import six
+from django.core.signals import request_finished, request_started, setting_changed
+from django.db.models.signals import post_delete, post_save
 
 try:
     from django.utils.encoding import smart_bytes
 except ImportError:
     from django.utils.encoding import smart_str as smart_bytes
 
-from django_browserid.base import get_audience, LocalVerifier, RemoteVerifier
+from django_browserid import metrics, timing
+from django_browserid.base import CachedVerifier, get_audience, LocalVerifier, RemoteVerifier
+from django_browserid.compat import async_supported
+from django_browserid.replay import mark_assertion_used
 from django_browserid.signals import user_created
-from django_browserid.util import import_from_setting
+from django_browserid.util import import_from_setting, LRUCache
+
+if async_supported:
+    from django_browserid.aio import AsyncBackendMixin
+else:
+    class AsyncBackendMixin(object):
+        pass
 
 try:
     from django.contrib.auth import get_user_model
@@ -28,6 +44,97 @@ except ImportError:
 logger = logging.getLogger(__name__)
 
 
+# Verifier instances shared by every backend in this process, keyed by
+# (verifier class, whether results are cached), along with the pid of the
+# process that created them so that forked children build their own.
+_verifiers = {}
+_verifiers_pid = None
+_verifiers_lock = threading.Lock()
+
+
+def get_verifier_class(default=RemoteVerifier):
+    """
+    Return the verifier class named by the BROWSERID_VERIFIER_CLASS
+    setting, or ``default`` if the setting is not set.
+
+    :raises:
+        ImproperlyConfigured if the setting cannot be imported.
+    """
+    if getattr(settings, 'BROWSERID_VERIFIER_CLASS', None):
+        return import_from_setting('BROWSERID_VERIFIER_CLASS')
+    return default
+
+
+def get_shared_verifier(verifier_class, cached=False):
+    """
+    Return the process-wide instance of ``verifier_class``, creating it on
+    first use or after the process has forked. Shared verifiers are used
+    from several threads at once, so they must not keep per-call state.
+
+    :param verifier_class:
+        Verifier class to instantiate. It is called without arguments.
+
+    :param cached:
+        If True, return the shared instance wrapped in a
+        :class:`django_browserid.base.CachedVerifier`, or in the class set as
+        the verifier's ``cached_verifier_class`` attribute.
+    """
+    global _verifiers, _verifiers_pid
+
+    key = (verifier_class, bool(cached))
+    pid = os.getpid()
+    verifier = _verifiers.get(key) if _verifiers_pid == pid else None
+    if verifier is None:
+        with _verifiers_lock:
+            if _verifiers_pid != pid:
+                _verifiers, _verifiers_pid = {}, pid
+
+            verifier = _verifiers.get(key)
+            if verifier is None:
+                verifier = _verifiers.get((verifier_class, False))
+                if verifier is None:
+                    verifier = _verifiers[(verifier_class, False)] = verifier_class()
+                if cached:
+                    cached_verifier_class = getattr(verifier, 'cached_verifier_class',
+                                                    CachedVerifier)
+                    verifier = _verifiers[key] = cached_verifier_class(verifier)
+    return verifier
+
+
+def close_verifiers():
+    """
+    Close and forget the shared verifiers of the current process. Verifiers
+    with a ``close`` method are closed, releasing connection or process
+    pools. This is run automatically when the interpreter exits.
+    """
+    global _verifiers
+
+    with _verifiers_lock:
+        verifiers, _verifiers = _verifiers, {}
+    if _verifiers_pid != os.getpid():
+        return
+
+    for (verifier_class, cached), verifier in verifiers.items():
+        close = getattr(verifier, 'close', None)
+        if cached or close is None:
+            continue
+        # Asynchronous verifiers must be closed from their event loop.
+        if async_supported and inspect.iscoroutinefunction(close):
+            continue
+
+        try:
+            close()
+        except Exception as err:
+            logger.warning('Error while closing verifier %r: %s', verifier, err)
+atexit.register(close_verifiers)
+
+
+def _reset_verifiers(setting, **kwargs):
+    if setting == 'BROWSERID_VERIFIER_CLASS' or setting.startswith('BROWSERID_VERIFICATION_CACHE'):
+        close_verifiers()
+setting_changed.connect(_reset_verifiers)
+
+
 def default_username_algo(email):
     # store the username as a base64 encoded sha1 of the email address
     # this protects against data leakage because usernames are often
@@ -37,11 +144,166 @@ def default_username_algo(email):
     ).rstrip(b'=')
 
 
-class BrowserIDBackend(object):
+# In-process cache of email to user primary key mappings, used when
+# BROWSERID_USER_CACHE_ALIAS isn't set.
+_user_cache = None
+_user_cache_lock = threading.Lock()
+
+
+def get_user_cache():
+    """
+    Return the cache used to map verified email addresses to user primary
+    keys, or None if the BROWSERID_USER_CACHE setting is False.
+
+    If the BROWSERID_USER_CACHE_ALIAS setting names a Django cache, that
+    cache is used. Otherwise, a process-wide
+    :class:`django_browserid.util.LRUCache` holding up to
+    BROWSERID_USER_CACHE_SIZE entries is used.
+    """
+    global _user_cache
+
+    if not getattr(settings, 'BROWSERID_USER_CACHE', False):
+        return None
+
+    alias = getattr(settings, 'BROWSERID_USER_CACHE_ALIAS', None)
+    if alias is not None:
+        from django.core.cache import caches
+        return caches[alias]
+
+    if _user_cache is None:
+        with _user_cache_lock:
+            if _user_cache is None:
+                _user_cache = LRUCache(getattr(settings, 'BROWSERID_USER_CACHE_SIZE', 10000))
+    return _user_cache
+
+
+def user_cache_key(email):
+    """Return the user cache key for the given email address."""
+    normalized = smart_bytes(email.strip().lower())
+    return 'browserid:user:' + hashlib.sha1(normalized).hexdigest()
+
+
+def invalidate_user_cache(email):
+    """Forget the cached user for the given email address, if any."""
+    cache = get_user_cache()
+    if cache is not None and email:
+        cache.delete(user_cache_key(email))
+
+
+def _invalidate_cached_user(sender, instance=None, user=None, **kwargs):
+    # Connected to post_save, post_delete and user_created. The setting is
+    # checked first since post_save fires for every model.
+    if not getattr(settings, 'BROWSERID_USER_CACHE', False):
+        return
+
+    if user is None and sender is get_user_model():
+        user = instance
+    if user is not None:
+        invalidate_user_cache(getattr(user, 'email', None))
+post_save.connect(_invalidate_cached_user)
+post_delete.connect(_invalidate_cached_user)
+user_created.connect(_invalidate_cached_user)
+
+
+def _reset_user_cache(setting, **kwargs):
+    global _user_cache
+    if setting.startswith('BROWSERID_USER_CACHE'):
+        _user_cache = None
+setting_changed.connect(_reset_user_cache)
+
+
+# Users fetched by BrowserIDBackend.get_user during the current request,
+# keyed like the shared cache. Only kept between the request_started and
+# request_finished signals. Saving or deleting a user bumps the generation,
+# which makes every thread drop its memo.
+_request_users = threading.local()
+_request_users_generation = 0
+_request_users_lock = threading.Lock()
+
+_get_user_stats = {'request_hits': 0, 'cache_hits': 0, 'misses': 0}
+_get_user_stats_lock = threading.Lock()
+
+
+def get_user_cache_key(user_model, user_id):
+    """Return the get_user cache key for a user model and primary key."""
+    opts = user_model._meta
+    return 'browserid:get_user:{0}.{1}:{2}'.format(opts.app_label, opts.model_name,
+                                                   six.text_type(user_id))
+
+
+def get_user_stats(reset=False):
+    """
+    Return counters for :meth:`BrowserIDBackend.get_user` calls when
+    BROWSERID_GET_USER_CACHE is enabled: ``request_hits`` for users found in
+    the per-request memo, ``cache_hits`` for users found in the shared cache
+    and ``misses`` for users fetched from the database.
+
+    :param reset:
+        If True, reset the counters to zero after reading them.
+    """
+    with _get_user_stats_lock:
+        stats = dict(_get_user_stats)
+        if reset:
+            for name in _get_user_stats:
+                _get_user_stats[name] = 0
+    return stats
+
+
+def _count_get_user(name):
+    with _get_user_stats_lock:
+        _get_user_stats[name] += 1
+    metrics.incr('get_user_cache.' + name)
+
+
+def _request_user_memo():
+    """
+    Return the current thread's memo of users, or None outside of a request.
+    """
+    memo = getattr(_request_users, 'users', None)
+    generation = _request_users_generation
+    if memo is not None and _request_users.generation != generation:
+        memo = _request_users.users = {}
+        _request_users.generation = generation
+    return memo
+
+
+def _start_request_user_memo(**kwargs):
+    _request_users.users = {}
+    _request_users.generation = _request_users_generation
+request_started.connect(_start_request_user_memo)
+
+
+def _end_request_user_memo(**kwargs):
+    _request_users.users = None
+request_finished.connect(_end_request_user_memo)
+
+
+def _invalidate_get_user_cache(sender, instance, **kwargs):
+    global _request_users_generation
+    if not getattr(settings, 'BROWSERID_GET_USER_CACHE', False) or sender is not get_user_model():
+        return
+
+    from django.core.cache import caches
+    caches[getattr(settings, 'BROWSERID_GET_USER_CACHE_ALIAS', 'default')].delete(
+        get_user_cache_key(sender, instance.pk))
+
+    # Drop the memos only once the shared cache is cleared, so that they
+    # can't pick the old user up from it again.
+    with _request_users_lock:
+        _request_users_generation += 1
+post_save.connect(_invalidate_get_user_cache)
+post_delete.connect(_invalidate_get_user_cache)
+
+
+class BrowserIDBackend(AsyncBackendMixin):
     supports_anonymous_user = False
     supports_inactive_user = True
     supports_object_permissions = False
 
+    #: Verifier class used to verify assertions. Unless a subclass sets its
+    #: own, the BROWSERID_VERIFIER_CLASS setting takes precedence.
+    verifier_class = RemoteVerifier
+
     def __init__(self):
         # Store the current user model on creation to avoid issues if settings.AUTH_USER_MODEL
         # changes, which usually only happens during tests.
@@ -49,10 +311,19 @@ class BrowserIDBackend(object):
 
     def get_verifier(self):
         """
-        Create a verifier for verifying assertions. Uses a
-        :class:`django_browserid.base.RemoteVerifier` by default.
+        Return the verifier for verifying assertions. Uses
+        :attr:`verifier_class` if a subclass sets it, or else the class named
+        by the BROWSERID_VERIFIER_CLASS setting, defaulting to a
+        :class:`django_browserid.base.RemoteVerifier`.
+
+        The verifier is created once per process and shared between threads
+        and backend instances; see :func:`get_shared_verifier`.
         """
-        return RemoteVerifier()
+        verifier_class = self.verifier_class
+        if verifier_class is BrowserIDBackend.verifier_class:
+            verifier_class = get_verifier_class(verifier_class)
+        return get_shared_verifier(verifier_class,
+                                   cached=getattr(settings, 'BROWSERID_VERIFICATION_CACHE', False))
 
     def filter_users_by_email(self, email):
         """Return all users matching the specified email."""
@@ -91,24 +362,38 @@ class BrowserIDBackend(object):
         for accepted arguments.
         """
         if audience is None and request:
-            audience = get_audience(request)
+            with timing.phase('get_audience'):
+                audience = get_audience(request)
 
         if audience is None or assertion is None:
             return None
 
         verifier = self.get_verifier()
-        try:
-            result = verifier.verify(assertion, audience, **kwargs)
-        except Exception as e:
-            result = None
-            logger.warn('Error while verifying assertion %s with audience %s.', assertion,
-                        audience)
-            logger.warn(e)
+        with timing.phase('verify') as verify_phase:
+            try:
+                with metrics.timer('verification.duration'):
+                    result = verifier.verify(assertion, audience, **kwargs)
+            except Exception as e:
+                result = None
+                verify_phase.outcome = 'error'
+                metrics.incr('verification.error')
+                logger.warn('Error while verifying assertion %s with audience %s.', assertion,
+                            audience)
+                logger.warn(e)
+            else:
+                if not result:
+                    verify_phase.outcome = 'failure'
+                metrics.incr('verification.ok' if result else 'verification.failure')
 
         if not result:
             return None
-        else:
-            return result.email
+        with timing.phase('replay_check') as replay_phase:
+            if not mark_assertion_used(assertion, audience, result):
+                replay_phase.outcome = 'failure'
+                metrics.incr('verification.replay')
+                logger.warning('Rejected replayed assertion for %s.', result.email)
+                return None
+        return result.email
 
     def authenticate(self, assertion=None, audience=None, request=None, **kwargs):
         """
@@ -143,14 +428,25 @@ class BrowserIDBackend(object):
             function on the verifier.
         """
         email = self.verify(assertion, audience, request, **kwargs)
+        return self.get_user_for_email(email)
+
+    def get_user_for_email(self, email):
+        """
+        Return the user to log in for a verified email address, creating a
+        new user if necessary and allowed by BROWSERID_CREATE_USER.
+
+        :returns:
+            The user, or None if no user could be found or created.
+        """
         if not email or not self.is_valid_email(email):
             return None
 
         # In the rare case that two user accounts have the same email address,
         # log and bail. Randomly selecting one seems really wrong.
-        users = self.filter_users_by_email(email=email)
+        with timing.phase('get_users'):
+            users = self.get_users_for_email(email)
         if len(users) > 1:
-            logger.warn('%s users with email address %s.', len(users), email)
+            logger.warn('Multiple users with email address %s.', email)
             return None
         if len(users) == 1:
             return users[0]
@@ -167,11 +463,92 @@ class BrowserIDBackend(object):
                 # Find the function to call.
                 create_function = import_from_setting('BROWSERID_CREATE_USER')
 
-            user = create_function(email)
-            user_created.send(create_function, user=user)
+            with timing.phase('create_user'):
+                user = create_function(email)
+            with timing.phase('user_created'):
+                user_created.send(create_function, user=user)
+            metrics.incr('user.created')
             return user
 
+    def get_users_for_email(self, email):
+        """
+        Return a list of at most two users matching the specified email;
+        two means the address is shared by several accounts.
+
+        If the BROWSERID_USER_CACHE setting is True, the primary key of the
+        matching user is cached, and later lookups only fetch that user,
+        re-checking that their email still matches. Addresses without a
+        user are also cached for a short time, unless users are created on
+        demand. Cached entries are dropped when a user is saved, deleted or
+        created by django-browserid.
+        """
+        cache = get_user_cache()
+        if cache is None:
+            return list(self.filter_users_by_email(email=email)[:2])
+
+        key = user_cache_key(email)
+        cached = cache.get(key)
+        if cached:
+            users = list(self.filter_users_by_email(email=email).filter(pk=cached[0])[:1])
+            if users:
+                metrics.incr('user_cache.hits')
+                return users
+        elif cached is not None and not getattr(settings, 'BROWSERID_CREATE_USER', True):
+            metrics.incr('user_cache.hits')
+            return []
+
+        metrics.incr('user_cache.misses')
+        users = list(self.filter_users_by_email(email=email)[:2])
+        if len(users) == 1:
+            cache.set(key, (users[0].pk,), getattr(settings, 'BROWSERID_USER_CACHE_TIMEOUT', 3600))
+        elif not users:
+            cache.set(key, (), getattr(settings, 'BROWSERID_USER_CACHE_NEGATIVE_TIMEOUT', 60))
+        return users
+
     def get_user(self, user_id):
+        """
+        Return the user with the given primary key, or None if there is no
+        such user.
+
+        If the BROWSERID_GET_USER_CACHE setting is True, users are memoized
+        until the end of the current request and stored in the Django cache
+        named by BROWSERID_GET_USER_CACHE_ALIAS for
+        BROWSERID_GET_USER_CACHE_TIMEOUT seconds. Outside of requests, such as
+        in management commands, only the Django cache is used. Cached users
+        are dropped, in every thread, when they are saved or deleted, but not
+        when they are changed without
+        sending signals, e.g. by ``QuerySet.update``; such changes, including
+        deactivating a user, only take effect once the cached user expires.
+        See :func:`get_user_stats` for hit and miss counters.
+        """
+        if not getattr(settings, 'BROWSERID_GET_USER_CACHE', False):
+            return self.fetch_user(user_id)
+
+        key = get_user_cache_key(self.User, user_id)
+        memo = _request_user_memo()
+        user = memo.get(key) if memo is not None else None
+        if user is not None:
+            _count_get_user('request_hits')
+            return user
+
+        from django.core.cache import caches
+        cache = caches[getattr(settings, 'BROWSERID_GET_USER_CACHE_ALIAS', 'default')]
+        user = cache.get(key)
+        if user is not None:
+            _count_get_user('cache_hits')
+        else:
+            _count_get_user('misses')
+            user = self.fetch_user(user_id)
+            if user is None:
+                return None
+            cache.set(key, user, getattr(settings, 'BROWSERID_GET_USER_CACHE_TIMEOUT', 30))
+
+        if memo is not None:
+            memo[key] = user
+        return user
+
+    def fetch_user(self, user_id):
+        """Fetch the user with the given primary key from the database."""
         try:
             user = self.User.objects.get(pk=user_id)
             return user
@@ -184,8 +561,11 @@ class LocalBrowserIDBackend(BrowserIDBackend):
     BrowserID authentication backend that uses local verification
     instead of remote verification.
     """
-    def get_verifier(self):
-        return LocalVerifier()
+    verifier_class = LocalVerifier
+
+    def get_async_verifier(self):
+        # Local verification is CPU-bound, so it is run in an executor.
+        return self.get_verifier()
 
 
 class AutoLoginBackend(BrowserIDBackend):
@@ -2,17 +2,27 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 import logging
+import multiprocessing
+import os
+import threading
+import time
 from datetime import datetime
+from functools import partial
+from multiprocessing.pool import ThreadPool
 
 from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
 from django.utils import six
 from django.utils.encoding import python_2_unicode_compatible
 
 import requests
 
+from django_browserid.circuit import CircuitOpenError, get_circuit_breaker
 from django_browserid.compat import pybrowserid_found
-from django_browserid.util import same_origin
+from django_browserid.hedging import get_endpoint_set
+from django_browserid.metrics import incr
+from django_browserid.util import assertion_digest, LRUCache, origin
 
 
 logger = logging.getLogger(__name__)
@@ -67,6 +77,38 @@ def sanity_checks(request):
     return True
 
 
+# Origin index of the last audience list seen by get_audience_index, stored
+# with the list it was built from.
+_audience_index = (None, {})
+
+
+def get_audience_index(audiences):
+    """
+    Return a dict mapping the origin of each audience in ``audiences``, as
+    returned by :func:`django_browserid.util.origin`, to the first audience
+    with that origin.
+
+    The index is built once and reused for as long as the same list is
+    passed in, and is rebuilt when the BROWSERID_AUDIENCES setting changes.
+    """
+    global _audience_index
+
+    indexed_audiences, index = _audience_index
+    if indexed_audiences is not audiences:
+        index = {}
+        for audience in audiences:
+            index.setdefault(origin(audience), audience)
+        _audience_index = (audiences, index)
+    return index
+
+
+def _reset_audience_index(setting, **kwargs):
+    global _audience_index
+    if setting == 'BROWSERID_AUDIENCES':
+        _audience_index = (None, {})
+setting_changed.connect(_reset_audience_index)
+
+
 def get_audience(request):
     """
     Determine the audience to use for verification from the given request.
@@ -91,14 +133,16 @@ def get_audience(request):
     except AttributeError:
         if settings.DEBUG:
             return host
+        incr('audience.misconfigured')
         raise ImproperlyConfigured('Required setting BROWSERID_AUDIENCES not found!')
 
-    for audience in audiences:
-        if same_origin(host, audience):
-            return audience
+    audience = get_audience_index(audiences).get(origin(host))
+    if audience is not None:
+        return audience
 
     # No audience found? We must not be configured properly, otherwise why are we getting this
     # request?
+    incr('audience.misconfigured')
     raise ImproperlyConfigured('No audience could be found in BROWSERID_AUDIENCES for host `{0}`.'
                                .format(host))
 
@@ -153,17 +197,173 @@ class VerificationResult(object):
         return six.u('<VerificationResult {0}{1}>').format(result, email_string)
 
 
-class RemoteVerifier(object):
+def _capture_errors(func, *args, **kwargs):
+    """
+    Call func, returning any exception it raises instead of raising it.
+    """
+    try:
+        return func(*args, **kwargs)
+    except Exception as err:
+        return err
+
+
+class BulkVerificationMixin(object):
+    """
+    Adds :meth:`verify_many` to a verifier, verifying several assertions
+    concurrently using a pool of threads.
+    """
+    #: Maximum number of assertions that :meth:`verify_many` verifies at
+    #: once, unless overridden by its ``concurrency`` argument.
+    verify_many_concurrency = 10
+
+    def verify_many(self, assertions, audience, concurrency=None, **kwargs):
+        """
+        Verify several assertions for the same audience concurrently.
+
+        :param assertions:
+            Iterable of BrowserID assertions to verify.
+
+        :param audience:
+            The protocol, hostname and port of your website.
+
+        :param concurrency:
+            Maximum number of assertions to verify at once. Defaults to
+            :attr:`verify_many_concurrency`.
+
+        :param kwargs:
+            Extra keyword arguments are passed on to ``verify``.
+
+        :returns:
+            A list with one item per assertion, in the same order as
+            ``assertions``. Each item is either the
+            :class:`.VerificationResult` for the assertion, or the exception
+            raised while verifying it.
+        """
+        assertions = list(assertions)
+        if not assertions:
+            return []
+
+        concurrency = min(concurrency or self.verify_many_concurrency, len(assertions))
+        pool = ThreadPool(concurrency)
+        try:
+            return pool.map(partial(_capture_errors, self.verify, audience=audience, **kwargs),
+                            assertions)
+        finally:
+            pool.terminate()
+
+
+# Process-wide HTTP session shared by every RemoteVerifier, along with
+# the pid of the process that created it. Sessions (and the sockets in
+# their connection pools) must not be shared across a fork, so a child
+# process always builds its own.
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+
+def create_session():
+    """
+    Create a :class:`requests.Session` configured with a keep-alive
+    connection pool sized by the BROWSERID_HTTP_POOL_* settings.
+    """
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=getattr(settings, 'BROWSERID_HTTP_POOL_CONNECTIONS', 10),
+        pool_maxsize=getattr(settings, 'BROWSERID_HTTP_POOL_MAXSIZE', 10),
+        pool_block=getattr(settings, 'BROWSERID_HTTP_POOL_BLOCK', False),
+        max_retries=getattr(settings, 'BROWSERID_HTTP_MAX_RETRIES', 0),
+    )
+
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def get_session():
+    """
+    Return the pooled :class:`requests.Session` for the current process,
+    creating it on first use or after the process has forked.
+    """
+    global _session, _session_pid
+
+    pid = os.getpid()
+    if _session is None or _session_pid != pid:
+        with _session_lock:
+            if _session is None or _session_pid != pid:
+                _session = create_session()
+                _session_pid = pid
+    return _session
+
+
+def close_session():
+    """
+    Close the pooled session, if any, dropping its idle connections. A new
+    session is created the next time one is needed.
+    """
+    global _session, _session_pid
+
+    with _session_lock:
+        session, _session, _session_pid = _session, None, None
+    if session is not None:
+        session.close()
+
+
+def _reset_session(setting, **kwargs):
+    if setting.startswith('BROWSERID_HTTP_'):
+        close_session()
+setting_changed.connect(_reset_session)
+
+
+class RemoteVerifier(BulkVerificationMixin):
     """
     Verifies BrowserID assertions using a remote verification service.
 
     By default, this uses the Mozilla Persona service for remote verification.
+    Requests are sent through a process-wide, keep-alive connection pool that
+    is shared by all RemoteVerifier instances. If several verification URLs
+    are configured, requests are hedged across them.
+
+    If the BROWSERID_CIRCUIT_BREAKER setting is True, calls to the service
+    are guarded by a shared :class:`~django_browserid.circuit.CircuitBreaker`
+    that fails fast, or uses a fallback verifier, while the service is
+    failing or slow.
     """
     verification_service_url = 'https://verifier.login.persona.org/verify'
     requests_parameters = {
         'timeout': 5
     }
 
+    @property
+    def session(self):
+        """
+        :class:`requests.Session` used to contact the verification service.
+        Defaults to the pooled session returned by :func:`.get_session`.
+        """
+        return get_session()
+
+    @property
+    def circuit_breaker(self):
+        """
+        :class:`~django_browserid.circuit.CircuitBreaker` guarding the
+        verification service, or None if there is none. Defaults to the
+        breaker returned by :func:`~django_browserid.circuit.get_circuit_breaker`.
+        """
+        return get_circuit_breaker()
+
+    def verify_circuit_open(self, assertion, audience, **kwargs):
+        """
+        Handle a verification rejected by the circuit breaker, by using the
+        breaker's fallback verifier if it has one.
+
+        :raises:
+            :class:`.BrowserIDException`: If there is no fallback verifier.
+        """
+        fallback = self.circuit_breaker.fallback
+        if fallback is None:
+            raise BrowserIDException(CircuitOpenError(
+                'Verification service {0} is unavailable.'.format(self.verification_service_url)))
+        return fallback.verify(assertion, audience, **kwargs)
+
     def verify(self, assertion, audience, **kwargs):
         """
         Verify an assertion using a remote verification service.
@@ -176,15 +376,20 @@ class RemoteVerifier(object):
             meant for your site and not for another site.
 
         :param kwargs:
-            Extra keyword arguments are passed on to requests.post to allow customization.
+            Extra keyword arguments are sent to the verification service as POST arguments.
 
         :returns:
             :class:`.VerificationResult`
 
         :raises:
             :class:`.BrowserIDException`: Error connecting to the remote verification service, or
-            error parsing the response received from the service.
+            error parsing the response received from the service, or the circuit breaker is open
+            and there is no fallback verifier.
         """
+        breaker = self.circuit_breaker
+        if breaker is not None and not breaker.allow():
+            return self.verify_circuit_open(assertion, audience, **kwargs)
+
         parameters = dict(self.requests_parameters, **{
             'data': {
                 'assertion': assertion,
@@ -193,13 +398,45 @@ class RemoteVerifier(object):
         })
         parameters['data'].update(kwargs)
 
+        urls = self.get_verification_urls()
+        start = time.time()
+        failed = True
+        try:
+            if len(urls) == 1:
+                result, failed = self._post(urls[0], parameters)
+            else:
+                result, failed = get_endpoint_set(urls).call(partial(self._post,
+                                                                     parameters=parameters))
+            return result
+        finally:
+            if breaker is not None:
+                breaker.record(time.time() - start, failed)
+
+    def get_verification_urls(self):
+        """
+        Return the list of verification service URLs to use. Defaults to the
+        BROWSERID_VERIFICATION_URLS setting, or ``verification_service_url``
+        if it isn't set. With several URLs, requests are hedged across them;
+        see :class:`~django_browserid.hedging.EndpointSet`.
+        """
+        return getattr(settings, 'BROWSERID_VERIFICATION_URLS', None) or [
+            self.verification_service_url]
+
+    def _post(self, url, parameters):
+        """
+        Send a verification request to url.
+
+        :returns:
+            A tuple of the :class:`.VerificationResult` and whether the
+            response could not be parsed.
+        """
         try:
-            response = requests.post(self.verification_service_url, **parameters)
+            response = self.session.post(url, **parameters)
         except requests.exceptions.RequestException as err:
             raise BrowserIDException(err)
 
         try:
-            return VerificationResult(response.json())
+            return VerificationResult(response.json()), False
         except (ValueError, TypeError) as err:
             # If the returned JSON is invalid, log a warning and return a failure result.
             logger.warning('Failed to parse remote verifier response: `{0}`'
@@ -207,10 +444,14 @@ class RemoteVerifier(object):
             return VerificationResult({
                 'status': 'failure',
                 'reason': 'Could not parse verifier response: {0}'.format(err)
-            })
+            }), True
+
+    def close(self):
+        """Close the pooled session's idle connections. See :func:`.close_session`."""
+        close_session()
 
 
-class MockVerifier(object):
+class MockVerifier(BulkVerificationMixin):
     """Mock-verifies BrowserID assertions."""
 
     def __init__(self, email, **kwargs):
@@ -248,18 +489,302 @@ class MockVerifier(object):
             return VerificationResult(result)
 
 
+# In-process cache used by CachedVerifier when no Django cache is configured.
+_verification_cache = None
+_verification_cache_lock = threading.Lock()
+
+
+def get_verification_cache():
+    """
+    Return the cache used to store verification results.
+
+    If the BROWSERID_VERIFICATION_CACHE_ALIAS setting names a Django cache,
+    that cache is used so results can be shared between processes.
+    Otherwise, a process-wide :class:`django_browserid.util.LRUCache` holding
+    up to BROWSERID_VERIFICATION_CACHE_SIZE results is used.
+    """
+    global _verification_cache
+
+    alias = getattr(settings, 'BROWSERID_VERIFICATION_CACHE_ALIAS', None)
+    if alias is not None:
+        from django.core.cache import caches
+        return caches[alias]
+
+    if _verification_cache is None:
+        with _verification_cache_lock:
+            if _verification_cache is None:
+                size = getattr(settings, 'BROWSERID_VERIFICATION_CACHE_SIZE', 1000)
+                _verification_cache = LRUCache(size)
+    return _verification_cache
+
+
+def _reset_verification_cache(setting, **kwargs):
+    global _verification_cache
+    if setting.startswith('BROWSERID_VERIFICATION_CACHE'):
+        _verification_cache = None
+setting_changed.connect(_reset_verification_cache)
+
+
+class CachedVerifier(BulkVerificationMixin):
+    """
+    Wraps another verifier and caches its results, so that an assertion
+    submitted several times is only verified once.
+
+    Successful results are cached until the assertion expires. Failed
+    results are only cached for a short time, controlled by the
+    BROWSERID_VERIFICATION_CACHE_FAILURE_TIMEOUT setting. Errors raised by
+    the wrapped verifier are never cached.
+    """
+    key_prefix = 'browserid:verification:'
+
+    def __init__(self, verifier, cache=None):
+        """
+        :param verifier:
+            Verifier to cache results from.
+
+        :param cache:
+            Cache to store results in. Any object implementing ``get`` and
+            ``set`` like a Django cache backend will do. Defaults to the cache
+            returned by :func:`.get_verification_cache`.
+        """
+        self.verifier = verifier
+        self.cache = cache if cache is not None else get_verification_cache()
+
+    def get_timeout(self, result):
+        """
+        Return the number of seconds to cache the given result for, or None
+        if it should not be cached.
+        """
+        if not result:
+            return getattr(settings, 'BROWSERID_VERIFICATION_CACHE_FAILURE_TIMEOUT', 5) or None
+
+        try:
+            expires = int(result._response['expires']) / 1000.0
+        except (KeyError, TypeError, ValueError):
+            return None
+
+        remaining = int(expires - time.time())
+        return remaining if remaining > 0 else None
+
+    def verify(self, assertion, audience, **kwargs):
+        """
+        Verify an assertion, returning a cached result if the same assertion
+        was recently verified for the same audience.
+
+        Extra keyword arguments are passed to the wrapped verifier. Since they
+        may affect the result, calls with extra keyword arguments bypass the
+        cache.
+
+        :returns:
+            :class:`.VerificationResult`
+        """
+        if kwargs:
+            return self.verifier.verify(assertion, audience, **kwargs)
+
+        key = self.key_prefix + assertion_digest(assertion, audience)
+        response = self.cache.get(key)
+        if response is not None:
+            incr('verification_cache.hits')
+            return VerificationResult(response)
+
+        incr('verification_cache.misses')
+        result = self.verifier.verify(assertion, audience)
+        timeout = self.get_timeout(result)
+        if timeout is not None:
+            self.cache.set(key, result._response, timeout)
+        return result
+
+
 if pybrowserid_found:
     from browserid.errors import Error as PyBrowserIDError
     from browserid.verifiers.local import LocalVerifier as PyBrowserIDLocalVerifier
 
-    class LocalVerifier(object):
+    # PyBrowserID verifier used by worker processes. Only set in processes
+    # started by LocalVerifier.
+    _worker_verifier = None
+
+    def _create_pybid_verifier():
+        # Imported here to avoid a circular import.
+        from django_browserid.supportdoc import get_support_document_manager
+        return PyBrowserIDLocalVerifier(supportdocs=get_support_document_manager())
+
+    def _init_worker():
+        global _worker_verifier
+        _worker_verifier = _create_pybid_verifier()
+
+    def _verify_in_worker(assertion, audience):
+        """
+        Verify an assertion in a worker process, returning the raw response
+        dict or the exception that was raised.
+        """
+        if _worker_verifier is None:
+            _init_worker()
+
+        try:
+            return _worker_verifier.verify(assertion, audience)
+        except Exception as err:
+            return err
+
+    class _PoolSlot(object):
+        # Releases a VerificationProcessPool slot at most once, whichever of
+        # the pool's callbacks or the waiting caller gets there first.
+        def __init__(self, semaphore):
+            self._semaphore = semaphore
+            self._lock = threading.Lock()
+            self._released = False
+
+        def release(self, *args):
+            with self._lock:
+                if self._released:
+                    return
+                self._released = True
+            self._semaphore.release()
+
+    class VerificationProcessPool(object):
+        """
+        Bounded pool of worker processes that verify assertions locally.
+
+        Workers are started, and their verifiers created, when the pool is
+        created. At most ``max_pending`` verifications may be queued or
+        running at once; callers wait up to ``timeout`` seconds for a free
+        slot and then for their result.
+        """
+        def __init__(self, processes, max_pending, timeout):
+            self.processes = processes
+            self.max_pending = max_pending
+            self.timeout = timeout
+            self.pid = os.getpid()
+            self._pool = multiprocessing.Pool(processes, initializer=_init_worker)
+            self._slots = threading.BoundedSemaphore(max_pending)
+
+        def _acquire_slot(self):
+            if six.PY3:
+                return self._slots.acquire(timeout=self.timeout)
+            else:
+                # Python 2 semaphores can't wait with a timeout, so reject
+                # immediately instead.
+                return self._slots.acquire(False)
+
+        def _submit(self, assertion, audience):
+            if not self._acquire_slot():
+                raise BrowserIDException(multiprocessing.TimeoutError(
+                    'Timed out waiting for a local verification worker.'))
+
+            # The slot is released when the worker finishes or fails, even if
+            # we've stopped waiting for it, so abandoned work still counts
+            # towards the limit.
+            slot = _PoolSlot(self._slots)
+            kwargs = {'error_callback': slot.release} if six.PY3 else {}
+            async_result = self._pool.apply_async(_verify_in_worker, (assertion, audience),
+                                                  callback=slot.release, **kwargs)
+            return async_result, slot
+
+        def _get(self, async_result, slot, deadline):
+            try:
+                return async_result.get(max(deadline - time.time(), 0))
+            except multiprocessing.TimeoutError as err:
+                raise BrowserIDException(err)
+            finally:
+                # Python 2 has no error callback, so release the slot here
+                # if the worker failed.
+                if async_result.ready():
+                    slot.release()
+
+        def apply(self, assertion, audience):
+            """
+            Verify an assertion in a worker process.
+
+            :returns:
+                The raw response dict, or the exception raised by the worker.
+
+            :raises:
+                :class:`.BrowserIDException`: The pool was too busy to accept
+                the assertion, or the result wasn't ready in time.
+            """
+            deadline = time.time() + self.timeout
+            async_result, slot = self._submit(assertion, audience)
+            return self._get(async_result, slot, deadline)
+
+        def map(self, assertions, audience):
+            """
+            Verify several assertions, returning raw responses in order.
+            Each assertion waits for a slot like :meth:`apply`, so large
+            batches are queued ``max_pending`` at a time.
+
+            :raises:
+                :class:`.BrowserIDException`: The pool was too busy to accept
+                an assertion, or a result wasn't ready in time.
+            """
+            pending = []
+            for assertion in assertions:
+                async_result, slot = self._submit(assertion, audience)
+                pending.append((async_result, slot, time.time() + self.timeout))
+            return [self._get(*args) for args in pending]
+
+        def close(self):
+            """Stop all worker processes."""
+            self._pool.terminate()
+            self._pool.join()
+
+    _process_pool = None
+    _process_pool_lock = threading.Lock()
+
+    def get_process_pool():
+        """
+        Return the process-wide :class:`VerificationProcessPool`, or None if
+        BROWSERID_LOCAL_VERIFIER_PROCESSES is not set.
+        """
+        global _process_pool
+
+        processes = getattr(settings, 'BROWSERID_LOCAL_VERIFIER_PROCESSES', 0)
+        if not processes:
+            return None
+
+        pid = os.getpid()
+        if _process_pool is None or _process_pool.pid != pid:
+            with _process_pool_lock:
+                if _process_pool is None or _process_pool.pid != pid:
+                    _process_pool = VerificationProcessPool(
+                        processes,
+                        max_pending=getattr(settings, 'BROWSERID_LOCAL_VERIFIER_MAX_PENDING',
+                                            processes * 4),
+                        timeout=getattr(settings, 'BROWSERID_LOCAL_VERIFIER_TIMEOUT', 5),
+                    )
+        return _process_pool
+
+    def close_process_pool():
+        """Stop the process-wide verification pool, if it is running."""
+        global _process_pool
+
+        with _process_pool_lock:
+            pool, _process_pool = _process_pool, None
+        if pool is not None and pool.pid == os.getpid():
+            pool.close()
+
+    def _reset_process_pool(setting, **kwargs):
+        if setting.startswith('BROWSERID_LOCAL_VERIFIER_'):
+            close_process_pool()
+    setting_changed.connect(_reset_process_pool)
+
+    class LocalVerifier(BulkVerificationMixin):
         """
         Verifies BrowserID assertions locally instead of using the remote
         verification service.
+
+        Issuer support documents and public keys are cached by a shared
+        :class:`~django_browserid.supportdoc.CachingSupportDocumentManager`.
+
+        By default, assertions are verified on the calling thread. If the
+        BROWSERID_LOCAL_VERIFIER_PROCESSES setting is set, they are instead
+        verified by a shared :class:`VerificationProcessPool` so that
+        signature checks can use several CPU cores.
+
+        :meth:`verify_many` uses a pool of processes rather than threads,
+        since signature checks are CPU-bound.
         """
         def __init__(self, *args, **kwargs):
             super(LocalVerifier, self).__init__(*args, **kwargs)
-            self.pybid_verifier = PyBrowserIDLocalVerifier()
+            self.pybid_verifier = _create_pybid_verifier()
 
         def verify(self, assertion, audience, **kwargs):
             """
@@ -274,7 +799,18 @@ if pybrowserid_found:
 
             :returns:
                 :class:`.VerificationResult`
+
+            :raises:
+                :class:`.BrowserIDException`: When using a process pool, if the pool is too busy or
+                doesn't return a result within BROWSERID_LOCAL_VERIFIER_TIMEOUT seconds.
             """
+            pool = get_process_pool()
+            if pool is not None:
+                result = self._to_result(pool.apply(assertion, audience))
+                if isinstance(result, Exception):
+                    raise result
+                return result
+
             try:
                 result = self.pybid_verifier.verify(assertion, audience)
             except PyBrowserIDError as error:
@@ -284,6 +820,45 @@ if pybrowserid_found:
                 })
 
             return VerificationResult(result)
+
+        def verify_many(self, assertions, audience, concurrency=None, **kwargs):
+            """
+            Verify several assertions for the same audience in parallel
+            worker processes. See
+            :meth:`BulkVerificationMixin.verify_many` for arguments and
+            return values.
+
+            If a shared process pool is configured it is used, and its size
+            limits concurrency instead of the ``concurrency`` argument.
+            """
+            assertions = list(assertions)
+            if not assertions:
+                return []
+
+            shared_pool = get_process_pool()
+            if shared_pool is not None:
+                responses = shared_pool.map(assertions, audience)
+            else:
+                concurrency = min(concurrency or self.verify_many_concurrency, len(assertions))
+                pool = multiprocessing.Pool(concurrency)
+                try:
+                    responses = pool.map(partial(_verify_in_worker, audience=audience),
+                                         assertions)
+                finally:
+                    pool.terminate()
+
+            return [self._to_result(response) for response in responses]
+
+        def close(self):
+            """Stop the shared process pool, if any. See :func:`close_process_pool`."""
+            close_process_pool()
+
+        def _to_result(self, response):
+            if isinstance(response, PyBrowserIDError):
+                return VerificationResult({'status': 'failure', 'reason': response})
+            elif isinstance(response, Exception):
+                return response
+            return VerificationResult(response)
 else:
     # If someone tries to use LocalVerifier, let's show a helpful error
     # instead of just raising an ImportError.
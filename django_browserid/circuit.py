@@ -0,0 +1,250 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+Circuit breaker for the remote verification service.
+"""
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+from django.conf import settings
+from django.core.signals import setting_changed
+
+from django_browserid.util import import_from_setting
+
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitOpenError(Exception):
+    """Raised when a call is rejected because the circuit is open."""
+
+
+class CircuitBreaker(object):
+    """
+    Tracks the error rate and latency of calls to a service over a sliding
+    window, and stops calls to the service once it looks unhealthy.
+
+    The breaker starts out closed, letting every call through. Once at
+    least ``min_calls`` calls were made in the last ``window`` seconds and
+    the share of them that failed, or that took ``slow_call_duration``
+    seconds or more, reaches ``error_rate`` or ``slow_call_rate``, the
+    breaker opens and rejects calls. After ``reset_timeout`` seconds it
+    half-opens and lets up to ``probes`` calls through. If they all succeed
+    quickly the breaker closes again, otherwise it re-opens.
+
+    Callers ask :meth:`allow` before each call and must then report its
+    outcome with :meth:`record`.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, window=30, min_calls=10, error_rate=0.5, slow_call_duration=2.0,
+                 slow_call_rate=0.5, reset_timeout=30, probes=1, fallback=None):
+        """
+        :param window:
+            Number of seconds of calls to consider, in one second buckets.
+
+        :param min_calls:
+            Minimum number of calls in the window before the breaker may open.
+
+        :param error_rate:
+            Share of failed calls, from 0 to 1, that opens the breaker.
+
+        :param slow_call_duration:
+            Number of seconds after which a call counts as slow.
+
+        :param slow_call_rate:
+            Share of slow calls, from 0 to 1, that opens the breaker.
+
+        :param reset_timeout:
+            Number of seconds to stay open before letting probe calls through.
+
+        :param probes:
+            Number of successful probe calls needed to close the breaker.
+
+        :param fallback:
+            Verifier to use instead of the service while the breaker is open,
+            or None to fail fast.
+        """
+        self.window = window
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.slow_call_duration = slow_call_duration
+        self.slow_call_rate = slow_call_rate
+        self.reset_timeout = reset_timeout
+        self.probes = probes
+        self.fallback = fallback
+
+        self.state = self.CLOSED
+        self.opened_at = None
+        self.rejected = 0
+
+        # Each bucket is [second, calls, errors, slow calls].
+        self._buckets = deque()
+        self._calls = self._errors = self._slow_calls = 0
+        self._probes_in_flight = 0
+        self._probe_successes = 0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """
+        Return True if a call may be made now, or False if it should be
+        rejected.
+        """
+        with self._lock:
+            if self.state == self.OPEN:
+                if time.time() < self.opened_at + self.reset_timeout:
+                    self.rejected += 1
+                    return False
+                self._set_state(self.HALF_OPEN)
+
+            if self.state == self.HALF_OPEN:
+                if self._probes_in_flight >= self.probes:
+                    self.rejected += 1
+                    return False
+                self._probes_in_flight += 1
+            return True
+
+    def record(self, duration, failed=False):
+        """
+        Record the outcome of a call that was allowed by :meth:`allow`.
+
+        :param duration:
+            Number of seconds the call took.
+
+        :param failed:
+            True if the call failed.
+        """
+        slow = duration >= self.slow_call_duration
+        with self._lock:
+            now = time.time()
+            if self.state == self.HALF_OPEN:
+                self._probes_in_flight = max(self._probes_in_flight - 1, 0)
+                if failed or slow:
+                    self._open(now)
+                else:
+                    self._probe_successes += 1
+                    if self._probe_successes >= self.probes:
+                        self._set_state(self.CLOSED)
+                return
+            elif self.state == self.OPEN:
+                # The call started before the breaker opened.
+                return
+
+            second = int(now)
+            if not self._buckets or self._buckets[-1][0] != second:
+                self._buckets.append([second, 0, 0, 0])
+            bucket = self._buckets[-1]
+            bucket[1] += 1
+            bucket[2] += failed
+            bucket[3] += slow
+            self._calls += 1
+            self._errors += failed
+            self._slow_calls += slow
+            self._expire(now)
+
+            if self._calls >= self.min_calls and (
+                    self._errors >= self.error_rate * self._calls or
+                    self._slow_calls >= self.slow_call_rate * self._calls):
+                self._open(now)
+
+    def reset(self):
+        """Close the breaker and forget all recorded calls."""
+        with self._lock:
+            self._set_state(self.CLOSED)
+
+    def stats(self):
+        """
+        Return a dict describing the current state of the breaker, for
+        monitoring.
+        """
+        with self._lock:
+            self._expire(time.time())
+            calls = self._calls
+            return {
+                'state': self.state,
+                'opened_at': self.opened_at,
+                'calls': calls,
+                'errors': self._errors,
+                'slow_calls': self._slow_calls,
+                'error_rate': float(self._errors) / calls if calls else 0.0,
+                'slow_call_rate': float(self._slow_calls) / calls if calls else 0.0,
+                'rejected': self.rejected,
+            }
+
+    def _expire(self, now):
+        while self._buckets and self._buckets[0][0] <= now - self.window:
+            second, calls, errors, slow_calls = self._buckets.popleft()
+            self._calls -= calls
+            self._errors -= errors
+            self._slow_calls -= slow_calls
+
+    def _open(self, now):
+        self._set_state(self.OPEN)
+        self.opened_at = now
+
+    def _set_state(self, state):
+        if state != self.state:
+            log = logger.warning if state == self.OPEN else logger.info
+            log('Verification circuit breaker changed from %s to %s.', self.state, state)
+
+        self.state = state
+        self._probes_in_flight = 0
+        self._probe_successes = 0
+        if state != self.HALF_OPEN:
+            self._buckets.clear()
+            self._calls = self._errors = self._slow_calls = 0
+        if state == self.CLOSED:
+            self.opened_at = None
+
+
+_circuit_breaker = None
+_circuit_breaker_pid = None
+_circuit_breaker_lock = threading.Lock()
+
+
+def get_circuit_breaker():
+    """
+    Return the process-wide :class:`CircuitBreaker` guarding the remote
+    verification service, configured by the BROWSERID_CIRCUIT_BREAKER_*
+    settings, or None if the BROWSERID_CIRCUIT_BREAKER setting is False.
+    """
+    global _circuit_breaker, _circuit_breaker_pid
+
+    if not getattr(settings, 'BROWSERID_CIRCUIT_BREAKER', False):
+        return None
+
+    pid = os.getpid()
+    if _circuit_breaker is None or _circuit_breaker_pid != pid:
+        with _circuit_breaker_lock:
+            if _circuit_breaker is None or _circuit_breaker_pid != pid:
+                fallback = None
+                if getattr(settings, 'BROWSERID_CIRCUIT_BREAKER_FALLBACK', None):
+                    fallback = import_from_setting('BROWSERID_CIRCUIT_BREAKER_FALLBACK')()
+
+                _circuit_breaker = CircuitBreaker(
+                    window=getattr(settings, 'BROWSERID_CIRCUIT_BREAKER_WINDOW', 30),
+                    min_calls=getattr(settings, 'BROWSERID_CIRCUIT_BREAKER_MIN_CALLS', 10),
+                    error_rate=getattr(settings, 'BROWSERID_CIRCUIT_BREAKER_ERROR_RATE', 0.5),
+                    slow_call_duration=getattr(
+                        settings, 'BROWSERID_CIRCUIT_BREAKER_SLOW_CALL_DURATION', 2.0),
+                    slow_call_rate=getattr(
+                        settings, 'BROWSERID_CIRCUIT_BREAKER_SLOW_CALL_RATE', 0.5),
+                    reset_timeout=getattr(settings, 'BROWSERID_CIRCUIT_BREAKER_RESET_TIMEOUT', 30),
+                    probes=getattr(settings, 'BROWSERID_CIRCUIT_BREAKER_PROBES', 1),
+                    fallback=fallback,
+                )
+                _circuit_breaker_pid = pid
+    return _circuit_breaker
+
+
+def _reset_circuit_breaker(setting, **kwargs):
+    global _circuit_breaker
+    if setting.startswith('BROWSERID_CIRCUIT_BREAKER'):
+        _circuit_breaker = None
+setting_changed.connect(_reset_circuit_breaker)
@@ -2,6 +2,7 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 """Imports that vary depending on available libraries or python versions."""
+import sys
 
 
 # If funfactory is available, we want to use its locale-aware reverse
@@ -12,6 +13,12 @@ try:
 except ImportError:
     from django.core.urlresolvers import reverse
 
+# django.core.urlresolvers moves to django.urls in newer Django versions.
+try:
+    from django.urls import get_script_prefix, get_urlconf
+except ImportError:
+    from django.core.urlresolvers import get_script_prefix, get_urlconf
+
 
 # If PyBrowserID is installed, we can support local verification.
 try:
@@ -19,3 +26,23 @@ try:
     pybrowserid_found = True
 except ImportError:
     pybrowserid_found = False
+
+
+# If aiohttp is installed, we can support asynchronous remote verification.
+try:
+    import aiohttp
+    aiohttp_found = True
+except ImportError:
+    aiohttp_found = False
+
+
+# The async API uses async/await syntax, which is only available on Python
+# 3.5 and above.
+async_supported = sys.version_info >= (3, 5)
+
+
+# functools.lru_cache is not available on Python 2.
+try:
+    from functools import lru_cache
+except ImportError:
+    lru_cache = None
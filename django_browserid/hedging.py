@@ -0,0 +1,221 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+Hedged requests across several replicas of the verification service.
+"""
+import os
+import random
+import threading
+import time
+from collections import deque
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.utils.six.moves import queue
+
+
+class Endpoint(object):
+    """
+    Health statistics for a single endpoint, as exponentially weighted
+    moving averages of its latency and error rate.
+    """
+    #: Weight given to each new sample in the moving averages.
+    decay = 0.1
+
+    def __init__(self, url):
+        self.url = url
+        self.latency = None
+        self.error_rate = 0.0
+
+    def record(self, duration, failed):
+        if self.latency is None:
+            self.latency = duration
+        else:
+            self.latency += self.decay * (duration - self.latency)
+        self.error_rate += self.decay * (float(failed) - self.error_rate)
+
+    @property
+    def weight(self):
+        """
+        Relative share of requests this endpoint should receive. Slow or
+        failing endpoints get less traffic, but never none, so that they are
+        noticed once they recover.
+        """
+        latency = max(self.latency or 0.0, 0.001)
+        return max((1 - self.error_rate) ** 2, 0.01) / latency
+
+
+class EndpointSet(object):
+    """
+    Sends requests to one of several equivalent endpoints, hedging slow
+    requests by sending a second copy to another endpoint.
+
+    Endpoints are picked at random, weighted by their recent latency and
+    error rate. If the first endpoint hasn't answered after the
+    ``percentile``-th percentile of recent response times, the request is
+    also sent to the next endpoint, up to ``max_requests`` copies, and the
+    first successful answer wins. A failed request is retried on the next
+    endpoint right away.
+    """
+    #: Number of recent response times used to compute the hedge delay.
+    sample_size = 200
+
+    #: Minimum number of response times needed before the hedge delay is
+    #: computed from them rather than using ``delay``.
+    min_samples = 20
+
+    def __init__(self, urls, percentile=95, delay=0.5, max_requests=2):
+        """
+        :param urls:
+            List of endpoint URLs.
+
+        :param percentile:
+            Percentile of recent response times to wait for before hedging.
+
+        :param delay:
+            Number of seconds to wait before hedging until enough response
+            times have been recorded.
+
+        :param max_requests:
+            Maximum number of endpoints to send a single request to.
+        """
+        self.endpoints = [Endpoint(url) for url in urls]
+        self.percentile = percentile
+        self.delay = delay
+        self.max_requests = max_requests
+        self._latencies = deque(maxlen=self.sample_size)
+        self._lock = threading.Lock()
+
+    def choose(self):
+        """
+        Return all endpoints in the order they should be tried, sampled by
+        weight without replacement.
+        """
+        with self._lock:
+            keyed = [(random.random() ** (1.0 / endpoint.weight), endpoint)
+                     for endpoint in self.endpoints]
+        keyed.sort(key=lambda item: item[0], reverse=True)
+        return [endpoint for key, endpoint in keyed]
+
+    def hedge_delay(self):
+        """Return the number of seconds to wait before hedging a request."""
+        with self._lock:
+            latencies = sorted(self._latencies)
+        if len(latencies) < self.min_samples:
+            return self.delay
+        index = int(round(self.percentile / 100.0 * (len(latencies) - 1)))
+        return latencies[index]
+
+    def record(self, endpoint, duration, failed):
+        """Record the outcome of a request to the given endpoint."""
+        with self._lock:
+            endpoint.record(duration, failed)
+            if not failed:
+                self._latencies.append(duration)
+
+    def call(self, func):
+        """
+        Call ``func`` with endpoint URLs until one call succeeds, hedging
+        slow calls.
+
+        :param func:
+            Function taking a URL and returning a ``(value, failed)`` tuple,
+            where ``failed`` is True if the value is not a usable answer. It
+            may also raise an exception.
+
+        :returns:
+            The ``(value, failed)`` tuple of the first successful call. If
+            every call fails, the tuple of the last unusable answer is
+            returned, or if there were none, the last exception is raised.
+
+        Calls that lose the race are abandoned rather than interrupted; their
+        results are still recorded for the endpoint's health statistics.
+        """
+        candidates = self.choose()[:self.max_requests]
+        delay = self.hedge_delay()
+        answers = queue.Queue()
+
+        def send(endpoint):
+            start = time.time()
+            try:
+                answer = func(endpoint.url)
+                error = None
+            except Exception as err:
+                answer, error = None, err
+            self.record(endpoint, time.time() - start, error is not None or answer[1])
+            answers.put((answer, error))
+
+        sent = pending = 0
+        next_send_at = time.time()
+        last_answer = last_error = None
+        while True:
+            if sent < len(candidates) and time.time() >= next_send_at:
+                thread = threading.Thread(target=send, args=(candidates[sent],))
+                thread.daemon = True
+                thread.start()
+                sent += 1
+                pending += 1
+                next_send_at = time.time() + delay
+
+            if not pending:
+                break
+
+            timeout = max(next_send_at - time.time(), 0) if sent < len(candidates) else None
+            try:
+                answer, error = answers.get(timeout=timeout)
+            except queue.Empty:
+                continue
+
+            pending -= 1
+            if error is None and not answer[1]:
+                return answer
+
+            if error is None:
+                last_answer = answer
+            else:
+                last_error = error
+            next_send_at = time.time()
+
+        if last_answer is not None:
+            return last_answer
+        raise last_error
+
+
+_endpoint_sets = {}
+_endpoint_sets_pid = None
+_endpoint_sets_lock = threading.Lock()
+
+
+def get_endpoint_set(urls):
+    """
+    Return the process-wide :class:`EndpointSet` for the given URLs,
+    configured by the BROWSERID_HEDGE_* settings.
+    """
+    global _endpoint_sets, _endpoint_sets_pid
+
+    key = tuple(urls)
+    pid = os.getpid()
+    endpoint_set = _endpoint_sets.get(key) if _endpoint_sets_pid == pid else None
+    if endpoint_set is None:
+        with _endpoint_sets_lock:
+            if _endpoint_sets_pid != pid:
+                _endpoint_sets, _endpoint_sets_pid = {}, pid
+
+            endpoint_set = _endpoint_sets.get(key)
+            if endpoint_set is None:
+                endpoint_set = _endpoint_sets[key] = EndpointSet(
+                    urls,
+                    percentile=getattr(settings, 'BROWSERID_HEDGE_PERCENTILE', 95),
+                    delay=getattr(settings, 'BROWSERID_HEDGE_DELAY', 0.5),
+                    max_requests=getattr(settings, 'BROWSERID_HEDGE_MAX_REQUESTS', 2),
+                )
+    return endpoint_set
+
+
+def _reset_endpoint_sets(setting, **kwargs):
+    global _endpoint_sets
+    if setting.startswith('BROWSERID_HEDGE_'):
+        with _endpoint_sets_lock:
+            _endpoint_sets = {}
+setting_changed.connect(_reset_endpoint_sets)
@@ -2,15 +2,24 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 import json
+import os
 
 from django.conf import settings
 from django.contrib.staticfiles.storage import staticfiles_storage
-from django.template.loader import render_to_string
+from django.core.signals import setting_changed
+from django.middleware.csrf import get_token
+from django.template import TemplateDoesNotExist
+from django.template.loader import get_template, render_to_string
+from django.utils.formats import localize
+from django.utils.functional import Promise
+from django.utils.html import conditional_escape
 from django.utils.safestring import mark_safe
+from django.utils.timezone import template_localtime
+from django.utils import translation
 from django.utils.six import string_types
 
-from django_browserid.compat import reverse
-from django_browserid.util import LazyEncoder
+from django_browserid.compat import get_script_prefix, get_urlconf, reverse
+from django_browserid.util import get_csrf_token, json_dumps
 
 
 MANDATORY_LINK_CLASS_LOGIN = 'browserid-login'
@@ -18,6 +27,10 @@ DEFAULT_LINK_CLASS_LOGIN = MANDATORY_LINK_CLASS_LOGIN + ' persona-button'
 MANDATORY_LINK_CLASS_LOGOUT = 'browserid-logout'
 DEFAULT_LINK_CLASS_LOGOUT = MANDATORY_LINK_CLASS_LOGOUT
 
+BUTTON_TEMPLATE = 'browserid/button.html'
+DEFAULT_BUTTON_TEMPLATE_PATH = os.path.join(os.path.dirname(__file__), 'templates',
+                                            BUTTON_TEMPLATE)
+
 
 # Use no-op shims for registering template helpers for jingo if it isn't
 # found.
@@ -34,28 +47,112 @@ except ImportError:
     register = JingoRegister()
 
 
+# Rendered browserid_info output, keyed by the language, urlconf, script
+# prefix and settings version it was rendered with.
+_info_cache = {}
+_info_cache_max_size = 100
+_settings_version = 0
+
+# Generated <script> and <link> tags, keyed by the browserid_js arguments
+# and settings they depend on.
+_static_tags_cache = {}
+
+# Whether browserid/button.html resolves to a template other than the one
+# shipped with django-browserid, or None if that hasn't been checked yet.
+_button_template_overridden = None
+
+
+def _invalidate_render_caches(**kwargs):
+    # Any setting may affect the output, from BROWSERID_REQUEST_ARGS to the
+    # template or URL configuration, and settings only change in tests.
+    global _settings_version, _button_template_overridden
+    _settings_version += 1
+    _info_cache.clear()
+    _static_tags_cache.clear()
+    _button_template_overridden = None
+setting_changed.connect(_invalidate_render_caches)
+
+
 @register.function
-def browserid_info():
+def browserid_info(request=None):
     """
     Output the HTML for the info tag, which contains the arguments for
     navigator.id.request from the BROWSERID_REQUEST_ARGS setting. Should
     be called once at the top of the page just below the <body> tag.
+
+    The output is rendered once per active language, urlconf and script
+    prefix and then reused, unless the BROWSERID_INFO_CACHE setting is
+    False or BROWSERID_REQUEST_ARGS, or any of its values, is lazy or
+    callable, since those may differ between requests. Disable it if the
+    output depends on anything else, such as the current site.
+
+    :param request:
+        The current request. If given and the BROWSERID_INFO_CSRF_TOKEN
+        setting is True, the request's CSRF token is included so the
+        JavaScript doesn't have to fetch one before logging in or out. The
+        output is then rendered on every call, as it differs per user.
+
+        If given and the BROWSERID_CSRF_COOKIE setting is True, the CSRF
+        cookie is set on the response so the JavaScript can read the token
+        from it.
     """
+    if request is not None:
+        if getattr(settings, 'BROWSERID_INFO_CSRF_TOKEN', False):
+            return _render_info(get_csrf_token(request))
+        if _use_csrf_cookie():
+            get_token(request)
+
+    if not getattr(settings, 'BROWSERID_INFO_CACHE', True) or _request_args_are_lazy():
+        return _render_info()
+
+    key = (translation.get_language(), get_urlconf(), get_script_prefix(), _settings_version)
+    try:
+        return _info_cache[key]
+    except KeyError:
+        output = _render_info()
+        if len(_info_cache) >= _info_cache_max_size:
+            _info_cache.clear()
+        _info_cache[key] = output
+        return output
+
+
+def _is_lazy(value):
+    return isinstance(value, Promise) or callable(value)
+
+
+def _request_args_are_lazy():
+    request_args = getattr(settings, 'BROWSERID_REQUEST_ARGS', {})
+    return _is_lazy(request_args) or any(_is_lazy(value) for value in request_args.values())
+
+
+def _render_info(csrf_token=None):
     # Force request_args to be a dictionary, in case it is lazily generated.
     request_args = dict(getattr(settings, 'BROWSERID_REQUEST_ARGS', {}))
 
-    info = json.dumps({
+    info = {
         'loginUrl': reverse('browserid.login'),
         'logoutUrl': reverse('browserid.logout'),
         'csrfUrl': reverse('browserid.csrf'),
         'requestArgs': request_args,
-    }, cls=LazyEncoder)
+    }
+    if csrf_token is not None:
+        info['csrfToken'] = csrf_token
+    if _use_csrf_cookie():
+        info['csrfCookieName'] = settings.CSRF_COOKIE_NAME
 
     return render_to_string('browserid/info.html', {
-        'info': info,
+        'info': json_dumps(info),
     })
 
 
+def _use_csrf_cookie():
+    # JavaScript can only read the CSRF token from the cookie if it is stored
+    # in one and the cookie isn't HttpOnly.
+    return (getattr(settings, 'BROWSERID_CSRF_COOKIE', False) and
+            not getattr(settings, 'CSRF_COOKIE_HTTPONLY', False) and
+            not getattr(settings, 'CSRF_USE_SESSIONS', False))
+
+
 def browserid_button(text=None, next=None, link_class=None, attrs=None, href='#'):
     """
     Output the HTML for a BrowserID link.
@@ -85,10 +182,48 @@ def browserid_button(text=None, next=None, link_class=None, attrs=None, href='#'
     attrs.setdefault('class', link_class)
     attrs.setdefault('href', href)
     attrs.setdefault('data-next', next)
-    return render_to_string('browserid/button.html', {
-        'text': text,
-        'attrs': attrs,
-    })
+    if button_template_overridden():
+        return render_to_string(BUTTON_TEMPLATE, {
+            'text': text,
+            'attrs': attrs,
+        })
+    return _render_button(text, attrs)
+
+
+def button_template_overridden():
+    """
+    Return True if the browserid/button.html template has been overridden by
+    the project, in which case buttons are rendered with the template engine.
+    Otherwise buttons are rendered directly, with identical output.
+
+    The template is only looked up once per process, and again after a
+    setting changes.
+    """
+    global _button_template_overridden
+
+    if _button_template_overridden is None:
+        try:
+            path = get_template(BUTTON_TEMPLATE).origin.name
+            overridden = os.path.realpath(path) != os.path.realpath(DEFAULT_BUTTON_TEMPLATE_PATH)
+        except (TemplateDoesNotExist, AttributeError, TypeError):
+            # Backends that don't report where a template came from can't be
+            # told apart from an override.
+            overridden = True
+        _button_template_overridden = overridden
+    return _button_template_overridden
+
+
+def _render_value(value):
+    # Same as outputting {{ value }} in a template with autoescaping on.
+    return conditional_escape(localize(template_localtime(value)))
+
+
+def _render_button(text, attrs):
+    """Output the same HTML as the default browserid/button.html template."""
+    attributes = ''.join(u'{0}="{1}" '.format(_render_value(key), _render_value(value))
+                         for key, value in attrs.items())
+    return mark_safe(u'\n\n<a {0}>\n\t<span>{1}</span>\n</a>\n'.format(
+        attributes, _render_value(text)))
 
 
 @register.function
@@ -183,32 +318,51 @@ def browserid_js(include_shim=True):
     file for mocking out Persona will be included, and the shim won't
     be included regardless of the value of the ``include_shim`` setting.
 
+    If the BROWSERID_JS_BUNDLE setting is True, the django-browserid API and
+    button JavaScript are included as a single file instead of two.
+
+    The tags are generated once and reused until a setting changes, so the
+    storage backend is only asked for each URL once.
+
     :param include_shim:
         A boolean that determines if the persona.org JavaScript shim is included
         in the output. Useful if you want to minify the button JavaScript using
         a library like django-compressor that can't handle external JavaScript.
     """
-    files = []
     autologin_enabled = getattr(settings, 'BROWSERID_AUTOLOGIN_ENABLED', False)
+    bundle = getattr(settings, 'BROWSERID_JS_BUNDLE', False)
+    key = ('js', bool(include_shim), autologin_enabled, bundle)
+    try:
+        return _static_tags_cache[key]
+    except KeyError:
+        pass
+
+    files = []
 
     # Include navigator.id shim only if we're not doing autologin.
     if include_shim and not autologin_enabled:
         files.append(getattr(settings, 'BROWSERID_SHIM', 'https://login.persona.org/include.js'))
 
-    # Include django-browserid API
-    files.append(staticfiles_storage.url('browserid/api.js'))
+    if bundle and not autologin_enabled:
+        # Include django-browserid API and the JS to bind to login buttons
+        # in one file.
+        files.append(staticfiles_storage.url('browserid/browserid.bundle.js'))
+    else:
+        # Include django-browserid API
+        files.append(staticfiles_storage.url('browserid/api.js'))
 
-    # If we're doing autologin, include the JS to mock out certain parts
-    # of the API.
-    if autologin_enabled:
-        files.append(staticfiles_storage.url('browserid/autologin.js'))
+        # If we're doing autologin, include the JS to mock out certain parts
+        # of the API.
+        if autologin_enabled:
+            files.append(staticfiles_storage.url('browserid/autologin.js'))
 
-    # Include the JS to bind to login buttons.
-    files.append(staticfiles_storage.url('browserid/browserid.js'))
+        # Include the JS to bind to login buttons.
+        files.append(staticfiles_storage.url('browserid/browserid.js'))
 
     tags = ['<script type="text/javascript" src="{0}"></script>'.format(path)
             for path in files]
-    return mark_safe('\n'.join(tags))
+    output = _static_tags_cache[key] = mark_safe('\n'.join(tags))
+    return output
 
 
 @register.function
@@ -217,5 +371,10 @@ def browserid_css():
     Return <link> tag for the optional CSS included with django-browserid.
     Requires use of the staticfiles app.
     """
-    url = staticfiles_storage.url('browserid/persona-buttons.css')
-    return mark_safe('<link rel="stylesheet" href="{0}" />'.format(url))
+    try:
+        return _static_tags_cache['css']
+    except KeyError:
+        url = staticfiles_storage.url('browserid/persona-buttons.css')
+        output = _static_tags_cache['css'] = mark_safe(
+            '<link rel="stylesheet" href="{0}" />'.format(url))
+        return output
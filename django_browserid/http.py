@@ -1,8 +1,6 @@
-import json
-
 from django.http import HttpResponse
 
-from django_browserid.util import LazyEncoder
+from django_browserid.util import json_dumps
 
 
 class JSONResponse(HttpResponse):
@@ -18,6 +16,6 @@ class JSONResponse(HttpResponse):
         :param status:
             HTTP status code to use for this response. Defaults to 200.
         """
-        data_json = json.dumps(data, cls=LazyEncoder)
+        data_json = json_dumps(data)
         super(JSONResponse, self).__init__(
             data_json, content_type='application/json', status=status)
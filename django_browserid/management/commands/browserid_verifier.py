@@ -0,0 +1,65 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+from django.core.management.base import BaseCommand, CommandError
+
+from django_browserid.standin import mint_assertion, StandInServer
+
+
+class Command(BaseCommand):
+    help = ('Run a local stand-in verification service for load tests and offline '
+            'development, or mint a test assertion for it.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1', help='Address to listen on.')
+        parser.add_argument('--port', type=int, default=8001, help='Port to listen on.')
+        parser.add_argument('--latency', type=float, default=0,
+                            help='Milliseconds to wait before answering each request.')
+        parser.add_argument('--slow-rate', type=float, default=0,
+                            help='Share of requests that wait --slow-latency instead.')
+        parser.add_argument('--slow-latency', type=float, default=0,
+                            help='Milliseconds slow requests wait.')
+        parser.add_argument('--error-rate', type=float, default=0,
+                            help='Share of requests answered with a 503 error.')
+        parser.add_argument('--malformed-rate', type=float, default=0,
+                            help='Share of requests answered with invalid JSON.')
+        parser.add_argument('--secret', help='Key for signing assertions. Random by default.')
+        parser.add_argument('--strict', action='store_true',
+                            help='Only accept minted assertions, not email addresses.')
+        parser.add_argument('--mint', metavar='EMAIL',
+                            help='Print an assertion for EMAIL, signed with --secret, and exit.')
+        parser.add_argument('--audience', help='Audience the minted assertion is valid for.')
+        parser.add_argument('--ttl', type=int, default=120,
+                            help='Seconds the minted assertion is valid for.')
+
+    def handle(self, *args, **options):
+        if options['mint']:
+            if not options['secret']:
+                raise CommandError('--mint requires --secret.')
+            self.stdout.write(mint_assertion(options['mint'], options['secret'],
+                                             audience=options['audience'], ttl=options['ttl']))
+            return
+
+        server = StandInServer(
+            host=options['host'],
+            port=options['port'],
+            latency=options['latency'] / 1000.0,
+            slow_rate=options['slow_rate'],
+            slow_latency=options['slow_latency'] / 1000.0,
+            error_rate=options['error_rate'],
+            malformed_rate=options['malformed_rate'],
+            secret=options['secret'],
+            accept_emails=not options['strict'],
+            verbose=options['verbosity'] > 1,
+        )
+        self.stdout.write('Stand-in verification service running at {0}'.format(server.url))
+        self.stdout.write("Set BROWSERID_VERIFICATION_URLS = ['{0}'] to use it."
+                          .format(server.url))
+        if not options['secret']:
+            self.stdout.write('Signing assertions with secret {0}'.format(server.secret))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
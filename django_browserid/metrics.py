@@ -0,0 +1,657 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+Counters and latency histograms for monitoring django-browserid.
+
+Metrics are recorded into per-thread shards without locking and
+periodically merged and sent to the sink named by the
+BROWSERID_METRICS_SINK setting. Recording is a no-op unless the
+BROWSERID_METRICS setting is True.
+"""
+import atexit
+import errno
+import json
+import logging
+import math
+import os
+import socket
+import tempfile
+import threading
+import time
+from bisect import bisect_right
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+
+from django_browserid.circuit import CircuitBreaker, get_circuit_breaker
+from django_browserid.util import import_from_setting
+
+
+logger = logging.getLogger(__name__)
+
+#: Number of histogram buckets per power of two. Bucket bounds are within
+#: about 3% of each other, regardless of scale.
+SUB_BUCKETS = 16
+
+#: Bucket index used for zero and negative values.
+ZERO_BUCKET = -(1 << 30)
+
+#: Default upper bounds, in seconds, of the buckets exposed to Prometheus.
+PROMETHEUS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def bucket_upper_bound(index):
+    """Return the exclusive upper bound of the histogram bucket at index."""
+    if index == ZERO_BUCKET:
+        return 0.0
+    exponent, sub_bucket = divmod(index, SUB_BUCKETS)
+    return math.ldexp(0.5 + (sub_bucket + 1) / (2.0 * SUB_BUCKETS), exponent)
+
+
+# Upper bounds of the buckets from about half a microsecond to six days.
+# Values in this range are bucketed by bisecting the bounds, which is
+# faster than computing their index from their exponent and mantissa.
+_FIRST_INDEX = -20 * SUB_BUCKETS
+_BOUNDS = [bucket_upper_bound(index) for index in range(_FIRST_INDEX, 20 * SUB_BUCKETS)]
+_BOUNDS_MIN = bucket_upper_bound(_FIRST_INDEX - 1)
+_BOUNDS_MAX = _BOUNDS[-1]
+
+
+def bucket_index(value):
+    """Return the index of the histogram bucket holding value."""
+    if _BOUNDS_MIN <= value < _BOUNDS_MAX:
+        return _FIRST_INDEX + bisect_right(_BOUNDS, value)
+    if value <= 0:
+        return ZERO_BUCKET
+    mantissa, exponent = math.frexp(value)
+    return exponent * SUB_BUCKETS + int((mantissa - 0.5) * 2 * SUB_BUCKETS)
+
+
+class Histogram(object):
+    """
+    Distribution of recorded values, as counts per logarithmic bucket, with
+    their total.
+    """
+    def __init__(self, buckets=None, total=0.0):
+        self.buckets = dict(buckets or {})
+        self.total = total
+
+    @property
+    def count(self):
+        return sum(self.buckets.values())
+
+    def merge(self, other):
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        self.total += other.total
+
+    def subtract(self, other):
+        """Return a new histogram of the values in this one but not in other."""
+        buckets = {}
+        for index, count in self.buckets.items():
+            count -= other.buckets.get(index, 0)
+            if count:
+                buckets[index] = count
+        return Histogram(buckets, self.total - other.total)
+
+    def percentile(self, pct):
+        """
+        Return an upper bound for the pct-th percentile of the recorded
+        values, or None if there are none.
+        """
+        count = self.count
+        if not count:
+            return None
+        rank = max(pct / 100.0 * count, 1)
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank:
+                return bucket_upper_bound(index)
+
+    def cumulative_counts(self, bounds):
+        """
+        Return the number of values below each of the given upper bounds, in
+        order, as used by Prometheus.
+        """
+        counts = [0] * len(bounds)
+        for index, count in self.buckets.items():
+            upper = bucket_upper_bound(index)
+            for i, bound in enumerate(bounds):
+                if upper <= bound:
+                    counts[i] += count
+        return counts
+
+
+class Snapshot(object):
+    """
+    Metrics recorded over some period: a dict of counter values and a dict
+    of :class:`Histogram` objects, both keyed by metric name.
+    """
+    def __init__(self, counters=None, histograms=None):
+        self.counters = counters or {}
+        self.histograms = histograms or {}
+
+    def merge(self, other):
+        for name, value in other.counters.items():
+            self.counters[name] = self.counters.get(name, 0) + value
+        for name, histogram in other.histograms.items():
+            self.histograms.setdefault(name, Histogram()).merge(histogram)
+
+    def subtract(self, other):
+        """Return a new snapshot of what was recorded in this one but not in other."""
+        counters = {}
+        for name, value in self.counters.items():
+            delta = value - other.counters.get(name, 0)
+            if delta:
+                counters[name] = delta
+        histograms = {}
+        for name, histogram in self.histograms.items():
+            delta = histogram.subtract(other.histograms.get(name, Histogram()))
+            if delta.buckets:
+                histograms[name] = delta
+        return Snapshot(counters, histograms)
+
+    def __bool__(self):
+        return bool(self.counters or self.histograms)
+    __nonzero__ = __bool__
+
+
+class _Shard(object):
+    __slots__ = ('thread', 'counters', 'buckets', 'totals')
+
+    def __init__(self, thread):
+        self.thread = thread
+        self.counters = {}
+        self.buckets = {}
+        self.totals = {}
+
+    def snapshot(self):
+        # Copying a dict doesn't release the GIL, so each copy is consistent
+        # even while the owning thread keeps recording.
+        histograms = {}
+        for name, buckets in list(self.buckets.items()):
+            histograms[name] = Histogram(dict(buckets), self.totals.get(name, 0.0))
+        return Snapshot(dict(self.counters), histograms)
+
+
+class Registry(object):
+    """
+    Aggregates metrics recorded by every thread in the process.
+
+    Each thread records into its own shard, so recording never takes a
+    lock. :meth:`snapshot` merges the shards, and :meth:`flush` sends what
+    was recorded since the previous flush to the sink.
+
+    A forked child only notices the fork, and forgets what the parent
+    recorded, when a thread without a shard records a metric or when the
+    registry is read. Until then, the thread that forked keeps recording
+    into the shard it inherited. :func:`get_registry` avoids this on
+    Python 3.7 and above by giving the child a new registry as soon as it
+    forks. On older versions, the child also runs no flusher thread until
+    it notices the fork.
+    """
+    def __init__(self, sink=None, on_fork=None):
+        """
+        :param on_fork:
+            Optional function called without arguments in a forked child
+            once it notices the fork.
+        """
+        self.sink = sink
+        self.on_fork = on_fork
+        self._clear()
+
+    def _clear(self):
+        self.pid = os.getpid()
+        self._local = threading.local()
+        self._shards = []
+        self._retired = Snapshot()
+        self._flushed = Snapshot()
+        self._lock = threading.Lock()
+
+    def _check_fork(self):
+        # Checking the pid on every call would cost more than recording, so
+        # it is only checked when a shard is created or the shards are read.
+        if self.pid != os.getpid():
+            self._clear()
+            if self.on_fork is not None:
+                self.on_fork()
+
+    def _shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            self._check_fork()
+            shard = self._local.shard = _Shard(threading.current_thread())
+            with self._lock:
+                self._shards.append(shard)
+            return shard
+
+    def incr(self, name, value=1):
+        """Add value to the counter with the given name."""
+        try:
+            counters = self._local.shard.counters
+        except AttributeError:
+            counters = self._shard().counters
+        counters[name] = counters.get(name, 0) + value
+
+    def observe(self, name, value):
+        """Record value, typically a duration in seconds, in the named histogram."""
+        try:
+            shard = self._local.shard
+        except AttributeError:
+            shard = self._shard()
+        buckets = shard.buckets.get(name)
+        if buckets is None:
+            buckets = shard.buckets[name] = {}
+        # Inlined from bucket_index, which costs as much again to call.
+        if _BOUNDS_MIN <= value < _BOUNDS_MAX:
+            index = _FIRST_INDEX + bisect_right(_BOUNDS, value)
+        else:
+            index = bucket_index(value)
+        buckets[index] = buckets.get(index, 0) + 1
+        shard.totals[name] = shard.totals.get(name, 0.0) + value
+
+    def snapshot(self):
+        """Return a :class:`Snapshot` of everything recorded so far."""
+        self._check_fork()
+        with self._lock:
+            snapshot = Snapshot()
+            snapshot.merge(self._retired)
+            live = []
+            for shard in self._shards:
+                if shard.thread.is_alive():
+                    live.append(shard)
+                    snapshot.merge(shard.snapshot())
+                else:
+                    # Fold shards of finished threads into one, so that
+                    # short-lived threads don't accumulate.
+                    self._retired.merge(shard.snapshot())
+                    snapshot.merge(shard.snapshot())
+            self._shards = live
+        return snapshot
+
+    def flush(self):
+        """Send what was recorded since the last flush to the sink."""
+        snapshot = self.snapshot()
+        delta = snapshot.subtract(self._flushed)
+        self._flushed = snapshot
+        if delta and self.sink is not None:
+            try:
+                self.sink.send(delta)
+            except Exception:
+                logger.exception('Error sending django-browserid metrics.')
+
+
+class CallbackSink(object):
+    """
+    Sink that passes each flushed :class:`Snapshot` to the function named by
+    the BROWSERID_METRICS_CALLBACK setting.
+    """
+    def __init__(self, callback=None):
+        self.callback = callback or import_from_setting('BROWSERID_METRICS_CALLBACK')
+
+    def send(self, snapshot):
+        self.callback(snapshot)
+
+
+class StatsdSink(object):
+    """
+    Sink sending counters to statsd over UDP, and histograms as gauges of
+    their 50th, 95th and 99th percentiles and maximum, in milliseconds.
+    """
+    percentiles = (50, 95, 99, 100)
+
+    def __init__(self, host=None, port=None, prefix=None):
+        self.address = (host or getattr(settings, 'BROWSERID_METRICS_STATSD_HOST', 'localhost'),
+                        port or getattr(settings, 'BROWSERID_METRICS_STATSD_PORT', 8125))
+        self.prefix = prefix or getattr(settings, 'BROWSERID_METRICS_STATSD_PREFIX', 'browserid')
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def format(self, snapshot):
+        """Return the statsd lines for a snapshot."""
+        lines = ['{0}.{1}:{2}|c'.format(self.prefix, name, value)
+                 for name, value in sorted(snapshot.counters.items())]
+        for name, histogram in sorted(snapshot.histograms.items()):
+            lines.append('{0}.{1}.count:{2}|c'.format(self.prefix, name, histogram.count))
+            for pct in self.percentiles:
+                label = 'max' if pct == 100 else 'p{0}'.format(pct)
+                lines.append('{0}.{1}.{2}:{3:.3f}|g'.format(
+                    self.prefix, name, label, histogram.percentile(pct) * 1000))
+        return lines
+
+    def send(self, snapshot):
+        # Keep datagrams small enough to avoid fragmentation.
+        packet = []
+        for line in self.format(snapshot):
+            if packet and sum(len(item) + 1 for item in packet) + len(line) > 512:
+                self.socket.sendto('\n'.join(packet).encode('utf-8'), self.address)
+                packet = []
+            packet.append(line)
+        if packet:
+            self.socket.sendto('\n'.join(packet).encode('utf-8'), self.address)
+
+
+def prometheus_name(name, suffix=''):
+    """Convert a dotted metric name to a Prometheus metric name."""
+    return 'browserid_' + name.replace('.', '_').replace('-', '_') + suffix
+
+
+def format_prometheus(snapshot, bounds=PROMETHEUS_BUCKETS, gauges=None):
+    """
+    Return the Prometheus text exposition of a snapshot of cumulative
+    metrics. Histogram values are assumed to be in seconds.
+
+    :param gauges:
+        Optional dict mapping process IDs to dicts of gauge values, as
+        returned by :func:`collect_gauges`. Gauges are labelled with the
+        process ID.
+    """
+    lines = []
+    by_name = {}
+    for pid, values in (gauges or {}).items():
+        for name, value in values.items():
+            by_name.setdefault(name, []).append((pid, value))
+    for name, values in sorted(by_name.items()):
+        metric = prometheus_name(name)
+        lines.append('# TYPE {0} gauge'.format(metric))
+        for pid, value in sorted(values):
+            lines.append('{0}{{pid="{1}"}} {2}'.format(metric, pid, value))
+
+    for name, value in sorted(snapshot.counters.items()):
+        metric = prometheus_name(name, '_total')
+        lines.append('# TYPE {0} counter'.format(metric))
+        lines.append('{0} {1}'.format(metric, value))
+
+    for name, histogram in sorted(snapshot.histograms.items()):
+        metric = prometheus_name(name, '_seconds')
+        lines.append('# TYPE {0} histogram'.format(metric))
+        for bound, count in zip(bounds, histogram.cumulative_counts(bounds)):
+            lines.append('{0}_bucket{{le="{1}"}} {2}'.format(metric, bound, count))
+        lines.append('{0}_bucket{{le="+Inf"}} {1}'.format(metric, histogram.count))
+        lines.append('{0}_sum {1}'.format(metric, histogram.total))
+        lines.append('{0}_count {1}'.format(metric, histogram.count))
+    return '\n'.join(lines) + '\n'
+
+
+class PrometheusSink(object):
+    """
+    Sink that accumulates flushed snapshots, so they can be exposed in the
+    Prometheus text format with :meth:`render`. If it is the configured
+    sink, :func:`render_prometheus` renders from it.
+    """
+    def __init__(self):
+        self.snapshot = Snapshot()
+        self._lock = threading.Lock()
+
+    def send(self, snapshot):
+        with self._lock:
+            self.snapshot.merge(snapshot)
+
+    def render(self, gauges=None):
+        """
+        Return the accumulated metrics in the Prometheus text format.
+
+        :param gauges:
+            Optional gauge values to include; see :func:`format_prometheus`.
+        """
+        with self._lock:
+            return format_prometheus(self.snapshot, gauges=gauges)
+
+
+def collect_gauges():
+    """
+    Return a dict of the current values of this process's gauges: the state
+    and recent error and slow call rates of the circuit breaker, if enabled.
+    """
+    breaker = get_circuit_breaker()
+    if breaker is None:
+        return {}
+    stats = breaker.stats()
+    return {
+        'circuit.open': int(stats['state'] == CircuitBreaker.OPEN),
+        'circuit.half_open': int(stats['state'] == CircuitBreaker.HALF_OPEN),
+        'circuit.error_rate': stats['error_rate'],
+        'circuit.slow_call_rate': stats['slow_call_rate'],
+        'circuit.rejected': stats['rejected'],
+    }
+
+
+def _encode_snapshot(snapshot, gauges):
+    return {
+        'counters': snapshot.counters,
+        'histograms': dict((name, {'buckets': histogram.buckets, 'total': histogram.total})
+                           for name, histogram in snapshot.histograms.items()),
+        'gauges': gauges,
+    }
+
+
+def _decode_snapshot(data):
+    histograms = {}
+    for name, histogram in data['histograms'].items():
+        buckets = dict((int(index), count) for index, count in histogram['buckets'].items())
+        histograms[name] = Histogram(buckets, histogram['total'])
+    return Snapshot(data['counters'], histograms), data['gauges']
+
+
+def get_metrics_dir():
+    """Return the directory named by the BROWSERID_METRICS_DIR setting."""
+    directory = getattr(settings, 'BROWSERID_METRICS_DIR', None)
+    if not directory:
+        raise ImproperlyConfigured('BROWSERID_METRICS_DIR must be set to share metrics '
+                                   'between processes.')
+    return directory
+
+
+class FileSink(object):
+    """
+    Sink that accumulates flushed snapshots and writes them, with the
+    process's gauges, to a file per process in the directory named by
+    BROWSERID_METRICS_DIR. :func:`read_metrics_dir` merges the files of all
+    processes, so one process can report metrics for every worker.
+
+    The directory should be emptied when the server starts, so that files
+    from earlier runs aren't counted.
+    """
+    def __init__(self, directory=None):
+        self.directory = directory or get_metrics_dir()
+        self.path = os.path.join(self.directory, 'browserid-{0}.json'.format(os.getpid()))
+        self.snapshot = Snapshot()
+        self._lock = threading.Lock()
+
+    def send(self, snapshot):
+        with self._lock:
+            self.snapshot.merge(snapshot)
+            data = json.dumps(_encode_snapshot(self.snapshot, collect_gauges()))
+            # Write to a temporary file and rename it, so that readers never
+            # see a partially written file.
+            fd, temp_path = tempfile.mkstemp(dir=self.directory, prefix='.browserid-')
+            with os.fdopen(fd, 'w') as f:
+                f.write(data)
+            os.rename(temp_path, self.path)
+
+
+def _process_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def read_metrics_dir(directory=None):
+    """
+    Merge the metrics written by :class:`FileSink` in every process.
+
+    Counters and histograms of processes that have exited are kept, so that
+    totals don't go backwards when workers are restarted. Gauges are only
+    kept for running processes.
+
+    :returns:
+        A tuple of the merged :class:`Snapshot` and a dict mapping process IDs
+        to dicts of gauge values.
+    """
+    directory = directory or get_metrics_dir()
+    merged = Snapshot()
+    gauges = {}
+    for filename in sorted(os.listdir(directory)):
+        if not (filename.startswith('browserid-') and filename.endswith('.json')):
+            continue
+        try:
+            with open(os.path.join(directory, filename)) as f:
+                snapshot, process_gauges = _decode_snapshot(json.load(f))
+            pid = int(filename[len('browserid-'):-len('.json')])
+        except (IOError, OSError, KeyError, TypeError, ValueError) as e:
+            logger.warning('Could not read metrics file %s: %s', filename, e)
+            continue
+        merged.merge(snapshot)
+        if process_gauges and _process_exists(pid):
+            gauges[pid] = process_gauges
+    return merged, gauges
+
+
+class _Flusher(threading.Thread):
+    def __init__(self, registry, interval):
+        super(_Flusher, self).__init__(name='browserid-metrics')
+        self.daemon = True
+        self.registry = registry
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.registry.flush()
+
+
+# Placeholder for the process-wide registry until get_registry creates it,
+# which may be None if metrics are disabled.
+_NOT_CREATED = object()
+
+_registry = _NOT_CREATED
+_registry_pid = None
+_registry_lock = threading.Lock()
+_flusher = None
+
+
+def get_registry():
+    """
+    Return the process-wide :class:`Registry`, or None if the
+    BROWSERID_METRICS setting is False.
+
+    The registry is flushed to the sink created from the
+    BROWSERID_METRICS_SINK setting, or to a :class:`FileSink` if only
+    BROWSERID_METRICS_DIR is set, every BROWSERID_METRICS_FLUSH_INTERVAL
+    seconds, and at exit.
+    """
+    global _registry, _registry_pid, _flusher
+
+    pid = os.getpid()
+    if _registry_pid != pid:
+        with _registry_lock:
+            if _registry_pid != pid:
+                registry = flusher = None
+                if getattr(settings, 'BROWSERID_METRICS', False):
+                    sink = None
+                    if getattr(settings, 'BROWSERID_METRICS_SINK', None):
+                        sink = import_from_setting('BROWSERID_METRICS_SINK')()
+                    elif getattr(settings, 'BROWSERID_METRICS_DIR', None):
+                        sink = FileSink()
+                    registry = Registry(sink, on_fork=_reset_after_fork)
+                    if sink is not None:
+                        interval = getattr(settings, 'BROWSERID_METRICS_FLUSH_INTERVAL', 10)
+                        flusher = _Flusher(registry, interval)
+                        flusher.start()
+                # incr and observe use _registry without locking, so set it
+                # last.
+                _registry_pid, _flusher, _registry = pid, flusher, registry
+    return _registry
+
+
+def incr(name, value=1):
+    """Add value to the named counter, if metrics are enabled."""
+    registry = _registry
+    if registry is _NOT_CREATED:
+        registry = get_registry()
+    if registry is not None:
+        registry.incr(name, value)
+
+
+def observe(name, value):
+    """Record value in the named histogram, if metrics are enabled."""
+    registry = _registry
+    if registry is _NOT_CREATED:
+        registry = get_registry()
+    if registry is not None:
+        registry.observe(name, value)
+
+
+class timer(object):
+    """
+    Context manager recording the number of seconds its block took in the
+    named histogram.
+    """
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        observe(self.name, time.time() - self.start)
+
+
+def flush_metrics():
+    """Flush the process-wide registry, if metrics are enabled."""
+    registry = _registry
+    if registry is not _NOT_CREATED and registry is not None:
+        registry.flush()
+atexit.register(flush_metrics)
+
+
+def render_prometheus():
+    """
+    Return all metrics in the Prometheus text format.
+
+    If the BROWSERID_METRICS_DIR setting is set, metrics are read from the
+    files written by every process's :class:`FileSink`, after flushing this
+    process's metrics. Otherwise only this process's metrics are included,
+    rendered by the sink after flushing if it is a :class:`PrometheusSink`.
+    """
+    if getattr(settings, 'BROWSERID_METRICS_DIR', None):
+        flush_metrics()
+        snapshot, gauges = read_metrics_dir()
+        return format_prometheus(snapshot, gauges=gauges)
+
+    registry = get_registry()
+    gauges = {os.getpid(): collect_gauges()}
+    if registry is not None and isinstance(registry.sink, PrometheusSink):
+        registry.flush()
+        return registry.sink.render(gauges=gauges)
+    snapshot = registry.snapshot() if registry is not None else Snapshot()
+    return format_prometheus(snapshot, gauges=gauges)
+
+
+def _reset_registry(setting, **kwargs):
+    global _registry, _registry_pid, _flusher
+    if setting.startswith('BROWSERID_METRICS'):
+        with _registry_lock:
+            if _flusher is not None:
+                _flusher.stopped.set()
+            _registry, _registry_pid, _flusher = _NOT_CREATED, None, None
+setting_changed.connect(_reset_registry)
+
+
+def _reset_after_fork():
+    # The flusher thread doesn't survive a fork, the sink may be tied to the
+    # parent, and the parent's metrics must not be reported twice, so the
+    # child creates its own registry on first use.
+    global _registry, _registry_pid, _registry_lock, _flusher
+    _registry_lock = threading.Lock()
+    _registry, _registry_pid, _flusher = _NOT_CREATED, None, None
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
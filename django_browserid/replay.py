@@ -0,0 +1,248 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+Stores of assertions that were already used to log in, for rejecting
+replayed assertions.
+
+A store is any object with an ``add(key, timeout=None)`` method that records
+``key`` for ``timeout`` seconds and returns True, or returns False if ``key``
+was already recorded or can't be recorded for that long.
+"""
+import hashlib
+import logging
+import math
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.core.signals import setting_changed
+
+from django_browserid.util import assertion_digest, import_from_setting, smart_bytes
+
+
+logger = logging.getLogger(__name__)
+
+
+class BloomFilter(object):
+    """
+    Fixed-size set of strings that may report strings it doesn't contain as
+    present, at a rate of about ``error_rate`` while it holds no more than
+    ``capacity`` strings, but never misses strings it does contain.
+    """
+    def __init__(self, capacity=10000, error_rate=1e-6):
+        self.capacity = capacity
+        self.num_bits = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.num_hashes = max(1, int(round(float(self.num_bits) / capacity * math.log(2))))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key):
+        # Double hashing: derive every bit position from two halves of one
+        # digest.
+        digest = hashlib.sha1(smart_bytes(key)).hexdigest()
+        first, second = int(digest[:20], 16), int(digest[20:], 16) | 1
+        return [(first + i * second) % self.num_bits for i in range(self.num_hashes)]
+
+    def __contains__(self, key):
+        return all(self.bits[position >> 3] & (1 << (position & 7))
+                   for position in self._positions(key))
+
+    def add(self, key):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+
+def _reject_long_timeout(timeout):
+    # The key would be forgotten before it expires, and could then be
+    # replayed, so refuse it instead.
+    logger.warning('Rejecting assertion valid for another %d seconds, longer than '
+                   'BROWSERID_REPLAY_MAX_AGE.', timeout)
+    return False
+
+
+class MemoryReplayStore(object):
+    """
+    In-process store that remembers keys in one :class:`BloomFilter` per
+    ``bucket_seconds`` of expiry time, and drops each filter once all of its
+    keys have expired. Memory use is bounded by the number of buckets that
+    fit in ``max_age``, whatever the number of logins.
+
+    A key may be falsely reported as already used, at a rate of about
+    ``error_rate`` while fewer than ``capacity`` keys expire in the same
+    bucket. The rate grows if more do, and a warning is logged.
+    """
+    def __init__(self, max_age=300, bucket_seconds=30, capacity=10000, error_rate=1e-6):
+        """
+        :param max_age:
+            Maximum number of seconds to remember a key for. Keys with a
+            longer timeout are rejected.
+
+        :param bucket_seconds:
+            Number of seconds of expiry times that share a filter.
+
+        :param capacity:
+            Number of keys each filter is sized for.
+
+        :param error_rate:
+            Rate of keys falsely reported as used while filters are under
+            capacity.
+        """
+        self.max_age = max_age
+        self.bucket_seconds = bucket_seconds
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self._filters = {}
+        self._lock = threading.Lock()
+
+    def add(self, key, timeout=None):
+        """
+        Remember key for timeout seconds, or ``max_age`` if timeout is None.
+
+        :returns:
+            True if the key was added, or False if it was already present or
+            timeout is longer than ``max_age``.
+        """
+        if timeout is None:
+            timeout = self.max_age
+        elif timeout > self.max_age:
+            return _reject_long_timeout(timeout)
+
+        now = time.time()
+        with self._lock:
+            current = int(now // self.bucket_seconds)
+            for bucket in [bucket for bucket in self._filters if bucket < current]:
+                del self._filters[bucket]
+
+            if any(key in bloom_filter for bloom_filter in self._filters.values()):
+                return False
+
+            # The filter for a bucket is dropped once the bucket's end has
+            # passed, which is at or after now + timeout.
+            bucket = int((now + timeout) // self.bucket_seconds)
+            bloom_filter = self._filters.get(bucket)
+            if bloom_filter is None:
+                bloom_filter = self._filters[bucket] = BloomFilter(self.capacity,
+                                                                   self.error_rate)
+            bloom_filter.add(key)
+            if bloom_filter.count == self.capacity + 1:
+                logger.warning('Replay store bucket is over capacity; some assertions may '
+                               'be rejected as replays. Increase '
+                               'BROWSERID_REPLAY_BUCKET_CAPACITY.')
+            return True
+
+    def __len__(self):
+        return len(self._filters)
+
+
+class CacheReplayStore(object):
+    """
+    Store backed by a Django cache, for sharing used assertions between
+    processes and servers. Relies on the cache's atomic ``add``.
+    """
+    key_prefix = 'browserid:replay:'
+
+    def __init__(self, alias='default', max_age=300):
+        """
+        :param alias:
+            Alias of the Django cache to use.
+
+        :param max_age:
+            Maximum number of seconds to remember a key for. Keys with a
+            longer timeout are rejected.
+        """
+        from django.core.cache import caches
+        self.cache = caches[alias]
+        self.max_age = max_age
+
+    def add(self, key, timeout=None):
+        """
+        Remember key for timeout seconds, or ``max_age`` if timeout is None.
+
+        :returns:
+            True if the key was added, or False if it was already present or
+            timeout is longer than ``max_age``.
+        """
+        if timeout is None:
+            timeout = self.max_age
+        elif timeout > self.max_age:
+            return _reject_long_timeout(timeout)
+        return self.cache.add(self.key_prefix + key, 1, max(int(math.ceil(timeout)), 1))
+
+
+_replay_store = None
+_replay_store_pid = None
+_replay_store_lock = threading.Lock()
+
+
+def get_replay_store():
+    """
+    Return the process-wide store of used assertions, or None if the
+    BROWSERID_REPLAY_PROTECTION setting is False.
+
+    The store is created from the BROWSERID_REPLAY_STORE setting if it is
+    set, or is a :class:`CacheReplayStore` if BROWSERID_REPLAY_CACHE_ALIAS
+    is set, or a :class:`MemoryReplayStore` otherwise.
+    """
+    global _replay_store, _replay_store_pid
+
+    if not getattr(settings, 'BROWSERID_REPLAY_PROTECTION', False):
+        return None
+
+    pid = os.getpid()
+    if _replay_store is None or _replay_store_pid != pid:
+        with _replay_store_lock:
+            if _replay_store is None or _replay_store_pid != pid:
+                max_age = getattr(settings, 'BROWSERID_REPLAY_MAX_AGE', 300)
+                alias = getattr(settings, 'BROWSERID_REPLAY_CACHE_ALIAS', None)
+                if getattr(settings, 'BROWSERID_REPLAY_STORE', None):
+                    _replay_store = import_from_setting('BROWSERID_REPLAY_STORE')()
+                elif alias is not None:
+                    _replay_store = CacheReplayStore(alias, max_age=max_age)
+                else:
+                    _replay_store = MemoryReplayStore(
+                        max_age=max_age,
+                        capacity=getattr(settings, 'BROWSERID_REPLAY_BUCKET_CAPACITY', 10000),
+                    )
+                _replay_store_pid = pid
+    return _replay_store
+
+
+def get_remaining_lifetime(result):
+    """
+    Return the number of seconds until the assertion verified with the
+    given :class:`.VerificationResult` expires, or None if unknown.
+    """
+    try:
+        expires = int(result._response['expires']) / 1000.0
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return None
+    return max(expires - time.time(), 0)
+
+
+def mark_assertion_used(assertion, audience, result=None):
+    """
+    Record that an assertion was used to log in to the given audience.
+
+    :param result:
+        The :class:`.VerificationResult` for the assertion, used to forget the
+        assertion once it expires.
+
+    :returns:
+        False if the assertion was already used, or if the store can't
+        remember it until it expires, and True otherwise, including when
+        replay protection is disabled.
+    """
+    store = get_replay_store()
+    if store is None:
+        return True
+    return store.add(assertion_digest(assertion, audience), get_remaining_lifetime(result))
+
+
+def _reset_replay_store(setting, **kwargs):
+    global _replay_store
+    if setting.startswith('BROWSERID_REPLAY_'):
+        _replay_store = None
+setting_changed.connect(_reset_replay_store)
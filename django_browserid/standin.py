@@ -0,0 +1,250 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+Local stand-in for a remote verification service, for load tests and
+offline development.
+
+:class:`StandInServer` answers ``POST /verify`` requests like a
+Persona-compatible verifier. It accepts assertions minted with
+:func:`mint_assertion` and, unless strict, plain email addresses, and can
+delay its responses or answer with errors or malformed JSON at configurable
+rates. Run it with the ``browserid_verifier`` management command.
+"""
+import base64
+import hashlib
+import hmac
+import json
+import os
+import random
+import threading
+import time
+
+from django.utils.crypto import constant_time_compare
+from django.utils.six import string_types
+from django.utils.six.moves import BaseHTTPServer, socketserver
+from django.utils.six.moves.urllib.parse import parse_qs, urlparse
+
+from django_browserid.util import smart_bytes
+
+
+#: Issuer reported for verified assertions.
+ISSUER = 'standin.browserid.invalid'
+
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def _b64decode(data):
+    data = smart_bytes(data)
+    return base64.urlsafe_b64decode(data + b'=' * (-len(data) % 4))
+
+
+def _sign(secret, payload):
+    return _b64encode(hmac.new(smart_bytes(secret), smart_bytes(payload),
+                               hashlib.sha256).digest())
+
+
+def mint_assertion(email, secret, audience=None, ttl=120):
+    """
+    Return a test assertion for email, signed with secret, that a
+    :class:`StandInServer` using the same secret verifies.
+
+    :param audience:
+        If given, the assertion is only valid for this audience.
+
+    :param ttl:
+        Number of seconds the assertion is valid for.
+    """
+    payload = _b64encode(smart_bytes(json.dumps({
+        'email': email,
+        'audience': audience,
+        'exp': int((time.time() + ttl) * 1000),
+    })))
+    return '{0}.{1}'.format(payload, _sign(secret, payload))
+
+
+def check_assertion(assertion, audience, secret, accept_emails=True):
+    """
+    Verify a test assertion and return the response a verification service
+    would send, as a dict.
+
+    :param accept_emails:
+        If True, an email address is accepted as an assertion for itself.
+    """
+    def failure(reason):
+        return {'status': 'failure', 'reason': reason}
+
+    if not assertion or not audience:
+        return failure('need assertion and audience')
+
+    if accept_emails and '@' in assertion and '.' in assertion.rsplit('@', 1)[1]:
+        email, expires = assertion, int((time.time() + 120) * 1000)
+    else:
+        try:
+            payload, signature = assertion.split('.')
+            data = json.loads(_b64decode(payload).decode('utf-8'))
+            email, expires = data['email'], int(data['exp'])
+        except (KeyError, TypeError, ValueError):
+            return failure('malformed assertion')
+        if not constant_time_compare(signature, _sign(secret, payload)):
+            return failure('bad signature')
+        if expires < time.time() * 1000:
+            return failure('assertion has expired')
+        if data.get('audience') not in (None, audience):
+            return failure('audience mismatch')
+
+    return {
+        'status': 'okay',
+        'email': email,
+        'audience': audience,
+        'expires': expires,
+        'issuer': ISSUER,
+    }
+
+
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            if length < 0:
+                raise ValueError('negative Content-Length')
+        except ValueError:
+            # The body can't be skipped, so the connection can't be reused.
+            self.close_connection = True
+            return self.respond_failure('malformed Content-Length')
+        body = self.rfile.read(length)
+
+        path = urlparse(self.path).path
+        if path not in ('/verify', '/mint'):
+            return self.respond(404, 'Not found.', 'text/plain')
+
+        try:
+            body = body.decode('utf-8')
+            if self.headers.get('Content-Type', '').startswith('application/json'):
+                data = json.loads(body)
+            else:
+                data = dict((key, values[0]) for key, values in parse_qs(body).items())
+            if not isinstance(data, dict):
+                raise TypeError('request body must be an object')
+        except (AttributeError, TypeError, UnicodeDecodeError, ValueError):
+            return self.respond_failure('malformed request')
+
+        if path == '/mint':
+            email = data.get('email', 'a@example.com')
+            try:
+                ttl = int(data.get('ttl', 120))
+            except (TypeError, ValueError):
+                return self.respond_failure('ttl must be an integer')
+            if not isinstance(email, string_types):
+                return self.respond_failure('email must be a string')
+            assertion = self.server.mint_assertion(email, audience=data.get('audience'),
+                                                   ttl=ttl)
+            return self.respond(200, assertion, 'text/plain')
+
+        server = self.server
+        latency = server.latency
+        if server.slow_rate and random.random() < server.slow_rate:
+            latency = server.slow_latency
+        if latency:
+            time.sleep(latency)
+
+        if server.error_rate and random.random() < server.error_rate:
+            return self.respond(503, 'Service unavailable.', 'text/plain')
+        if server.malformed_rate and random.random() < server.malformed_rate:
+            return self.respond(200, '{"status": "okay", "email": ', 'application/json')
+
+        try:
+            result = check_assertion(data.get('assertion'), data.get('audience'), server.secret,
+                                     server.accept_emails)
+        except (AttributeError, TypeError, ValueError):
+            return self.respond_failure('assertion and audience must be strings')
+        self.respond(200, json.dumps(result), 'application/json')
+
+    def respond(self, status, body, content_type):
+        body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def respond_failure(self, reason):
+        body = json.dumps({'status': 'failure', 'reason': reason})
+        self.respond(400, body, 'application/json')
+
+    def log_message(self, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, *args)
+
+
+class StandInServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Threaded HTTP server that verifies test assertions at ``/verify``, and
+    mints them at ``/mint``, with keep-alive connections.
+
+    Point ``BROWSERID_VERIFICATION_URLS`` at :attr:`url` to use it.
+    """
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, latency=0.0, port=0, slow_rate=0.0, slow_latency=0.0, error_rate=0.0,
+                 malformed_rate=0.0, host='127.0.0.1', secret=None, accept_emails=True,
+                 verbose=False):
+        """
+        :param latency:
+            Number of seconds to wait before answering each request.
+
+        :param port:
+            Port to listen on. If 0, a free port is chosen.
+
+        :param slow_rate:
+            Share of requests that wait ``slow_latency`` seconds instead, to
+            simulate tail latency.
+
+        :param error_rate:
+            Share of requests answered with a 503 error.
+
+        :param malformed_rate:
+            Share of requests answered with invalid JSON.
+
+        :param secret:
+            Key for signing assertions. If None, a random key is used.
+
+        :param accept_emails:
+            If True, email addresses are accepted as assertions.
+        """
+        BaseHTTPServer.HTTPServer.__init__(self, (host, port), StandInHandler)
+        self.latency = latency
+        self.slow_rate = slow_rate
+        self.slow_latency = slow_latency
+        self.error_rate = error_rate
+        self.malformed_rate = malformed_rate
+        self.secret = secret or _b64encode(os.urandom(16))
+        self.accept_emails = accept_emails
+        self.verbose = verbose
+
+    @property
+    def url(self):
+        """URL of the server's verification endpoint."""
+        return 'http://{0}:{1}/verify'.format(*self.server_address[:2])
+
+    def mint_assertion(self, email, audience=None, ttl=120):
+        """Return a test assertion this server verifies. See :func:`mint_assertion`."""
+        return mint_assertion(email, self.secret, audience=audience, ttl=ttl)
+
+    def start(self):
+        """Serve requests in a background thread."""
+        # Poll for shutdown often, so that stop() returns quickly.
+        thread = threading.Thread(target=self.serve_forever, kwargs={'poll_interval': 0.05})
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
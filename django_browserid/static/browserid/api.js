@@ -2,7 +2,7 @@
  * License, v. 2.0. If a copy of the MPL was not distributed with this
  * file, You can obtain one at http://mozilla.org/MPL/2.0/. */
 
-;(function($, navigator, window_location) {
+;(function($, navigator, window_location, document) {
     'use strict';
 
     // Public API
@@ -34,14 +34,7 @@
          *                           been logged out.
          */
         logout: function logout(next) {
-            var info = this.getInfo();
-            return this.getCsrfToken().then(function(csrfToken) {
-                return $.ajax(info.logoutUrl, {
-                    type: 'POST',
-                    data: {next: next},
-                    headers: {'X-CSRFToken': csrfToken},
-                });
-            });
+            return this._postWithCsrfToken(this.getInfo().logoutUrl, {next: next});
         },
 
         /**
@@ -67,14 +60,8 @@
          *                           response once login is complete.
          */
         verifyAssertion: function verifyAssertion(assertion, next) {
-            var info = this.getInfo();
-            return this.getCsrfToken().then(function(csrfToken) {
-                return $.ajax(info.loginUrl, {
-                    type: 'POST',
-                    data: {assertion: assertion, next: next},
-                    headers: {'X-CSRFToken': csrfToken},
-                });
-            });
+            var data = {assertion: assertion, next: next};
+            return this._postWithCsrfToken(this.getInfo().loginUrl, data);
         },
 
         // Cache for the info fetched by django_browserid.getInfo().
@@ -92,12 +79,105 @@
             return this._info;
         },
 
+        // Cache for the CSRF token returned by django_browserid.getCsrfToken().
+        _csrfToken: null,
+
+        // Whether the CSRF token embedded in the info tag has been used.
+        _usedInfoCsrfToken: false,
+
         /**
-         * Fetch a CSRF token from the backend.
-         * @return {jqXHR} jQuery XmlHttpResponse that returns the token.
+         * Fetch a CSRF token, using the CSRF cookie or the token embedded in
+         * the info tag if available, or else fetching one from the backend.
+         * The token is reused until it is rejected or the user logs in or
+         * out.
+         * @return {jQuery.Deferred} Deferred that resolves with the token.
          */
         getCsrfToken: function getCsrfToken() {
-            return $.get(this.getInfo().csrfUrl);
+            if (!this._csrfToken) {
+                var info = this.getInfo();
+                var csrfToken = info.csrfCookieName ? this._getCookie(info.csrfCookieName) : null;
+                if (!csrfToken && info.csrfToken && !this._usedInfoCsrfToken) {
+                    this._usedInfoCsrfToken = true;
+                    csrfToken = info.csrfToken;
+                }
+
+                if (csrfToken) {
+                    this._csrfToken = $.Deferred().resolve(csrfToken).promise();
+                } else {
+                    this._csrfToken = this._fetchCsrfToken();
+                }
+            }
+
+            return this._csrfToken;
+        },
+
+        /**
+         * Read a cookie.
+         * @param {string} name Name of the cookie.
+         * @return {string} Value of the cookie, or null if it isn't set.
+         */
+        _getCookie: function _getCookie(name) {
+            var cookies = document.cookie ? document.cookie.split('; ') : [];
+            for (var i = 0; i < cookies.length; i++) {
+                var index = cookies[i].indexOf('=');
+                if (decodeURIComponent(cookies[i].substring(0, index)) === name) {
+                    return decodeURIComponent(cookies[i].substring(index + 1));
+                }
+            }
+
+            return null;
+        },
+
+        /**
+         * Fetch a new CSRF token from the backend, replacing the cached one.
+         * @return {jqXHR} jQuery XmlHttpResponse that returns the token.
+         */
+        _fetchCsrfToken: function _fetchCsrfToken() {
+            var self = this;
+            var request = $.get(this.getInfo().csrfUrl);
+            request.fail(function() {
+                if (self._csrfToken === request) {
+                    self._csrfToken = null;
+                }
+            });
+
+            this._csrfToken = request;
+            return request;
+        },
+
+        /**
+         * POST data to the given URL with a CSRF token. If the token is
+         * rejected, fetch a new one and try again once. The token is
+         * forgotten once the request succeeds, as logging in or out changes
+         * it.
+         * @param {string} url URL to POST to.
+         * @param {object} data Data to send.
+         * @return {jqXHR} Deferred that resolves with the response.
+         */
+        _postWithCsrfToken: function _postWithCsrfToken(url, data) {
+            var self = this;
+
+            function post(csrfToken) {
+                return $.ajax(url, {
+                    type: 'POST',
+                    data: data,
+                    headers: {'X-CSRFToken': csrfToken},
+                });
+            }
+
+            return this.getCsrfToken().then(function(csrfToken) {
+                return post(csrfToken).then(null, function(jqXHR) {
+                    // Login failures are 403s too, but come with a JSON body.
+                    var contentType = jqXHR.getResponseHeader('Content-Type') || '';
+                    if (jqXHR.status !== 403 || contentType.indexOf('json') !== -1) {
+                        return $.Deferred().rejectWith(this, arguments);
+                    }
+
+                    return self._fetchCsrfToken().then(post);
+                });
+            }).done(function() {
+                self._csrfToken = null;
+            });
         },
 
         // Deferred for post-watch-callback actions.
@@ -126,4 +206,4 @@
     };
 
     window.django_browserid = django_browserid;
-})(window.jQuery, window.navigator, window.location);
+})(window.jQuery, window.navigator, window.location, window.document);
@@ -0,0 +1,253 @@
+/* This Source Code Form is subject to the terms of the Mozilla Public
+ * License, v. 2.0. If a copy of the MPL was not distributed with this
+ * file, You can obtain one at http://mozilla.org/MPL/2.0/. */
+
+;(function($, navigator, window_location, document) {
+    'use strict';
+
+    // Public API
+    var django_browserid = {
+        /**
+         * Retrieve an assertion and use it to log the user into your site.
+         * @param {object} requestArgs Options to pass to navigator.id.request.
+         * @param {string} next URL to redirect the user to if login is
+         *                      successful.
+         * @return {jQuery.Deferred} Deferred that resolves once the user has
+         *                           been logged in.
+         */
+        login: function login(requestArgs, next) {
+            if (typeof requestArgs === 'string') {
+                next = requestArgs;
+                requestArgs = undefined;
+            }
+
+            return django_browserid.getAssertion(requestArgs).then(function(assertion) {
+                return django_browserid.verifyAssertion(assertion, next);
+            });
+        },
+
+        /**
+         * Log the user out of your site.
+         * @param {string} next URL to redirect the user to if logout is
+         *                      successful.
+         * @return {jQuery.Deferred} Deferred that resolves once the user has
+         *                           been logged out.
+         */
+        logout: function logout(next) {
+            return this._postWithCsrfToken(this.getInfo().logoutUrl, {next: next});
+        },
+
+        /**
+         * Retrieve an assertion via BrowserID.
+         * @param {object} requestArgs Options to pass to navigator.id.request.
+         * @return {jQuery.Deferred} Deferred that resolves with the assertion
+         *                           once it is retrieved.
+         */
+        getAssertion: function getAssertion(requestArgs) {
+            requestArgs = $.extend({}, this.getInfo().requestArgs, requestArgs);
+
+            this._requestDeferred = $.Deferred();
+            navigator.id.request(requestArgs);
+            return this._requestDeferred;
+        },
+
+        /**
+         * Verify that the given assertion is valid, and log the user in.
+         * @param {string} assertion Assertion to verify.
+         * @param {string} next URL to redirect the user to if the assertion is
+         *                      valid.
+         * @return {jQuery.Deferred} Deferred that resolves with the login view
+         *                           response once login is complete.
+         */
+        verifyAssertion: function verifyAssertion(assertion, next) {
+            var data = {assertion: assertion, next: next};
+            return this._postWithCsrfToken(this.getInfo().loginUrl, data);
+        },
+
+        // Cache for the info fetched by django_browserid.getInfo().
+        _info: null,
+
+        /**
+         * Fetch the info for the Persona popup and login requests.
+         * @return {object} Data encoded in the browserid-info tag.
+         */
+        getInfo: function getInfo() {
+            if (!this._info) {
+                this._info = $('#browserid-info').data('info');
+            }
+
+            return this._info;
+        },
+
+        // Cache for the CSRF token returned by django_browserid.getCsrfToken().
+        _csrfToken: null,
+
+        // Whether the CSRF token embedded in the info tag has been used.
+        _usedInfoCsrfToken: false,
+
+        /**
+         * Fetch a CSRF token, using the CSRF cookie or the token embedded in
+         * the info tag if available, or else fetching one from the backend.
+         * The token is reused until it is rejected or the user logs in or
+         * out.
+         * @return {jQuery.Deferred} Deferred that resolves with the token.
+         */
+        getCsrfToken: function getCsrfToken() {
+            if (!this._csrfToken) {
+                var info = this.getInfo();
+                var csrfToken = info.csrfCookieName ? this._getCookie(info.csrfCookieName) : null;
+                if (!csrfToken && info.csrfToken && !this._usedInfoCsrfToken) {
+                    this._usedInfoCsrfToken = true;
+                    csrfToken = info.csrfToken;
+                }
+
+                if (csrfToken) {
+                    this._csrfToken = $.Deferred().resolve(csrfToken).promise();
+                } else {
+                    this._csrfToken = this._fetchCsrfToken();
+                }
+            }
+
+            return this._csrfToken;
+        },
+
+        /**
+         * Read a cookie.
+         * @param {string} name Name of the cookie.
+         * @return {string} Value of the cookie, or null if it isn't set.
+         */
+        _getCookie: function _getCookie(name) {
+            var cookies = document.cookie ? document.cookie.split('; ') : [];
+            for (var i = 0; i < cookies.length; i++) {
+                var index = cookies[i].indexOf('=');
+                if (decodeURIComponent(cookies[i].substring(0, index)) === name) {
+                    return decodeURIComponent(cookies[i].substring(index + 1));
+                }
+            }
+
+            return null;
+        },
+
+        /**
+         * Fetch a new CSRF token from the backend, replacing the cached one.
+         * @return {jqXHR} jQuery XmlHttpResponse that returns the token.
+         */
+        _fetchCsrfToken: function _fetchCsrfToken() {
+            var self = this;
+            var request = $.get(this.getInfo().csrfUrl);
+            request.fail(function() {
+                if (self._csrfToken === request) {
+                    self._csrfToken = null;
+                }
+            });
+
+            this._csrfToken = request;
+            return request;
+        },
+
+        /**
+         * POST data to the given URL with a CSRF token. If the token is
+         * rejected, fetch a new one and try again once. The token is
+         * forgotten once the request succeeds, as logging in or out changes
+         * it.
+         * @param {string} url URL to POST to.
+         * @param {object} data Data to send.
+         * @return {jqXHR} Deferred that resolves with the response.
+         */
+        _postWithCsrfToken: function _postWithCsrfToken(url, data) {
+            var self = this;
+
+            function post(csrfToken) {
+                return $.ajax(url, {
+                    type: 'POST',
+                    data: data,
+                    headers: {'X-CSRFToken': csrfToken},
+                });
+            }
+
+            return this.getCsrfToken().then(function(csrfToken) {
+                return post(csrfToken).then(null, function(jqXHR) {
+                    // Login failures are 403s too, but come with a JSON body.
+                    var contentType = jqXHR.getResponseHeader('Content-Type') || '';
+                    if (jqXHR.status !== 403 || contentType.indexOf('json') !== -1) {
+                        return $.Deferred().rejectWith(this, arguments);
+                    }
+
+                    return self._fetchCsrfToken().then(post);
+                });
+            }).done(function() {
+                self._csrfToken = null;
+            });
+        },
+
+        // Deferred for post-watch-callback actions.
+        // Stored on the public API so tests can reset it.
+        _requestDeferred: null,
+
+        /**
+         * Register callbacks with navigator.id.watch that make the API work.
+         * This must be called before calling any other API methods.
+         * @param {function} Function to run once the user agent is ready to
+         *                   process login requests.
+         */
+        registerWatchHandlers: function registerWatchHandlers(onReady) {
+            var assertion = null;
+            var self = this;
+
+            navigator.id.watch({
+                onlogin: function(assertion) {
+                    if (self._requestDeferred) {
+                        self._requestDeferred.resolve(assertion);
+                    }
+                },
+                onready: onReady,
+            });
+        }
+    };
+
+    window.django_browserid = django_browserid;
+})(window.jQuery, window.navigator, window.location, window.document);
+/* This Source Code Form is subject to the terms of the Mozilla Public
+ * License, v. 2.0. If a copy of the MPL was not distributed with this
+ * file, You can obtain one at http://mozilla.org/MPL/2.0/. */
+
+;(function($, window) {
+    'use strict';
+
+    $(function() {
+        django_browserid.registerWatchHandlers();
+
+        // Trigger login whenever a login link is clicked, and redirect the user
+        // once it succeeds.
+        $(document).on('click', '.browserid-login', function(e) {
+            e.preventDefault();
+            var $link = $(this);
+            django_browserid.login($link.data('next')).then(function(verifyResult) {
+                window.location = verifyResult.redirect;
+            }, function(jqXHR) {
+                try {
+                    var response = JSON.parse(jqXHR.responseText);
+                    if (response.redirect) {
+                        window.location = response.redirect;
+                    } else {
+                        console.error('Unable to redirect after login failure: No redirect provided.');
+                    }
+                } catch(err) {
+                    console.error('Unable to redirect after login failure: %o', err);
+                }
+            });
+        });
+
+        // Trigger logout whenever a logout link is clicked, and redirect the
+        // user once it succeeds.
+        $(document).on('click', '.browserid-logout', function(e) {
+            e.preventDefault();
+            var $link = $(this);
+            django_browserid.logout($link.data('next')).then(function(logoutResult) {
+                window.location = logoutResult.redirect;
+            }, function(jqXHR) {
+                console.error('Unable to redirect after logout failure: No redirect provided.');
+            });
+        });
+    });
+})(jQuery, window);
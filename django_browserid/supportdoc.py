@@ -0,0 +1,222 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+Caching of BrowserID support documents for local verification. Requires
+PyBrowserID.
+"""
+import json
+import logging
+import os
+import re
+import threading
+import time
+from email.utils import mktime_tz, parsedate_tz
+
+from django.conf import settings
+from django.core.signals import setting_changed
+
+import requests
+from browserid.errors import ConnectionError, InvalidIssuerError
+from browserid.supportdoc import SupportDocumentManager, WELL_KNOWN_URL
+
+from django_browserid.base import get_session
+from django_browserid.util import LRUCache
+
+
+logger = logging.getLogger(__name__)
+
+MAX_AGE_RE = re.compile(r'max-age\s*=\s*(\d+)')
+
+
+def get_cache_ttl(response, max_ttl):
+    """
+    Determine how many seconds a response may be cached for from its
+    Cache-Control and Expires headers, capped at max_ttl. Responses without
+    caching headers are cached for max_ttl seconds.
+    """
+    cache_control = response.headers.get('Cache-Control', '').lower()
+    if 'no-store' in cache_control or 'no-cache' in cache_control:
+        return 0
+
+    match = MAX_AGE_RE.search(cache_control)
+    if match:
+        return min(int(match.group(1)), max_ttl)
+
+    expires = parsedate_tz(response.headers.get('Expires', ''))
+    if expires:
+        date = parsedate_tz(response.headers.get('Date', ''))
+        now = mktime_tz(date) if date else time.time()
+        return max(0, min(mktime_tz(expires) - now, max_ttl))
+
+    return max_ttl
+
+
+class CachingSupportDocumentManager(SupportDocumentManager):
+    """
+    Fetches BrowserID support documents and caches them according to the
+    caching headers sent by the issuer.
+
+    Once a cached document expires, it is still returned for up to
+    ``stale_ttl`` seconds while a fresh copy is fetched in a background
+    thread, so verification doesn't wait on a key that was valid a moment
+    ago. Documents the issuer forbids caching, with ``no-cache``,
+    ``no-store``, ``max-age=0`` or an Expires date in the past, are neither
+    cached nor served stale. Errors are cached for ``error_ttl`` seconds to
+    avoid flooding broken hosts.
+    """
+    error_ttl = 60
+
+    def __init__(self, max_ttl=3600, stale_ttl=300, max_size=1000, verify=None):
+        """
+        :param max_ttl:
+            Maximum number of seconds to treat a document as fresh.
+
+        :param stale_ttl:
+            Number of seconds after expiring that a document may still be
+            used while it is refreshed.
+
+        :param max_size:
+            Maximum number of hosts to cache documents for.
+
+        :param verify:
+            Passed to requests to control TLS certificate verification.
+        """
+        super(CachingSupportDocumentManager, self).__init__(cache=LRUCache(max_size),
+                                                            verify=verify)
+        self.max_ttl = max_ttl
+        self.stale_ttl = stale_ttl
+        self._refreshing = set()
+        self._refreshing_lock = threading.Lock()
+
+    def get_support_document(self, hostname):
+        """Get the BrowserID support document for the given hostname."""
+        entry = self.cache.get(hostname)
+        if entry is None:
+            entry = self._update(hostname)
+        else:
+            fresh_until, error, supportdoc = entry
+            if fresh_until <= time.time():
+                if error is None:
+                    self._refresh_in_background(hostname)
+                else:
+                    entry = self._update(hostname)
+
+        fresh_until, error, supportdoc = entry
+        if error is not None:
+            raise error
+        return supportdoc
+
+    def _update(self, hostname):
+        """Fetch the document for hostname and store it in the cache."""
+        try:
+            supportdoc, ttl = self.fetch_support_document(hostname)
+            entry = (time.time() + ttl, None, supportdoc)
+            timeout = ttl + self.stale_ttl if ttl > 0 else 0
+        except Exception as err:
+            entry = (time.time() + self.error_ttl, err, None)
+            timeout = self.error_ttl
+
+        if timeout > 0:
+            self.cache.set(hostname, entry, timeout)
+        return entry
+
+    def _refresh_in_background(self, hostname):
+        with self._refreshing_lock:
+            if hostname in self._refreshing:
+                return
+            self._refreshing.add(hostname)
+
+        thread = threading.Thread(target=self._refresh, args=(hostname,))
+        thread.daemon = True
+        thread.start()
+
+    def _refresh(self, hostname):
+        try:
+            supportdoc, ttl = self.fetch_support_document(hostname)
+            if ttl > 0:
+                self.cache.set(hostname, (time.time() + ttl, None, supportdoc),
+                               ttl + self.stale_ttl)
+            else:
+                # The issuer no longer allows caching; stop serving the
+                # stale copy.
+                self.cache.delete(hostname)
+        except Exception as err:
+            # Keep serving the stale document until it runs out; the next
+            # request after that will retry synchronously.
+            logger.warning('Could not refresh BrowserID support document for %s: %s',
+                           hostname, err)
+        finally:
+            with self._refreshing_lock:
+                self._refreshing.discard(hostname)
+
+    def _get(self, url):
+        kwargs = {'timeout': 5}
+        if self.verify is not None:
+            kwargs['verify'] = self.verify
+
+        try:
+            return get_session().get(url, **kwargs)
+        except requests.exceptions.RequestException as err:
+            raise ConnectionError('Failed to GET {0}. Reason: {1}'.format(url, err))
+
+    def fetch_support_document(self, hostname):
+        """
+        Fetch the BrowserID support document for the given hostname, falling
+        back to the legacy ``/pk`` document.
+
+        :returns:
+            A tuple of the parsed document and the number of seconds it may be
+            cached for.
+        """
+        response = self._get('https://{0}{1}'.format(hostname, WELL_KNOWN_URL))
+        if response.status_code == 200:
+            try:
+                supportdoc = json.loads(response.text)
+            except ValueError:
+                raise InvalidIssuerError('Host {0!r} has malformed BrowserID support document'
+                                         .format(hostname))
+        else:
+            response = self._get('https://{0}/pk'.format(hostname))
+            if response.status_code != 200:
+                raise InvalidIssuerError('Host {0!r} does not declare support for BrowserID'
+                                         .format(hostname))
+            try:
+                supportdoc = {'public-key': json.loads(response.text)}
+            except ValueError:
+                raise InvalidIssuerError('Host {0!r} has malformed BrowserID metadata document'
+                                         .format(hostname))
+
+        return supportdoc, get_cache_ttl(response, self.max_ttl)
+
+
+_manager = None
+_manager_pid = None
+_manager_lock = threading.Lock()
+
+
+def get_support_document_manager():
+    """
+    Return the process-wide :class:`CachingSupportDocumentManager`,
+    configured by the BROWSERID_SUPPORT_DOCUMENT_* settings.
+    """
+    global _manager, _manager_pid
+
+    pid = os.getpid()
+    if _manager is None or _manager_pid != pid:
+        with _manager_lock:
+            if _manager is None or _manager_pid != pid:
+                _manager = CachingSupportDocumentManager(
+                    max_ttl=getattr(settings, 'BROWSERID_SUPPORT_DOCUMENT_MAX_TTL', 3600),
+                    stale_ttl=getattr(settings, 'BROWSERID_SUPPORT_DOCUMENT_STALE_TTL', 300),
+                    max_size=getattr(settings, 'BROWSERID_SUPPORT_DOCUMENT_CACHE_SIZE', 1000),
+                )
+                _manager_pid = pid
+    return _manager
+
+
+def _reset_manager(setting, **kwargs):
+    global _manager
+    if setting.startswith('BROWSERID_SUPPORT_DOCUMENT_'):
+        _manager = None
+setting_changed.connect(_reset_manager)
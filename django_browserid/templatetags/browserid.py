@@ -6,8 +6,9 @@ from django_browserid import helpers
 register = template.Library()
 
 
-@register.simple_tag
-def browserid_info(**kwargs):
+@register.simple_tag(takes_context=True)
+def browserid_info(context, **kwargs):
+    kwargs.setdefault('request', context.get('request'))
     return helpers.browserid_info(**kwargs)
 
 
@@ -60,6 +60,19 @@ class mock_browserid(object):
         return inner
 
 
+def patch_supportdoc_fetching():
+    """
+    Patch support document fetching for local verification to use the dummy
+    keys generated by PyBrowserID's test support, so assertions made with
+    ``browserid.tests.support.make_assertion`` can be verified offline.
+    """
+    from browserid.tests.support import fetch_support_document
+    from django_browserid.supportdoc import CachingSupportDocumentManager
+
+    return patch.object(CachingSupportDocumentManager, 'fetch_support_document',
+                        side_effect=lambda hostname: (fetch_support_document(hostname), 3600))
+
+
 class TestCase(DjangoTestCase):
     def assert_json_equals(self, json_str, value):
         return self.assertEqual(json.loads(smart_text(json_str)), value)
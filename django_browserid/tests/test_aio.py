@@ -0,0 +1,386 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+import json
+import threading
+
+from django.contrib.auth.models import User
+from django.test import TransactionTestCase
+from django.test.client import RequestFactory
+from django.utils.six.moves import BaseHTTPServer
+
+from mock import Mock, patch
+
+from django_browserid.auth import BrowserIDBackend
+from django_browserid.base import BrowserIDException, MockVerifier, VerificationResult
+from django_browserid.circuit import CircuitBreaker, CircuitOpenError
+from django_browserid.compat import aiohttp_found, async_supported
+from django_browserid.tests import TestCase
+from django_browserid.tests.test_auth import DummyVerifier
+from django_browserid.tests.test_timing import collector
+from django_browserid.util import LRUCache
+
+if async_supported:
+    import asyncio
+    from django_browserid import aio
+
+
+class VerifierHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_POST(self):
+        length = int(self.headers['Content-Length'])
+        self.server.requests.append(self.rfile.read(length).decode('utf-8'))
+
+        body = self.server.response_body.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class AsyncTestMixin(object):
+    def setUp(self):
+        super(AsyncTestMixin, self).setUp()
+        if not async_supported:
+            self.skipTest('Python 3.5 or above required for test.')
+
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.addCleanup(self.loop.close)
+
+    def run_async(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+
+class CallHedgedTests(AsyncTestMixin, TestCase):
+    def test_cancel_losers(self):
+        """
+        Once an endpoint answers, requests to the others should be cancelled
+        and not recorded.
+        """
+        slow, fast = Mock(url='slow'), Mock(url='fast')
+        endpoint_set = Mock(max_requests=2)
+        endpoint_set.choose.return_value = [slow, fast]
+        endpoint_set.hedge_delay.return_value = 0.01
+        cancelled = []
+
+        async def post(url):
+            if url == 'fast':
+                return 'answer', False
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.append(url)
+                raise
+
+        answer = self.run_async(aio.call_hedged(endpoint_set, post))
+        self.assertEqual(answer, ('answer', False))
+        self.assertEqual(cancelled, ['slow'])
+        self.assertEqual([args[0][0] for args in endpoint_set.record.call_args_list], [fast])
+        self.assertEqual(asyncio.Task.all_tasks(self.loop), set())
+
+
+class AsyncCachedVerifierTests(AsyncTestMixin, TestCase):
+    def test_verify(self):
+        """Repeated assertions should only be verified once."""
+        class Verifier(object):
+            calls = 0
+
+            async def verify(self, assertion, audience, **kwargs):
+                self.calls += 1
+                return VerificationResult({'status': 'failure'})
+
+        verifier = Verifier()
+        cached_verifier = aio.AsyncCachedVerifier(verifier, cache=LRUCache(10))
+        for i in range(2):
+            result = self.run_async(cached_verifier.verify('asdf', 'http://testserver'))
+            self.assertEqual(result.status, 'failure')
+        self.assertEqual(verifier.calls, 1)
+
+        self.run_async(cached_verifier.verify('asdf', 'http://testserver', foo='bar'))
+        self.assertEqual(verifier.calls, 2)
+
+
+class AsyncRemoteVerifierTests(AsyncTestMixin, TestCase):
+    def setUp(self):
+        super(AsyncRemoteVerifierTests, self).setUp()
+        if not aiohttp_found:
+            self.skipTest('aiohttp required for test but not installed.')
+
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), VerifierHandler)
+        self.server.requests = []
+        self.server.response_body = '{"status": "okay", "email": "foo@example.com"}'
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+        self.verifier = aio.AsyncRemoteVerifier()
+        self.verifier.verification_service_url = 'http://127.0.0.1:{0}/verify'.format(
+            self.server.server_address[1])
+        self.addCleanup(lambda: self.run_async(self.verifier.close()))
+
+    def test_verify_success(self):
+        """
+        If the response contains valid JSON, return a result object for
+        that response.
+        """
+        result = self.run_async(self.verifier.verify('asdf', 'http://testserver', foo='bar'))
+        self.assertTrue(result)
+        self.assertEqual(result.email, 'foo@example.com')
+        self.assertTrue('assertion=asdf' in self.server.requests[0])
+        self.assertTrue('foo=bar' in self.server.requests[0])
+
+    def test_verify_invalid_json(self):
+        """
+        If the response contains invalid JSON, return a failure result.
+        """
+        self.server.response_body = '{asg9=3{{{}}{'
+        result = self.run_async(self.verifier.verify('asdf', 'http://testserver'))
+        self.assertTrue(not result)
+        self.assertTrue(result.reason.startswith('Could not parse verifier response'))
+
+    def test_verify_connection_error(self):
+        """
+        If the verification service can't be reached, raise a
+        BrowserIDException.
+        """
+        self.verifier.verification_service_url = 'http://127.0.0.1:1/verify'
+        with self.assertRaises(BrowserIDException):
+            self.run_async(self.verifier.verify('asdf', 'http://testserver'))
+
+    def test_verify_circuit_breaker(self):
+        """
+        Requests should be recorded with the circuit breaker, and rejected
+        without contacting the service while it is open.
+        """
+        breaker = CircuitBreaker(min_calls=1)
+        with patch.object(aio.AsyncRemoteVerifier, 'circuit_breaker', breaker):
+            self.run_async(self.verifier.verify('asdf', 'http://testserver'))
+            self.assertEqual(breaker.stats()['calls'], 1)
+
+            self.verifier.verification_service_url = 'http://127.0.0.1:1/verify'
+            with self.assertRaises(BrowserIDException):
+                self.run_async(self.verifier.verify('asdf', 'http://testserver'))
+            self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+
+            with self.assertRaises(BrowserIDException) as cm:
+                self.run_async(self.verifier.verify('asdf', 'http://testserver'))
+            self.assertTrue(isinstance(cm.exception.exc, CircuitOpenError))
+
+            breaker.fallback = MockVerifier('a@example.com')
+            result = self.run_async(self.verifier.verify('asdf', 'http://testserver'))
+            self.assertEqual(result.email, 'a@example.com')
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_verify_many(self):
+        """
+        verify_many should be awaited, limit concurrency and return
+        results and errors in order.
+        """
+        active = []
+        most_active = []
+        verify = self.verifier.verify
+
+        async def counting_verify(assertion, audience, **kwargs):
+            active.append(assertion)
+            most_active.append(len(active))
+            try:
+                if assertion == 'error':
+                    raise BrowserIDException(Exception())
+                return await verify(assertion, audience, **kwargs)
+            finally:
+                active.remove(assertion)
+
+        self.verifier.verify = counting_verify
+        results = self.run_async(self.verifier.verify_many(
+            ['a', 'error', 'b', 'c'], 'http://testserver', concurrency=2))
+        self.assertEqual(results[0].email, 'foo@example.com')
+        self.assertTrue(isinstance(results[1], BrowserIDException))
+        self.assertEqual(results[3].email, 'foo@example.com')
+        self.assertEqual(max(most_active), 2)
+        self.assertEqual(len(self.server.requests), 3)
+        self.assertEqual(self.run_async(self.verifier.verify_many([], 'http://testserver')), [])
+
+    def test_verification_urls(self):
+        """Requests should fail over between BROWSERID_VERIFICATION_URLS."""
+        urls = ['http://127.0.0.1:1/verify', self.verifier.verification_service_url]
+        with self.settings(BROWSERID_VERIFICATION_URLS=urls, BROWSERID_HEDGE_DELAY=5):
+            result = self.run_async(self.verifier.verify('asdf', 'http://testserver'))
+        self.assertEqual(result.email, 'foo@example.com')
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_verification_urls_all_fail(self):
+        urls = ['http://127.0.0.1:1/verify', 'http://127.0.0.1:2/verify']
+        with self.settings(BROWSERID_VERIFICATION_URLS=urls):
+            with self.assertRaises(BrowserIDException):
+                self.run_async(self.verifier.verify('asdf', 'http://testserver'))
+
+    def test_ssl_context(self):
+        """The verify and cert requests parameters should be passed to aiohttp."""
+        self.assertEqual(self.verifier.get_ssl_context(), None)
+        with patch.object(self.verifier, 'requests_parameters', {'verify': False}):
+            self.assertEqual(self.verifier.get_ssl_context(), False)
+        with patch('django_browserid.aio.ssl.create_default_context') as create_default_context:
+            with patch.object(self.verifier, 'requests_parameters',
+                              {'verify': '/etc/ca.pem', 'cert': ('/c.pem', '/k.pem')}):
+                context = self.verifier.get_ssl_context()
+        create_default_context.assert_called_with(cafile='/etc/ca.pem')
+        context.load_cert_chain.assert_called_with('/c.pem', '/k.pem')
+
+    def test_client_session_per_loop(self):
+        """Each event loop should reuse a single client session."""
+        client_session = self.verifier.get_client_session()
+        self.assertTrue(self.verifier.get_client_session() is client_session)
+
+        other_loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(other_loop)
+        try:
+            self.assertTrue(self.verifier.get_client_session() is not client_session)
+            other_loop.run_until_complete(self.verifier.close())
+        finally:
+            asyncio.set_event_loop(self.loop)
+            other_loop.close()
+
+
+class AsyncBackendTests(AsyncTestMixin, TransactionTestCase):
+    def setUp(self):
+        super(AsyncBackendTests, self).setUp()
+        self.backend = BrowserIDBackend()
+
+    @patch('django_browserid.aio.aiohttp_found', True)
+    def test_get_async_verifier(self):
+        """
+        get_async_verifier should return a shared AsyncRemoteVerifier, unless
+        BROWSERID_VERIFIER_CLASS is set or the backend sets verifier_class.
+        """
+        verifier = self.backend.get_async_verifier()
+        self.assertTrue(isinstance(verifier, aio.AsyncRemoteVerifier))
+        self.assertTrue(BrowserIDBackend().get_async_verifier() is verifier)
+
+        dummy_path = 'django_browserid.tests.test_auth.DummyVerifier'
+        with self.settings(BROWSERID_VERIFIER_CLASS=dummy_path):
+            self.assertTrue(isinstance(self.backend.get_async_verifier(), MockVerifier))
+
+        backend = BrowserIDBackend()
+        backend.verifier_class = DummyVerifier
+        self.assertTrue(isinstance(backend.get_async_verifier(), DummyVerifier))
+
+    @patch('django_browserid.aio.aiohttp_found', True)
+    def test_get_async_verifier_cache(self):
+        """
+        If BROWSERID_VERIFICATION_CACHE is True, the shared verifier should be
+        wrapped in an AsyncCachedVerifier.
+        """
+        with self.settings(BROWSERID_VERIFICATION_CACHE=True):
+            verifier = self.backend.get_async_verifier()
+            self.assertTrue(isinstance(verifier, aio.AsyncCachedVerifier))
+            self.assertTrue(isinstance(verifier.verifier, aio.AsyncRemoteVerifier))
+
+    def test_averify_sync_verifier(self):
+        """Verifiers with a synchronous verify should run in an executor."""
+        with patch.object(self.backend, 'get_async_verifier',
+                          return_value=MockVerifier('a@example.com')):
+            email = self.run_async(self.backend.averify('asdf', 'http://testserver'))
+        self.assertEqual(email, 'a@example.com')
+
+    def test_averify_error(self):
+        """If the verifier raises an exception, return None."""
+        verifier = MockVerifier('a@example.com')
+        with patch.object(verifier, 'verify', side_effect=BrowserIDException(Exception())):
+            with patch.object(self.backend, 'get_async_verifier', return_value=verifier):
+                email = self.run_async(self.backend.averify('asdf', 'http://testserver'))
+        self.assertEqual(email, None)
+
+    def test_aauthenticate(self):
+        """
+        aauthenticate should return the user matching the verified email,
+        creating them if needed.
+        """
+        with patch.object(self.backend, 'get_async_verifier',
+                          return_value=MockVerifier('a@example.com')):
+            user = self.run_async(self.backend.aauthenticate('asdf', 'http://testserver'))
+            self.assertEqual(user.email, 'a@example.com')
+            user_again = self.run_async(self.backend.aauthenticate('asdf', 'http://testserver'))
+            self.assertEqual(user_again, user)
+
+    def test_aauthenticate_failure(self):
+        with patch.object(self.backend, 'get_async_verifier', return_value=MockVerifier(None)):
+            user = self.run_async(self.backend.aauthenticate('asdf', 'http://testserver'))
+        self.assertEqual(user, None)
+
+    def test_auth_aauthenticate(self):
+        """
+        aio.aauthenticate should use backends with an aauthenticate method
+        and annotate the user with the backend path.
+        """
+        verifier = MockVerifier('a@example.com')
+        with patch.object(BrowserIDBackend, 'get_async_verifier', return_value=verifier):
+            user = self.run_async(aio.aauthenticate(assertion='asdf', audience='asdf'))
+        self.assertEqual(user.email, 'a@example.com')
+        self.assertEqual(user.backend, 'django_browserid.auth.BrowserIDBackend')
+
+
+class AsyncVerifyTests(AsyncTestMixin, TransactionTestCase):
+    def setUp(self):
+        super(AsyncVerifyTests, self).setUp()
+        self.factory = RequestFactory()
+
+    def verify(self, **kwargs):
+        request = self.factory.post('/browserid/verify', kwargs)
+        with patch('django_browserid.views.auth.login') as login:
+            response = self.run_async(aio.AsyncVerify.as_view()(request))
+        return response, login
+
+    def test_no_assertion(self):
+        """If no assertion is given, return a failure result."""
+        with self.settings(LOGIN_REDIRECT_URL_FAILURE='/fail'):
+            response, login = self.verify(blah='asdf')
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(json.loads(response.content.decode('utf-8')), {'redirect': '/fail'})
+
+    def test_method_not_allowed(self):
+        """Requests with other methods than POST should get an awaitable 405."""
+        request = self.factory.get('/browserid/verify')
+        response = self.run_async(aio.AsyncVerify.as_view()(request))
+        self.assertEqual(response.status_code, 405)
+        self.assertTrue('POST' in response['Allow'])
+
+    def test_auth_fail(self):
+        """If authentication fails, return a failure result."""
+        with patch.object(BrowserIDBackend, 'get_async_verifier', return_value=MockVerifier(None)):
+            response, login = self.verify(assertion='asdf')
+        self.assertEqual(response.status_code, 403)
+        self.assertTrue(not login.called)
+
+    def test_auth_success(self):
+        """If authentication succeeds, log the user in."""
+        user = User.objects.create_user('asdf', 'test@example.com')
+        verifier = MockVerifier('test@example.com')
+        with patch.object(BrowserIDBackend, 'get_async_verifier', return_value=verifier):
+            with self.settings(LOGIN_REDIRECT_URL='/success'):
+                response, login = self.verify(assertion='asdf')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content.decode('utf-8')),
+                         {'email': 'test@example.com', 'redirect': '/success'})
+        self.assertEqual(login.call_args[0][1], user)
+
+    def test_timing(self):
+        """Logins should be timed like with the synchronous view."""
+        collector.clear()
+        User.objects.create_user('asdf', 'test@example.com')
+        verifier = MockVerifier('test@example.com')
+        with patch.object(BrowserIDBackend, 'get_async_verifier', return_value=verifier):
+            hook = 'django_browserid.tests.test_timing.collector'
+            with self.settings(BROWSERID_TIMING_HOOK=hook, BROWSERID_AUDIENCES=['http://testserver']):
+                self.verify(assertion='asdf')
+
+        trace, = collector.traces
+        self.assertEqual(trace.outcome, 'success')
+        self.assertEqual([phase.name for phase in trace.phases],
+                         ['get_audience', 'verify', 'replay_check', 'get_users', 'authenticate',
+                          'login'])
@@ -1,15 +1,28 @@
 # This Source Code Form is subject to the terms of the Mozilla Public
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
+import os
+import threading
+
 from django.conf import settings
 from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import request_finished, request_started
 from django.db import IntegrityError
+from django.db.models.signals import post_save
+from django.test.utils import override_settings
 
 from mock import ANY, Mock, patch
 
-from django_browserid.auth import AutoLoginBackend, BrowserIDBackend, default_username_algo
-from django_browserid.base import MockVerifier
+from django_browserid import auth
+from django_browserid.auth import (AutoLoginBackend, BrowserIDBackend, default_username_algo,
+                                   LocalBrowserIDBackend)
+from django_browserid.base import CachedVerifier, LocalVerifier, MockVerifier, RemoteVerifier
+from django_browserid.compat import pybrowserid_found
+from django_browserid.signals import user_created
 from django_browserid.tests import mock_browserid, TestCase
+from django_browserid.util import LRUCache
 
 try:
     from django.contrib.auth import get_user_model
@@ -25,6 +38,12 @@ def new_user(email, username=None):
         return User.objects.create_user(username, email)
 
 
+class DummyVerifier(MockVerifier):
+    """Verifier that can be named by BROWSERID_VERIFIER_CLASS in tests."""
+    def __init__(self):
+        super(DummyVerifier, self).__init__('a@example.com')
+
+
 class BrowserIDBackendTests(TestCase):
     def setUp(self):
         self.backend = BrowserIDBackend()
@@ -46,6 +65,22 @@ class BrowserIDBackendTests(TestCase):
         self.assertEqual(self.backend.verify('asdf', 'qwer'), 'bob@example.com')
         self.verifier.verify.assert_called_with('asdf', 'qwer')
 
+    def test_verify_replay(self):
+        """
+        If replay protection is enabled, an assertion should only be
+        accepted once per audience.
+        """
+        self.verifier.verify.return_value = Mock(email='bob@example.com', _response={})
+        with self.settings(BROWSERID_REPLAY_PROTECTION=True):
+            self.assertEqual(self.backend.verify('asdf', 'qwer'), 'bob@example.com')
+            with patch('django_browserid.auth.logger'):
+                self.assertEqual(self.backend.verify('asdf', 'qwer'), None)
+            self.assertEqual(self.backend.verify('asdf', 'other'), 'bob@example.com')
+
+        # Without replay protection, assertions are accepted every time.
+        self.assertEqual(self.backend.verify('asdf', 'qwer'), 'bob@example.com')
+        self.assertEqual(self.backend.verify('asdf', 'qwer'), 'bob@example.com')
+
     def test_verify_no_audience_request(self):
         """
         If no audience is provided but a request is, retrieve the
@@ -68,6 +103,51 @@ class BrowserIDBackendTests(TestCase):
             get_audience.return_value = None
             self.assertEqual(self.backend.verify('asdf', request=Mock()), None)
 
+    def test_get_verifier(self):
+        """
+        get_verifier should return a RemoteVerifier shared between backend
+        instances.
+        """
+        verifier = BrowserIDBackend().get_verifier()
+        self.assertTrue(isinstance(verifier, RemoteVerifier))
+        self.assertTrue(BrowserIDBackend().get_verifier() is verifier)
+
+    def test_get_verifier_cache(self):
+        """
+        If BROWSERID_VERIFICATION_CACHE is True, the shared verifier should be
+        wrapped in a CachedVerifier.
+        """
+        with self.settings(BROWSERID_VERIFICATION_CACHE=True):
+            cached_verifier = BrowserIDBackend().get_verifier()
+            self.assertTrue(isinstance(cached_verifier, CachedVerifier))
+            self.assertTrue(BrowserIDBackend().get_verifier() is cached_verifier)
+        self.assertTrue(isinstance(cached_verifier.verifier, RemoteVerifier))
+
+    def test_get_verifier_setting(self):
+        """
+        If BROWSERID_VERIFIER_CLASS is set, get_verifier should use the class
+        it names, unless the backend sets its own verifier_class.
+        """
+        dummy_path = 'django_browserid.tests.test_auth.DummyVerifier'
+        with self.settings(BROWSERID_VERIFIER_CLASS=dummy_path):
+            self.assertTrue(isinstance(BrowserIDBackend().get_verifier(), DummyVerifier))
+
+        with self.settings(BROWSERID_VERIFIER_CLASS='django_browserid.base.Nope'):
+            with self.assertRaises(ImproperlyConfigured):
+                BrowserIDBackend().get_verifier()
+
+    def test_get_verifier_setting_local(self):
+        """
+        LocalBrowserIDBackend should ignore BROWSERID_VERIFIER_CLASS in favor
+        of its own verifier_class.
+        """
+        if not pybrowserid_found:
+            self.skipTest('PyBrowserID required for test but not installed.')
+
+        dummy_path = 'django_browserid.tests.test_auth.DummyVerifier'
+        with self.settings(BROWSERID_VERIFIER_CLASS=dummy_path):
+            self.assertTrue(isinstance(LocalBrowserIDBackend().get_verifier(), LocalVerifier))
+
     def test_verify_kwargs(self):
         """Any extra kwargs should be passed to the verifier."""
         self.backend.verify('asdf', 'asdf', request='blah', foo='bar', baz=1)
@@ -212,6 +292,274 @@ class BrowserIDBackendTests(TestCase):
             self.assertEqual(backend.authenticate('asdf', 'asdf'), None)
             logger.warn.assert_called_with(exception)
 
+    def test_get_users_for_email_limit(self):
+        """At most two users should be fetched for an email address."""
+        for i in range(3):
+            new_user('a@example.com', 'test{0}'.format(i))
+        with self.assertNumQueries(1):
+            self.assertEqual(len(self.backend.get_users_for_email('a@example.com')), 2)
+
+
+@override_settings(BROWSERID_USER_CACHE=True)
+class UserCacheTests(TestCase):
+    def setUp(self):
+        self.backend = BrowserIDBackend()
+        self.addCleanup(lambda: auth.get_user_cache() and auth.get_user_cache().clear())
+
+    def test_disabled(self):
+        with self.settings(BROWSERID_USER_CACHE=False):
+            self.assertEqual(auth.get_user_cache(), None)
+
+    def test_alias(self):
+        """If BROWSERID_USER_CACHE_ALIAS is set, use that Django cache."""
+        with self.settings(BROWSERID_USER_CACHE_ALIAS='default'):
+            self.assertTrue(auth.get_user_cache() is caches['default'])
+        self.assertTrue(isinstance(auth.get_user_cache(), LRUCache))
+
+    def test_key_normalized(self):
+        self.assertEqual(auth.user_cache_key(' A@Example.com'),
+                         auth.user_cache_key('a@example.com'))
+
+    def test_positive(self):
+        """Cached users should be fetched by primary key."""
+        user = new_user('a@example.com')
+        self.assertEqual(self.backend.get_users_for_email('a@example.com'), [user])
+        with self.assertNumQueries(1) as cm:
+            self.assertEqual(self.backend.get_users_for_email('a@example.com'), [user])
+        self.assertTrue('"id" = ' in cm.captured_queries[0]['sql'])
+
+    def test_positive_stale(self):
+        """
+        If the cached user no longer has the email address, look it up
+        again.
+        """
+        user = new_user('a@example.com')
+        self.backend.get_users_for_email('a@example.com')
+        User.objects.filter(pk=user.pk).update(email='b@example.com')  # No signals.
+        self.assertEqual(self.backend.get_users_for_email('a@example.com'), [])
+
+    @patch.object(settings, 'BROWSERID_CREATE_USER', False)
+    def test_negative(self):
+        """
+        If users aren't created on demand, remember addresses without a
+        user.
+        """
+        self.assertEqual(self.backend.get_users_for_email('a@example.com'), [])
+        with self.assertNumQueries(0):
+            self.assertEqual(self.backend.get_users_for_email('a@example.com'), [])
+
+    def test_negative_create_user(self):
+        """If users are created on demand, always check the database."""
+        self.backend.get_users_for_email('a@example.com')
+        User.objects.bulk_create([User(username='test', email='a@example.com')])  # No signals.
+        self.assertEqual(len(self.backend.get_users_for_email('a@example.com')), 1)
+
+    def test_duplicates_not_cached(self):
+        new_user('a@example.com', 'test1')
+        new_user('a@example.com', 'test2')
+        self.backend.get_users_for_email('a@example.com')
+        self.assertEqual(auth.get_user_cache().get(auth.user_cache_key('a@example.com')), None)
+
+    def test_invalidate_on_save_delete(self):
+        """Saving or deleting a user should drop their cache entry."""
+        cache = auth.get_user_cache()
+        key = auth.user_cache_key('a@example.com')
+        user = new_user('a@example.com')
+        self.backend.get_users_for_email('a@example.com')
+        self.assertEqual(cache.get(key), (user.pk,))
+
+        new_user('a@example.com', 'test2')
+        self.assertEqual(cache.get(key), None)
+        self.assertEqual(len(self.backend.get_users_for_email('a@example.com')), 2)
+
+        user.delete()
+        self.assertEqual(len(self.backend.get_users_for_email('a@example.com')), 1)
+        self.assertTrue(cache.get(key) is not None)
+        User.objects.get(username='test2').delete()
+        self.assertEqual(cache.get(key), None)
+
+    def test_invalidate_on_user_created(self):
+        cache = auth.get_user_cache()
+        cache.set(auth.user_cache_key('a@example.com'), (), 60)
+        user_created.send(None, user=Mock(email='a@example.com'))
+        self.assertEqual(cache.get(auth.user_cache_key('a@example.com')), None)
+
+    @patch.object(settings, 'BROWSERID_CREATE_USER', True)
+    def test_authenticate(self):
+        """Steady-state logins should take a single query."""
+        self.backend.verify = Mock(return_value='a@example.com')
+        user = self.backend.authenticate(assertion='asdf', audience='asdf')
+        self.assertEqual(self.backend.authenticate(assertion='asdf', audience='asdf'), user)
+        with self.assertNumQueries(1):
+            self.assertEqual(self.backend.authenticate(assertion='asdf', audience='asdf'), user)
+
+
+@override_settings(BROWSERID_GET_USER_CACHE=True)
+class GetUserCacheTests(TestCase):
+    def setUp(self):
+        self.backend = BrowserIDBackend()
+        self.user = new_user('a@example.com')
+        caches['default'].clear()
+        request_started.send(None)
+        self.addCleanup(request_finished.send, None)
+        auth.get_user_stats(reset=True)
+
+    def test_disabled(self):
+        with self.settings(BROWSERID_GET_USER_CACHE=False):
+            self.backend.get_user(self.user.pk)
+            with self.assertNumQueries(1):
+                self.assertEqual(self.backend.get_user(self.user.pk), self.user)
+        self.assertEqual(auth.get_user_stats(), {'request_hits': 0, 'cache_hits': 0, 'misses': 0})
+
+    def test_request_memo(self):
+        """Users should be memoized for the rest of the request."""
+        user = self.backend.get_user(self.user.pk)
+        self.assertEqual(user, self.user)
+        with self.assertNumQueries(0):
+            self.assertTrue(BrowserIDBackend().get_user(str(self.user.pk)) is user)
+        self.assertEqual(auth.get_user_stats(), {'request_hits': 1, 'cache_hits': 0, 'misses': 1})
+
+    def test_shared_cache(self):
+        """In later requests, users should come from the shared cache."""
+        user = self.backend.get_user(self.user.pk)
+        request_finished.send(None)
+        request_started.send(None)
+        with self.assertNumQueries(0):
+            cached_user = self.backend.get_user(self.user.pk)
+        self.assertEqual(cached_user, self.user)
+        self.assertTrue(cached_user is not user)
+        self.assertEqual(auth.get_user_stats()['cache_hits'], 1)
+
+    def test_alias_timeout(self):
+        with self.settings(BROWSERID_GET_USER_CACHE_ALIAS='other',
+                           BROWSERID_GET_USER_CACHE_TIMEOUT=10):
+            with patch('django.core.cache.caches') as caches_:
+                caches_['other'].get.return_value = None
+                self.backend.get_user(self.user.pk)
+        key = auth.get_user_cache_key(User, self.user.pk)
+        caches_['other'].set.assert_called_with(key, self.user, 10)
+
+    def test_default_timeout(self):
+        """
+        Users should only be cached briefly by default, since bulk updates
+        don't invalidate them.
+        """
+        with patch('django.core.cache.caches') as caches_:
+            caches_['default'].get.return_value = None
+            self.backend.get_user(self.user.pk)
+        key = auth.get_user_cache_key(User, self.user.pk)
+        caches_['default'].set.assert_called_with(key, self.user, 30)
+
+    def test_missing_user(self):
+        """Missing users should not be cached."""
+        self.assertEqual(self.backend.get_user(12345), None)
+        new_user('b@example.com', 'test2')
+        with self.assertNumQueries(1):
+            self.backend.get_user(12345)
+
+    def test_invalidate(self):
+        """Saving or deleting a user should drop them from both tiers."""
+        self.backend.get_user(self.user.pk)
+        self.user.first_name = 'Bob'
+        self.user.save()
+        self.assertEqual(self.backend.get_user(self.user.pk).first_name, 'Bob')
+        self.assertEqual(auth.get_user_stats()['misses'], 2)
+
+        self.user.delete()
+        self.assertEqual(self.backend.get_user(self.user.pk), None)
+        self.assertEqual(auth.get_user_stats()['misses'], 3)
+
+    def test_invalidate_other_thread(self):
+        """Saving a user in another thread should drop them from this thread's memo."""
+        self.backend.get_user(self.user.pk)
+        thread = threading.Thread(target=post_save.send, args=(User,),
+                                  kwargs={'instance': self.user})
+        thread.start()
+        thread.join()
+
+        self.backend.get_user(self.user.pk)
+        self.assertEqual(auth.get_user_stats(), {'request_hits': 0, 'cache_hits': 0, 'misses': 2})
+
+    def test_outside_request(self):
+        """Outside of requests, users should only be kept in the shared cache."""
+        request_finished.send(None)
+        user = self.backend.get_user(self.user.pk)
+        cached_user = self.backend.get_user(self.user.pk)
+        self.assertEqual(cached_user, user)
+        self.assertTrue(cached_user is not user)
+        self.assertEqual(auth.get_user_stats(), {'request_hits': 0, 'cache_hits': 1, 'misses': 1})
+
+    def test_stats_reset(self):
+        self.backend.get_user(self.user.pk)
+        self.assertEqual(auth.get_user_stats(reset=True)['misses'], 1)
+        self.assertEqual(auth.get_user_stats()['misses'], 0)
+
+
+class SharedVerifierTests(TestCase):
+    def setUp(self):
+        auth.close_verifiers()
+        self.addCleanup(auth.close_verifiers)
+
+    def test_shared(self):
+        verifier_class = Mock()
+        verifier = auth.get_shared_verifier(verifier_class)
+        self.assertEqual(verifier, verifier_class.return_value)
+        self.assertTrue(auth.get_shared_verifier(verifier_class) is verifier)
+        self.assertEqual(verifier_class.call_count, 1)
+
+    def test_cached(self):
+        """Cached verifiers should wrap the shared, uncached instance."""
+        verifier_class = Mock(return_value=Mock(spec=['verify']))
+        verifier = auth.get_shared_verifier(verifier_class)
+        cached_verifier = auth.get_shared_verifier(verifier_class, cached=True)
+        self.assertTrue(isinstance(cached_verifier, CachedVerifier))
+        self.assertTrue(cached_verifier.verifier is verifier)
+        self.assertTrue(auth.get_shared_verifier(verifier_class, cached=True) is cached_verifier)
+
+    def test_cached_verifier_class(self):
+        """Verifiers may set the class that wraps them when cached."""
+        verifier_class = Mock()
+        cached_verifier = auth.get_shared_verifier(verifier_class, cached=True)
+        cached_verifier_class = verifier_class.return_value.cached_verifier_class
+        self.assertEqual(cached_verifier, cached_verifier_class.return_value)
+        cached_verifier_class.assert_called_with(verifier_class.return_value)
+
+    def test_fork(self):
+        """A forked process should create its own verifiers."""
+        verifier_class = Mock(side_effect=[Mock(), Mock()])
+        verifier = auth.get_shared_verifier(verifier_class)
+        with patch('django_browserid.auth.os.getpid', return_value=os.getpid() + 1):
+            self.assertTrue(auth.get_shared_verifier(verifier_class) is not verifier)
+
+    def test_close_verifiers(self):
+        """
+        close_verifiers should close shared verifiers that can be closed,
+        and then create new ones on demand.
+        """
+        closeable = Mock()
+        closeable_class = Mock(side_effect=[closeable, Mock()])
+        not_closeable = Mock(spec=[])
+        error = Mock()
+        error.close.side_effect = Exception()
+
+        auth.get_shared_verifier(closeable_class, cached=True)
+        auth.get_shared_verifier(Mock(return_value=not_closeable))
+        auth.get_shared_verifier(Mock(return_value=error))
+
+        with patch('django_browserid.auth.logger') as logger:
+            auth.close_verifiers()
+        self.assertEqual(closeable.close.call_count, 1)
+        self.assertTrue(logger.warning.called)
+
+        self.assertTrue(auth.get_shared_verifier(closeable_class) is not closeable)
+
+    def test_setting_changed(self):
+        verifier_class = Mock(side_effect=[Mock(), Mock()])
+        verifier = auth.get_shared_verifier(verifier_class)
+        with self.settings(BROWSERID_VERIFIER_CLASS='django_browserid.base.MockVerifier'):
+            self.assertTrue(auth.get_shared_verifier(verifier_class) is not verifier)
+        self.assertEqual(verifier_class.call_count, 2)
+        self.assertEqual(verifier.close.call_count, 1)
 
 
 if get_user_model:
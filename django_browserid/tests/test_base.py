@@ -1,6 +1,9 @@
 # This Source Code Form is subject to the terms of the Mozilla Public
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
+import multiprocessing
+import threading
+import time
 from datetime import datetime
 
 from django.conf import settings
@@ -13,8 +16,10 @@ import requests
 from mock import Mock, patch
 
 from django_browserid import base
+from django_browserid.circuit import CircuitBreaker, CircuitOpenError
 from django_browserid.compat import pybrowserid_found
-from django_browserid.tests import TestCase
+from django_browserid.tests import patch_supportdoc_fetching, TestCase
+from django_browserid.util import LRUCache
 
 
 class SanityCheckTests(TestCase):
@@ -200,6 +205,63 @@ class GetAudienceTests(TestCase):
         with self.settings(BROWSERID_AUDIENCES=[], DEBUG=True):
             self.assertEqual(base.get_audience(request), 'http://testserver')
 
+    def test_first_matching_audience(self):
+        """If several audiences share an origin, return the first one."""
+        request = self.factory.get('http://testserver')
+
+        audiences = ['http://example.com', 'http://testserver/a', 'http://TestServer/b']
+        with self.settings(BROWSERID_AUDIENCES=audiences):
+            self.assertEqual(base.get_audience(request), 'http://testserver/a')
+
+    def test_port(self):
+        request = self.factory.get('/', SERVER_PORT='8000')
+
+        audiences = ['http://testserver', 'http://testserver:8000']
+        with self.settings(BROWSERID_AUDIENCES=audiences):
+            self.assertEqual(base.get_audience(request), 'http://testserver:8000')
+
+    def test_default_port(self):
+        """Audiences with an explicit default port should match."""
+        request = self.factory.get('/', secure=True)
+
+        with self.settings(BROWSERID_AUDIENCES=['https://testserver:443']):
+            self.assertEqual(base.get_audience(request), 'https://testserver:443')
+
+    def test_index_rebuilt(self):
+        """
+        The audience index should be built once, and rebuilt when
+        BROWSERID_AUDIENCES changes.
+        """
+        request = self.factory.get('http://testserver')
+
+        with self.settings(BROWSERID_AUDIENCES=['http://testserver']):
+            with patch('django_browserid.base.origin', wraps=base.origin) as origin:
+                base.get_audience(request)
+                base.get_audience(request)
+            # One lookup for the index, one for each request.
+            self.assertEqual(origin.call_count, 3)
+
+        with self.settings(BROWSERID_AUDIENCES=['https://example.com']):
+            with self.assertRaises(ImproperlyConfigured):
+                base.get_audience(request)
+
+
+class GetAudienceIndexTests(TestCase):
+    def test_index(self):
+        index = base.get_audience_index(['http://a.com', 'https://a.com:8443/path',
+                                         'https://B.com', 'http://a.com/other'])
+        self.assertEqual(index, {
+            ('http', 'a.com', 80): 'http://a.com',
+            ('https', 'a.com', 8443): 'https://a.com:8443/path',
+            ('https', 'b.com', 443): 'https://B.com',
+        })
+
+    def test_reused(self):
+        audiences = ['http://a.com']
+        index = base.get_audience_index(audiences)
+        self.assertTrue(base.get_audience_index(audiences) is index)
+        self.assertTrue(base.get_audience_index(list(audiences)) is not index)
+
 
 class VerificationResultTests(TestCase):
     def test_getattr_attribute_exists(self):
@@ -289,13 +351,14 @@ class RemoteVerifierTests(TestCase):
     def test_verify_requests_parameters(self):
         """
         If a subclass overrides requests_parameters, the parameters
-        should be passed to requests.post.
+        should be passed to session.post.
         """
         class MyVerifier(base.RemoteVerifier):
             requests_parameters = {'foo': 'bar'}
         verifier = MyVerifier()
 
-        with patch('django_browserid.base.requests.post') as post:
+        with patch.object(base.RemoteVerifier, 'session') as session:
+            post = session.post
             post.return_value = self._response(content='{"status":"failure"}')
             verifier.verify('asdf', 'http://testserver')
 
@@ -309,7 +372,8 @@ class RemoteVerifierTests(TestCase):
         """
         verifier = base.RemoteVerifier()
 
-        with patch('django_browserid.base.requests.post') as post:
+        with patch.object(base.RemoteVerifier, 'session') as session:
+            post = session.post
             post.return_value = self._response(content='{"status":"failure"}')
             verifier.verify('asdf', 'http://testserver', foo='bar', baz=5)
 
@@ -325,7 +389,8 @@ class RemoteVerifierTests(TestCase):
         verifier = base.RemoteVerifier()
         request_exception = requests.exceptions.RequestException()
 
-        with patch('django_browserid.base.requests.post') as post:
+        with patch.object(base.RemoteVerifier, 'session') as session:
+            post = session.post
             post.side_effect = request_exception
             with self.assertRaises(base.BrowserIDException) as cm:
                 verifier.verify('asdf', 'http://testserver')
@@ -338,7 +403,8 @@ class RemoteVerifierTests(TestCase):
         """
         verifier = base.RemoteVerifier()
 
-        with patch('django_browserid.base.requests.post') as post:
+        with patch.object(base.RemoteVerifier, 'session') as session:
+            post = session.post
             response = self._response(content='{asg9=3{{{}}{')
             response.json.side_effect = ValueError("Couldn't parse json")
             post.return_value = response
@@ -353,7 +419,8 @@ class RemoteVerifierTests(TestCase):
         """
         verifier = base.RemoteVerifier()
 
-        with patch('django_browserid.base.requests.post') as post:
+        with patch.object(base.RemoteVerifier, 'session') as session:
+            post = session.post
             response = self._response(
                 content='{"status": "okay", "email": "foo@example.com"}')
             response.json.return_value = {"status": "okay", "email": "foo@example.com"}
@@ -362,6 +429,189 @@ class RemoteVerifierTests(TestCase):
         self.assertTrue(result)
         self.assertEqual(result.email, 'foo@example.com')
 
+    def test_verify_multiple_urls(self):
+        """
+        If BROWSERID_VERIFICATION_URLS lists several URLs, hedge requests
+        across them.
+        """
+        verifier = base.RemoteVerifier()
+
+        with self.settings(BROWSERID_VERIFICATION_URLS=['http://a/verify', 'http://b/verify']):
+            with patch.object(base.RemoteVerifier, 'session') as session:
+                response = self._response()
+                response.json.return_value = {'status': 'okay', 'email': 'a@example.com'}
+                session.post.side_effect = [requests.exceptions.RequestException(), response]
+                result = verifier.verify('asdf', 'http://testserver')
+
+        self.assertEqual(result.email, 'a@example.com')
+        urls = set(call[0][0] for call in session.post.call_args_list)
+        self.assertEqual(urls, set(['http://a/verify', 'http://b/verify']))
+
+    def test_verify_circuit_breaker(self):
+        """
+        The outcome of each request should be recorded with the circuit
+        breaker.
+        """
+        verifier = base.RemoteVerifier()
+        breaker = CircuitBreaker()
+
+        with patch.object(base.RemoteVerifier, 'circuit_breaker', breaker):
+            with patch.object(base.RemoteVerifier, 'session') as session:
+                session.post.return_value = self._response()
+                session.post.return_value.json.return_value = {'status': 'okay'}
+                verifier.verify('asdf', 'http://testserver')
+
+                session.post.return_value.json.side_effect = ValueError()
+                verifier.verify('asdf', 'http://testserver')
+
+                session.post.side_effect = requests.exceptions.RequestException()
+                with self.assertRaises(base.BrowserIDException):
+                    verifier.verify('asdf', 'http://testserver')
+
+        stats = breaker.stats()
+        self.assertEqual(stats['calls'], 3)
+        self.assertEqual(stats['errors'], 2)
+
+    def test_verify_circuit_open(self):
+        """
+        If the circuit breaker is open, fail fast with a BrowserIDException
+        without contacting the service.
+        """
+        verifier = base.RemoteVerifier()
+        breaker = CircuitBreaker()
+        breaker.allow = Mock(return_value=False)
+
+        with patch.object(base.RemoteVerifier, 'circuit_breaker', breaker):
+            with patch.object(base.RemoteVerifier, 'session') as session:
+                with self.assertRaises(base.BrowserIDException) as cm:
+                    verifier.verify('asdf', 'http://testserver')
+
+                # Use the fallback verifier if there is one.
+                breaker.fallback = base.MockVerifier('a@example.com')
+                result = verifier.verify('asdf', 'http://testserver')
+
+        self.assertTrue(isinstance(cm.exception.exc, CircuitOpenError))
+        self.assertEqual(result.email, 'a@example.com')
+        self.assertTrue(not session.post.called)
+
+
+class VerifyManyTests(TestCase):
+    def test_empty(self):
+        self.assertEqual(base.MockVerifier('a@example.com').verify_many([], 'asdf'), [])
+
+    def test_order_preserved(self):
+        """Results should be returned in the same order as the assertions."""
+        verifier = base.MockVerifier('a@example.com')
+        assertions = ['assertion{0}'.format(i) for i in range(20)]
+
+        def verify(assertion, audience, **kwargs):
+            # Finish later assertions first.
+            time.sleep(0.001 * (20 - int(assertion[len('assertion'):])))
+            return base.VerificationResult({'status': 'okay', 'email': assertion})
+
+        with patch.object(verifier, 'verify', side_effect=verify):
+            results = verifier.verify_many(assertions, 'http://testserver')
+        self.assertEqual([result.email for result in results], assertions)
+
+    def test_exceptions_returned(self):
+        """
+        Exceptions raised while verifying an assertion should be returned
+        in its place.
+        """
+        verifier = base.RemoteVerifier()
+        error = base.BrowserIDException(Exception())
+
+        def verify(assertion, audience, **kwargs):
+            if assertion == 'bad':
+                raise error
+            return base.VerificationResult({'status': 'okay'})
+
+        with patch.object(verifier, 'verify', side_effect=verify):
+            results = verifier.verify_many(['good', 'bad', 'good'], 'http://testserver')
+        self.assertTrue(results[0])
+        self.assertTrue(results[1] is error)
+        self.assertTrue(results[2])
+
+    def test_kwargs(self):
+        """Extra kwargs should be passed on to verify."""
+        verifier = base.MockVerifier('a@example.com')
+        with patch.object(verifier, 'verify') as verify:
+            verifier.verify_many(['asdf'], 'http://testserver', foo='bar')
+        verify.assert_called_with('asdf', audience='http://testserver', foo='bar')
+
+    def test_concurrency(self):
+        """
+        The number of threads should be limited by the concurrency argument,
+        verify_many_concurrency, and the number of assertions.
+        """
+        verifier = base.MockVerifier('a@example.com')
+        verifier.verify_many_concurrency = 3
+        with patch('django_browserid.base.ThreadPool') as ThreadPool:
+            verifier.verify_many(['a'] * 10, 'asdf')
+            ThreadPool.assert_called_with(3)
+            verifier.verify_many(['a'] * 10, 'asdf', concurrency=5)
+            ThreadPool.assert_called_with(5)
+            verifier.verify_many(['a'] * 2, 'asdf')
+            ThreadPool.assert_called_with(2)
+
+
+class SessionTests(TestCase):
+    def setUp(self):
+        base.close_session()
+        self.addCleanup(base.close_session)
+
+    def test_get_session_reused(self):
+        """get_session should return the same session on every call."""
+        session = base.get_session()
+        self.assertTrue(isinstance(session, requests.Session))
+        self.assertTrue(base.get_session() is session)
+        self.assertTrue(base.RemoteVerifier().session is session)
+
+    def test_get_session_after_fork(self):
+        """
+        If the current pid differs from the pid that created the session,
+        create a new session for the new process.
+        """
+        session = base.get_session()
+        with patch('django_browserid.base.os.getpid', return_value=-1):
+            child_session = base.get_session()
+        self.assertTrue(child_session is not session)
+
+    def test_get_session_threads(self):
+        """Concurrent first calls should all share a single session."""
+        sessions = []
+        threads = [threading.Thread(target=lambda: sessions.append(base.get_session()))
+                   for i in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(set(id(session) for session in sessions)), 1)
+
+    @override_settings(BROWSERID_HTTP_POOL_CONNECTIONS=3, BROWSERID_HTTP_POOL_MAXSIZE=7,
+                       BROWSERID_HTTP_POOL_BLOCK=True, BROWSERID_HTTP_MAX_RETRIES=2)
+    def test_pool_settings(self):
+        """The connection pool should be configured from settings."""
+        adapter = base.get_session().get_adapter('https://verifier.login.persona.org/verify')
+        self.assertEqual(adapter._pool_connections, 3)
+        self.assertEqual(adapter._pool_maxsize, 7)
+        self.assertEqual(adapter._pool_block, True)
+        self.assertEqual(adapter.max_retries.total, 2)
+
+    def test_setting_changed(self):
+        """Changing a BROWSERID_HTTP_* setting should reset the session."""
+        session = base.get_session()
+        with self.settings(BROWSERID_HTTP_POOL_MAXSIZE=20):
+            self.assertTrue(base.get_session() is not session)
+
+    def test_close_session(self):
+        """close_session should close the session and discard it."""
+        session = base.get_session()
+        with patch.object(session, 'close') as close:
+            base.close_session()
+        self.assertTrue(close.called)
+        self.assertTrue(base.get_session() is not session)
+
 
 class MockVerifierTests(TestCase):
     def test_verify_no_email(self):
@@ -393,6 +643,102 @@ class MockVerifierTests(TestCase):
         self.assertEqual(result.baz, 5)
 
 
+class CachedVerifierTests(TestCase):
+    def setUp(self):
+        self.cache = LRUCache()
+        self.wrapped = Mock()
+        self.verifier = base.CachedVerifier(self.wrapped, cache=self.cache)
+
+    def _result(self, status='okay', expires_in=60):
+        response = {'status': status, 'email': 'a@example.com'}
+        if expires_in is not None:
+            response['expires'] = int((time.time() + expires_in) * 1000)
+        return base.VerificationResult(response)
+
+    def test_success_cached(self):
+        """
+        Successful results should be cached, and repeat verifications
+        should not reach the wrapped verifier.
+        """
+        self.wrapped.verify.return_value = self._result()
+        result = self.verifier.verify('asdf', 'http://testserver')
+        cached_result = self.verifier.verify('asdf', 'http://testserver')
+
+        self.assertEqual(self.wrapped.verify.call_count, 1)
+        self.assertTrue(cached_result)
+        self.assertEqual(cached_result._response, result._response)
+
+    def test_keyed_by_audience(self):
+        """The same assertion for a different audience is a cache miss."""
+        self.wrapped.verify.return_value = self._result()
+        self.verifier.verify('asdf', 'http://testserver')
+        self.verifier.verify('asdf', 'https://example.com')
+        self.assertEqual(self.wrapped.verify.call_count, 2)
+
+    def test_success_timeout(self):
+        """Successful results should be cached until they expire."""
+        self.assertEqual(self.verifier.get_timeout(self._result(expires_in=60.5)), 60)
+        self.assertEqual(self.verifier.get_timeout(self._result(expires_in=-5)), None)
+        self.assertEqual(self.verifier.get_timeout(self._result(expires_in=None)), None)
+
+        result = base.VerificationResult({'status': 'okay', 'expires': 'foasdfhas'})
+        self.assertEqual(self.verifier.get_timeout(result), None)
+
+    def test_expired_not_cached(self):
+        """Results that have already expired should not be cached."""
+        self.wrapped.verify.return_value = self._result(expires_in=-5)
+        self.verifier.verify('asdf', 'http://testserver')
+        self.verifier.verify('asdf', 'http://testserver')
+        self.assertEqual(self.wrapped.verify.call_count, 2)
+
+    def test_failure_timeout(self):
+        """
+        Failures should be cached for
+        BROWSERID_VERIFICATION_CACHE_FAILURE_TIMEOUT seconds, and not at all
+        if the setting is 0.
+        """
+        failure = self._result(status='failure')
+        self.assertEqual(self.verifier.get_timeout(failure), 5)
+        with self.settings(BROWSERID_VERIFICATION_CACHE_FAILURE_TIMEOUT=2):
+            self.assertEqual(self.verifier.get_timeout(failure), 2)
+        with self.settings(BROWSERID_VERIFICATION_CACHE_FAILURE_TIMEOUT=0):
+            self.assertEqual(self.verifier.get_timeout(failure), None)
+
+    def test_exception_not_cached(self):
+        """Exceptions from the wrapped verifier should propagate uncached."""
+        self.wrapped.verify.side_effect = base.BrowserIDException(Exception())
+        for i in range(2):
+            with self.assertRaises(base.BrowserIDException):
+                self.verifier.verify('asdf', 'http://testserver')
+        self.assertEqual(self.wrapped.verify.call_count, 2)
+
+    def test_kwargs_bypass_cache(self):
+        """Calls with extra kwargs should bypass the cache."""
+        self.wrapped.verify.return_value = self._result()
+        self.verifier.verify('asdf', 'http://testserver', foo='bar')
+        self.verifier.verify('asdf', 'http://testserver', foo='bar')
+        self.wrapped.verify.assert_called_with('asdf', 'http://testserver', foo='bar')
+        self.assertEqual(self.wrapped.verify.call_count, 2)
+        self.assertEqual(len(self.cache), 0)
+
+    def test_default_cache(self):
+        """
+        By default, use a shared LRUCache sized by
+        BROWSERID_VERIFICATION_CACHE_SIZE.
+        """
+        with self.settings(BROWSERID_VERIFICATION_CACHE_SIZE=5):
+            cache = base.get_verification_cache()
+            self.assertTrue(isinstance(cache, LRUCache))
+            self.assertEqual(cache.max_size, 5)
+            self.assertTrue(base.CachedVerifier(self.wrapped).cache is cache)
+
+    @override_settings(BROWSERID_VERIFICATION_CACHE_ALIAS='default')
+    def test_django_cache(self):
+        """If BROWSERID_VERIFICATION_CACHE_ALIAS is set, use that cache."""
+        from django.core.cache import caches
+        self.assertTrue(base.get_verification_cache() is caches['default'])
+
+
 class LocalVerifierTests(TestCase):
     def setUp(self):
         # Skip tests if PyBrowserID is not installed.
@@ -430,3 +776,170 @@ class LocalVerifierTests(TestCase):
         pybid_verifier.verify.assert_called_with('asdf', 'qwer')
         self.assertTrue(result)
         self.assertEqual(result._response, response)
+
+    def test_verify_many(self):
+        """
+        verify_many should verify assertions in worker processes and return
+        results in order. Invalid assertions get failure results, and
+        unexpected errors are returned as exceptions.
+        """
+        from browserid.tests.support import make_assertion
+
+        audience = 'http://testserver'
+        assertions = [make_assertion('a@example.com', audience),
+                      make_assertion('a@example.com', 'http://example.com'),
+                      'malformed',
+                      make_assertion('b@example.com', audience)]
+        with patch_supportdoc_fetching():
+            results = self.verifier.verify_many(assertions, audience, concurrency=2)
+
+        self.assertEqual(results[0].email, 'a@example.com')
+        self.assertTrue(not results[1])
+        self.assertTrue(isinstance(results[2], ValueError))
+        self.assertEqual(results[3].email, 'b@example.com')
+
+
+def _fail_in_worker(assertion, audience):
+    raise ValueError(assertion)
+
+
+class VerificationProcessPoolTests(TestCase):
+    def setUp(self):
+        if not pybrowserid_found:
+            self.skipTest('PyBrowserID required for test but not installed.')
+
+        from browserid.tests.support import make_assertion
+        self.make_assertion = make_assertion
+
+        # Workers are forked from this process, so they inherit the patch.
+        patcher = patch_supportdoc_fetching()
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(base.close_process_pool)
+
+    def test_disabled_by_default(self):
+        self.assertEqual(base.get_process_pool(), None)
+
+    @override_settings(BROWSERID_LOCAL_VERIFIER_PROCESSES=2)
+    def test_get_process_pool(self):
+        """
+        The pool should be reused, and configured from settings with
+        sensible defaults.
+        """
+        pool = base.get_process_pool()
+        self.assertTrue(base.get_process_pool() is pool)
+        self.assertEqual(pool.processes, 2)
+        self.assertEqual(pool.max_pending, 8)
+        self.assertEqual(pool.timeout, 5)
+
+        with patch('django_browserid.base.os.getpid', return_value=-1):
+            with patch('django_browserid.base.VerificationProcessPool') as VerificationProcessPool:
+                self.assertEqual(base.get_process_pool(), VerificationProcessPool.return_value)
+
+    @override_settings(BROWSERID_LOCAL_VERIFIER_PROCESSES=2)
+    def test_verify_in_pool(self):
+        """If a process pool is configured, LocalVerifier should use it."""
+        verifier = base.LocalVerifier()
+        verifier.pybid_verifier = Mock()
+
+        audience = 'http://testserver'
+        result = verifier.verify(self.make_assertion('a@example.com', audience), audience)
+        self.assertEqual(result.email, 'a@example.com')
+
+        result = verifier.verify(self.make_assertion('a@example.com', 'http://example.com'),
+                                 audience)
+        self.assertTrue(not result)
+        self.assertTrue(not verifier.pybid_verifier.verify.called)
+
+        with self.assertRaises(ValueError):
+            verifier.verify('malformed', audience)
+
+    @override_settings(BROWSERID_LOCAL_VERIFIER_PROCESSES=1,
+                       BROWSERID_LOCAL_VERIFIER_MAX_PENDING=1,
+                       BROWSERID_LOCAL_VERIFIER_TIMEOUT=0.05)
+    def test_back_pressure(self):
+        """
+        If max_pending verifications are already in progress, raise a
+        BrowserIDException once the timeout passes.
+        """
+        pool = base.get_process_pool()
+        pool._slots.acquire()
+        with self.assertRaises(base.BrowserIDException):
+            pool.apply('asdf', 'http://testserver')
+
+        pool._slots.release()
+        pool.timeout = 5
+        response = pool.apply(self.make_assertion('a@example.com', 'http://testserver'),
+                              'http://testserver')
+        self.assertEqual(response['email'], 'a@example.com')
+
+    @override_settings(BROWSERID_LOCAL_VERIFIER_PROCESSES=1,
+                       BROWSERID_LOCAL_VERIFIER_MAX_PENDING=1)
+    def test_worker_failure(self):
+        """A worker failing should release its slot."""
+        pool = base.get_process_pool()
+        with patch('django_browserid.base._verify_in_worker', _fail_in_worker):
+            with self.assertRaises(ValueError):
+                pool.apply('asdf', 'http://testserver')
+            with self.assertRaises(ValueError):
+                pool.map(['asdf'], 'http://testserver')
+
+        response = pool.apply(self.make_assertion('a@example.com', 'http://testserver'),
+                              'http://testserver')
+        self.assertEqual(response['email'], 'a@example.com')
+
+    @override_settings(BROWSERID_LOCAL_VERIFIER_PROCESSES=1,
+                       BROWSERID_LOCAL_VERIFIER_MAX_PENDING=2,
+                       BROWSERID_LOCAL_VERIFIER_TIMEOUT=0.05)
+    def test_map_back_pressure(self):
+        """
+        map should wait for slots like apply, and verify batches larger
+        than max_pending a few at a time.
+        """
+        pool = base.get_process_pool()
+        audience = 'http://testserver'
+        pool._slots.acquire()
+        pool._slots.acquire()
+        with self.assertRaises(base.BrowserIDException):
+            pool.map(['asdf'], audience)
+        pool._slots.release()
+        pool._slots.release()
+
+        pool.timeout = 5
+        emails = ['{0}@example.com'.format(i) for i in range(5)]
+        responses = pool.map([self.make_assertion(email, audience) for email in emails],
+                             audience)
+        self.assertEqual([response['email'] for response in responses], emails)
+
+    @override_settings(BROWSERID_LOCAL_VERIFIER_PROCESSES=1)
+    def test_timeout(self):
+        """
+        If the result isn't ready before the timeout, raise a
+        BrowserIDException.
+        """
+        pool = base.get_process_pool()
+        with patch.object(pool._pool, 'apply_async') as apply_async:
+            apply_async.return_value.get.side_effect = multiprocessing.TimeoutError()
+            with self.assertRaises(base.BrowserIDException):
+                pool.apply('asdf', 'http://testserver')
+
+    @override_settings(BROWSERID_LOCAL_VERIFIER_PROCESSES=2)
+    def test_verify_many_shared_pool(self):
+        """If a process pool is configured, verify_many should use it."""
+        audience = 'http://testserver'
+        assertions = [self.make_assertion('a@example.com', audience),
+                      self.make_assertion('b@example.com', audience)]
+        base.get_process_pool()
+        with patch('django_browserid.base.multiprocessing.Pool') as Pool:
+            results = base.LocalVerifier().verify_many(assertions, audience)
+        self.assertTrue(not Pool.called)
+        self.assertEqual([result.email for result in results], ['a@example.com', 'b@example.com'])
+
+    def test_setting_changed(self):
+        """Changing a BROWSERID_LOCAL_VERIFIER_* setting should stop the pool."""
+        with self.settings(BROWSERID_LOCAL_VERIFIER_PROCESSES=1):
+            pool = base.get_process_pool()
+        with patch.object(pool, 'close'):
+            with self.settings(BROWSERID_LOCAL_VERIFIER_PROCESSES=1):
+                self.assertTrue(base.get_process_pool() is not pool)
+        self.assertTrue(base.get_process_pool() is None)
@@ -0,0 +1,155 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+import os
+
+from mock import ANY, patch
+
+from django_browserid.base import MockVerifier
+from django_browserid.circuit import CircuitBreaker, get_circuit_breaker
+from django_browserid.tests import TestCase
+
+
+class CircuitBreakerTests(TestCase):
+    def setUp(self):
+        self.breaker = CircuitBreaker(window=10, min_calls=4, error_rate=0.5,
+                                      slow_call_duration=1, slow_call_rate=0.75,
+                                      reset_timeout=30, probes=2)
+
+        patcher = patch('django_browserid.circuit.time.time', return_value=1000)
+        self.time = patcher.start()
+        self.addCleanup(patcher.stop)
+
+        patcher = patch('django_browserid.circuit.logger')
+        self.logger = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def call(self, duration=0.1, failed=False):
+        allowed = self.breaker.allow()
+        if allowed:
+            self.breaker.record(duration, failed)
+        return allowed
+
+    def test_closed(self):
+        """A healthy service should keep the breaker closed."""
+        for i in range(20):
+            self.assertTrue(self.call(failed=(i % 4 == 1)))
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_min_calls(self):
+        """The breaker shouldn't open until min_calls calls were made."""
+        for i in range(3):
+            self.call(failed=True)
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+        self.call(failed=True)
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+
+    def test_error_rate(self):
+        self.call()
+        self.call()
+        self.call(failed=True)
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+        self.call(failed=True)
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(self.breaker.allow())
+        self.logger.warning.assert_called_with(ANY, 'closed', 'open')
+
+    def test_slow_call_rate(self):
+        self.call()
+        for i in range(3):
+            self.call(duration=1)
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+
+    def test_window(self):
+        """Calls older than the window should be forgotten."""
+        for i in range(3):
+            self.call(failed=True)
+        self.time.return_value = 1010
+        self.call(failed=True)
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+        self.assertEqual(self.breaker.stats()['calls'], 1)
+
+    def open(self):
+        for i in range(4):
+            self.call(failed=True)
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+
+    def test_half_open_success(self):
+        """
+        After reset_timeout, the breaker should let probes through, and close
+        once enough of them succeed.
+        """
+        self.open()
+        self.time.return_value = 1029
+        self.assertFalse(self.breaker.allow())
+
+        self.time.return_value = 1030
+        self.assertTrue(self.breaker.allow())
+        self.assertTrue(self.breaker.allow())
+        self.assertEqual(self.breaker.state, CircuitBreaker.HALF_OPEN)
+        # Only `probes` calls may be in flight at once.
+        self.assertFalse(self.breaker.allow())
+
+        self.breaker.record(0.1)
+        self.assertEqual(self.breaker.state, CircuitBreaker.HALF_OPEN)
+        self.breaker.record(0.1)
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+        self.assertEqual(self.breaker.stats()['calls'], 0)
+
+    def test_half_open_failure(self):
+        """A failed or slow probe should re-open the breaker."""
+        for duration, failed in ((0.1, True), (1, False)):
+            self.open()
+            self.time.return_value += 30
+            self.assertTrue(self.call(duration, failed))
+            self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+            self.assertEqual(self.breaker.opened_at, self.time.return_value)
+            self.breaker.reset()
+
+    def test_stats(self):
+        self.call()
+        self.call(duration=1)
+        self.call(failed=True)
+        self.call(failed=True)
+        self.assertFalse(self.breaker.allow())
+        self.assertEqual(self.breaker.stats(), {
+            'state': 'open',
+            'opened_at': 1000,
+            'calls': 0,
+            'errors': 0,
+            'slow_calls': 0,
+            'error_rate': 0.0,
+            'slow_call_rate': 0.0,
+            'rejected': 1,
+        })
+
+        breaker = CircuitBreaker()
+        breaker.record(3, failed=True)
+        stats = breaker.stats()
+        self.assertEqual((stats['calls'], stats['errors'], stats['slow_calls']), (1, 1, 1))
+        self.assertEqual(stats['error_rate'], 1.0)
+
+
+class GetCircuitBreakerTests(TestCase):
+    def test_disabled(self):
+        with self.settings(BROWSERID_CIRCUIT_BREAKER=False):
+            self.assertEqual(get_circuit_breaker(), None)
+
+    def test_settings(self):
+        with self.settings(BROWSERID_CIRCUIT_BREAKER=True,
+                           BROWSERID_CIRCUIT_BREAKER_WINDOW=5,
+                           BROWSERID_CIRCUIT_BREAKER_PROBES=3):
+            breaker = get_circuit_breaker()
+            self.assertTrue(get_circuit_breaker() is breaker)
+            self.assertEqual(breaker.window, 5)
+            self.assertEqual(breaker.probes, 3)
+            self.assertEqual(breaker.fallback, None)
+
+            with patch('django_browserid.circuit.os.getpid', return_value=os.getpid() + 1):
+                self.assertTrue(get_circuit_breaker() is not breaker)
+
+    def test_fallback(self):
+        with self.settings(BROWSERID_CIRCUIT_BREAKER=True,
+                           BROWSERID_CIRCUIT_BREAKER_FALLBACK=(
+                               'django_browserid.tests.test_auth.DummyVerifier')):
+            self.assertTrue(isinstance(get_circuit_breaker().fallback, MockVerifier))
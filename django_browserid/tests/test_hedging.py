@@ -0,0 +1,156 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+import threading
+import time
+
+from mock import patch
+
+from django_browserid.hedging import Endpoint, EndpointSet, get_endpoint_set
+from django_browserid.tests import TestCase
+
+
+class EndpointTests(TestCase):
+    def test_record(self):
+        endpoint = Endpoint('http://a')
+        endpoint.record(1.0, False)
+        self.assertEqual(endpoint.latency, 1.0)
+        self.assertEqual(endpoint.error_rate, 0.0)
+
+        endpoint.record(2.0, True)
+        self.assertAlmostEqual(endpoint.latency, 1.1)
+        self.assertAlmostEqual(endpoint.error_rate, 0.1)
+
+    def test_weight(self):
+        """Faster and more reliable endpoints should get more weight."""
+        fast, slow, failing = Endpoint('http://a'), Endpoint('http://b'), Endpoint('http://c')
+        fast.record(0.01, False)
+        slow.record(0.1, False)
+        failing.record(0.01, False)
+        failing.error_rate = 0.5
+        self.assertTrue(fast.weight > slow.weight)
+        self.assertTrue(fast.weight > failing.weight)
+
+        # Endpoints never get a weight of zero.
+        failing.error_rate = 1.0
+        self.assertTrue(failing.weight > 0)
+
+
+class EndpointSetTests(TestCase):
+    def setUp(self):
+        self.endpoint_set = EndpointSet(['http://a', 'http://b', 'http://c'],
+                                        percentile=90, delay=0.05, max_requests=2)
+
+    def test_choose(self):
+        """Healthier endpoints should usually be tried first."""
+        a, b, c = self.endpoint_set.endpoints
+        a.record(0.5, False)
+        b.record(0.001, False)
+        c.record(0.5, True)
+
+        first = [self.endpoint_set.choose()[0] for i in range(200)]
+        self.assertTrue(first.count(b) > 150)
+        self.assertEqual(len(set(self.endpoint_set.choose())), 3)
+
+    def test_hedge_delay(self):
+        """
+        The hedge delay should be the configured percentile of recent
+        successful response times, once there are enough of them.
+        """
+        endpoint = self.endpoint_set.endpoints[0]
+        for i in range(19):
+            self.endpoint_set.record(endpoint, i / 100.0, False)
+        self.endpoint_set.record(endpoint, 10, True)
+        self.assertEqual(self.endpoint_set.hedge_delay(), 0.05)
+
+        self.endpoint_set.record(endpoint, 0.19, False)
+        self.assertEqual(self.endpoint_set.hedge_delay(), 0.17)
+
+    def call(self, answers):
+        """
+        Call the endpoint set with a function answering each URL with the
+        given (delay, answer) pair, where answer may be an exception.
+        """
+        calls = []
+
+        def func(url):
+            calls.append(url)
+            delay, answer = answers[url]
+            time.sleep(delay)
+            if isinstance(answer, Exception):
+                raise answer
+            return answer
+
+        with patch.object(self.endpoint_set, 'choose', return_value=self.endpoint_set.endpoints):
+            return self.endpoint_set.call(func), calls
+
+    def test_fast(self):
+        """If the first endpoint answers quickly, don't hedge."""
+        answer, calls = self.call({'http://a': (0, ('a', False))})
+        self.assertEqual(answer, ('a', False))
+        self.assertEqual(calls, ['http://a'])
+
+    def test_hedge(self):
+        """
+        If the first endpoint is slow, send the request to the second one
+        and return the first answer.
+        """
+        answer, calls = self.call({'http://a': (0.5, ('a', False)),
+                                   'http://b': (0, ('b', False))})
+        self.assertEqual(answer, ('b', False))
+        self.assertEqual(calls, ['http://a', 'http://b'])
+
+    def test_max_requests(self):
+        """No more than max_requests endpoints should be tried."""
+        answer, calls = self.call({'http://a': (0.2, ('a', False)),
+                                   'http://b': (0.2, ('b', False)),
+                                   'http://c': (0, ('c', False))})
+        self.assertTrue(answer in [('a', False), ('b', False)])
+        self.assertEqual(calls, ['http://a', 'http://b'])
+
+    def test_failure_retried(self):
+        """If a request fails, try the next endpoint immediately."""
+        start = time.time()
+        answer, calls = self.call({'http://a': (0, Exception()),
+                                   'http://b': (0, ('b', False))})
+        self.assertEqual(answer, ('b', False))
+        self.assertTrue(time.time() - start < 0.05)
+
+        answer, calls = self.call({'http://a': (0, ('a', True)),
+                                   'http://b': (0, ('b', False))})
+        self.assertEqual(answer, ('b', False))
+
+    def test_all_failed(self):
+        """
+        If every request fails, return the last unusable answer, or raise the
+        last exception.
+        """
+        answer, calls = self.call({'http://a': (0, ('a', True)),
+                                   'http://b': (0, Exception())})
+        self.assertEqual(answer, ('a', True))
+
+        error = Exception()
+        with self.assertRaises(Exception) as cm:
+            self.call({'http://a': (0, Exception()), 'http://b': (0, error)})
+        self.assertTrue(cm.exception is error)
+
+    def test_losers_recorded(self):
+        """Abandoned requests should still be recorded for endpoint health."""
+        event = threading.Event()
+        with patch.object(self.endpoint_set, 'record', side_effect=lambda *args: event.set()):
+            self.call({'http://a': (0.2, ('a', False)), 'http://b': (0, ('b', False))})
+            event.clear()
+            self.assertTrue(event.wait(1))
+
+
+class GetEndpointSetTests(TestCase):
+    def test_shared(self):
+        with self.settings(BROWSERID_HEDGE_PERCENTILE=50, BROWSERID_HEDGE_DELAY=1,
+                           BROWSERID_HEDGE_MAX_REQUESTS=3):
+            endpoint_set = get_endpoint_set(['http://a', 'http://b'])
+            self.assertTrue(get_endpoint_set(['http://a', 'http://b']) is endpoint_set)
+            self.assertTrue(get_endpoint_set(['http://a', 'http://c']) is not endpoint_set)
+            self.assertEqual(endpoint_set.percentile, 50)
+            self.assertEqual(endpoint_set.delay, 1)
+            self.assertEqual(endpoint_set.max_requests, 3)
+        self.assertTrue(get_endpoint_set(['http://a', 'http://b']) is not endpoint_set)
@@ -1,4 +1,13 @@
+import os
+import shutil
+import tempfile
+
+from django.core.urlresolvers import set_script_prefix, set_urlconf
+from django.test.client import RequestFactory
+from django.utils import translation
 from django.utils.functional import lazy
+from django.utils.safestring import mark_safe, SafeData
+from django.utils.translation import ugettext_lazy
 
 from mock import patch
 
@@ -16,6 +25,7 @@ class BrowserIDInfoTests(TestCase):
         patcher = patch('django_browserid.helpers.render_to_string')
         self.addCleanup(patcher.stop)
         self.render_to_string = patcher.start()
+        helpers._info_cache.clear()
 
     def test_defaults(self):
         with self.settings(BROWSERID_REQUEST_ARGS={'foo': 'bar', 'baz': 1}):
@@ -43,8 +53,127 @@ class BrowserIDInfoTests(TestCase):
         })
         self.render_to_string.assert_called_with('browserid/info.html', {'info': expected_info})
 
+    def test_csrf_token(self):
+        """
+        If BROWSERID_INFO_CSRF_TOKEN is True, the request's CSRF token
+        should be included and the output should not be cached.
+        """
+        request = RequestFactory().get('/')
+        request.csrf_token = 'asdf'
+        with self.settings(BROWSERID_INFO_CSRF_TOKEN=True):
+            helpers.browserid_info(request)
+            helpers.browserid_info(request)
+
+        self.assertEqual(self.render_to_string.call_count, 2)
+        expected_info = JSON_STRING({
+            'loginUrl': '/browserid/login/',
+            'logoutUrl': '/browserid/logout/',
+            'csrfUrl': '/browserid/csrf/',
+            'requestArgs': {},
+            'csrfToken': 'asdf',
+        })
+        self.render_to_string.assert_called_with('browserid/info.html', {'info': expected_info})
+
+    def test_csrf_token_disabled(self):
+        """By default, the CSRF token should not be included."""
+        request = RequestFactory().get('/')
+        request.csrf_token = 'asdf'
+        helpers.browserid_info(request)
+        info = self.render_to_string.call_args[0][1]['info']
+        self.assertFalse('csrfToken' in info)
+
+    def test_csrf_cookie(self):
+        """
+        If BROWSERID_CSRF_COOKIE is True, the CSRF cookie name should be
+        included and the cookie should be set.
+        """
+        request = RequestFactory().get('/')
+        with self.settings(BROWSERID_CSRF_COOKIE=True, CSRF_COOKIE_NAME='csrf'):
+            helpers.browserid_info(request)
+
+        expected_info = JSON_STRING({
+            'loginUrl': '/browserid/login/',
+            'logoutUrl': '/browserid/logout/',
+            'csrfUrl': '/browserid/csrf/',
+            'requestArgs': {},
+            'csrfCookieName': 'csrf',
+        })
+        self.render_to_string.assert_called_with('browserid/info.html', {'info': expected_info})
+        self.assertTrue(request.META.get('CSRF_COOKIE_USED'))
+
+    def test_csrf_cookie_httponly(self):
+        """JavaScript can't read HttpOnly cookies, so don't use them."""
+        with self.settings(BROWSERID_CSRF_COOKIE=True, CSRF_COOKIE_HTTPONLY=True):
+            helpers.browserid_info()
+        info = self.render_to_string.call_args[0][1]['info']
+        self.assertFalse('csrfCookieName' in info)
+
+    def test_cached(self):
+        """The output should only be rendered once."""
+        output = helpers.browserid_info()
+        self.assertEqual(helpers.browserid_info(), output)
+        self.assertEqual(self.render_to_string.call_count, 1)
+
+    def test_cache_disabled(self):
+        with self.settings(BROWSERID_INFO_CACHE=False):
+            helpers.browserid_info()
+            helpers.browserid_info()
+        self.assertEqual(self.render_to_string.call_count, 2)
+
+    def test_lazy_request_args_not_cached(self):
+        """
+        If the request args or any of their values are lazy, they may change
+        between requests, so the output should not be cached.
+        """
+        site_names = iter(['first', 'second'])
+        site_name = lazy(lambda: next(site_names), str)
+        with self.settings(BROWSERID_REQUEST_ARGS={'siteName': site_name()}):
+            helpers.browserid_info()
+            helpers.browserid_info()
+        self.assertEqual(self.render_to_string.call_count, 2)
+        info = self.render_to_string.call_args[0][1]['info']
+        self.assertTrue('second' in info)
+
+        with self.settings(BROWSERID_REQUEST_ARGS=lazy_request_args()):
+            helpers.browserid_info()
+            helpers.browserid_info()
+        self.assertEqual(self.render_to_string.call_count, 4)
+
+    def test_cache_key(self):
+        """
+        The output should be rendered separately for each language, urlconf
+        and script prefix.
+        """
+        helpers.browserid_info()
+        with translation.override('fr'):
+            helpers.browserid_info()
+        self.assertEqual(self.render_to_string.call_count, 2)
+
+        set_urlconf('django_browserid.tests.urls')
+        self.addCleanup(set_urlconf, None)
+        helpers.browserid_info()
+        self.assertEqual(self.render_to_string.call_count, 3)
+
+        set_script_prefix('/prefix/')
+        self.addCleanup(set_script_prefix, '/')
+        helpers.browserid_info()
+        self.assertEqual(self.render_to_string.call_count, 4)
+        info = self.render_to_string.call_args[0][1]['info']
+        self.assertTrue('/prefix/browserid/login/' in info)
+
+    def test_settings_changed(self):
+        """Changing settings should invalidate cached output."""
+        helpers.browserid_info()
+        with self.settings(BROWSERID_REQUEST_ARGS={'foo': 'bar'}):
+            helpers.browserid_info()
+        helpers.browserid_info()
+        self.assertEqual(self.render_to_string.call_count, 3)
+
 
 class BrowserIDJSTests(TestCase):
+    def setUp(self):
+        helpers._static_tags_cache.clear()
+
     def test_basic(self):
         output = helpers.browserid_js()
         self.assertHTMLEqual(output, """
@@ -82,14 +211,70 @@ class BrowserIDJSTests(TestCase):
                 <script type="text/javascript" src="static/browserid/browserid.js"></script>
             """)
 
+    def test_bundle(self):
+        with self.settings(BROWSERID_JS_BUNDLE=True):
+            output = helpers.browserid_js()
+        self.assertHTMLEqual(output, """
+            <script type="text/javascript" src="https://login.persona.org/include.js"></script>
+            <script type="text/javascript" src="static/browserid/browserid.bundle.js"></script>
+        """)
+
+    def test_bundle_autologin(self):
+        """The bundle can't be used with the autologin mock script."""
+        with self.settings(BROWSERID_JS_BUNDLE=True, BROWSERID_AUTOLOGIN_ENABLED=True):
+            output = helpers.browserid_js()
+        self.assertHTMLEqual(output, """
+            <script type="text/javascript" src="static/browserid/api.js"></script>
+            <script type="text/javascript" src="static/browserid/autologin.js"></script>
+            <script type="text/javascript" src="static/browserid/browserid.js"></script>
+        """)
+
+    def test_bundle_contents(self):
+        """The bundle should be api.js followed by browserid.js."""
+        static_dir = os.path.join(os.path.dirname(helpers.__file__), 'static', 'browserid')
+
+        def read(filename):
+            with open(os.path.join(static_dir, filename), 'rb') as f:
+                return f.read()
+
+        self.assertEqual(read('browserid.bundle.js'), read('api.js') + read('browserid.js'))
+
+    @patch('django_browserid.helpers.staticfiles_storage')
+    def test_cached(self, staticfiles_storage):
+        """The storage should only be asked for URLs once."""
+        staticfiles_storage.url.side_effect = lambda path: '/static/' + path
+        output = helpers.browserid_js()
+        self.assertEqual(helpers.browserid_js(), output)
+        self.assertEqual(staticfiles_storage.url.call_count, 2)
+
+        # Different arguments and settings are cached separately.
+        self.assertNotEqual(helpers.browserid_js(include_shim=False), output)
+        with self.settings(BROWSERID_JS_BUNDLE=True):
+            self.assertTrue('browserid.bundle.js' in helpers.browserid_js())
+        self.assertEqual(staticfiles_storage.url.call_count, 5)
+
+        # Changing settings clears the cache.
+        helpers.browserid_js()
+        self.assertEqual(staticfiles_storage.url.call_count, 7)
+
 
 class BrowserIDCSSTests(TestCase):
+    def setUp(self):
+        helpers._static_tags_cache.clear()
+
     def test_basic(self):
         output = helpers.browserid_css()
         self.assertHTMLEqual(output, """
             <link rel="stylesheet" href="static/browserid/persona-buttons.css" />
         """)
 
+    @patch('django_browserid.helpers.staticfiles_storage')
+    def test_cached(self, staticfiles_storage):
+        staticfiles_storage.url.return_value = '/static/browserid/persona-buttons.css'
+        output = helpers.browserid_css()
+        self.assertEqual(helpers.browserid_css(), output)
+        self.assertEqual(staticfiles_storage.url.call_count, 1)
+
 
 class BrowserIDButtonTests(TestCase):
     def test_basic(self):
@@ -110,6 +295,49 @@ class BrowserIDButtonTests(TestCase):
             </a>
         """)
 
+    def test_matches_template(self):
+        """
+        Buttons rendered without the template engine should be identical to
+        buttons rendered from the default template.
+        """
+        attrs = {
+            'class': 'a "b" <c>',
+            'href': mark_safe('/safe?a=1&amp;b=2'),
+            'data-next': None,
+            'data-count': 5,
+            'title': ugettext_lazy('Sign in'),
+        }
+        text = u'Sign <in> \u2603'
+        with patch('django_browserid.helpers.button_template_overridden', return_value=True):
+            expected = helpers.browserid_button(text=text, attrs=dict(attrs))
+        self.assertEqual(helpers.browserid_button(text=text, attrs=dict(attrs)), expected)
+        self.assertTrue(isinstance(expected, SafeData))
+
+    def test_template_overridden(self):
+        """
+        If the project overrides the button template, it should be used to
+        render buttons.
+        """
+        self.assertFalse(helpers.button_template_overridden())
+
+        template_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, template_dir)
+        os.mkdir(os.path.join(template_dir, 'browserid'))
+        with open(os.path.join(template_dir, 'browserid', 'button.html'), 'w') as f:
+            f.write('<button class="{{ attrs.class }}">{{ text }}</button>')
+
+        templates = [{
+            'BACKEND': 'django.template.backends.django.DjangoTemplates',
+            'DIRS': [template_dir],
+            'APP_DIRS': True,
+        }]
+        with self.settings(TEMPLATES=templates):
+            self.assertTrue(helpers.button_template_overridden())
+            button = helpers.browserid_button(text='asdf', link_class='fake-button')
+        self.assertHTMLEqual(button, '<button class="fake-button">asdf</button>')
+
+        self.assertFalse(helpers.button_template_overridden())
+
 
 class BrowserIDLoginTests(TestCase):
     def test_login_class(self):
@@ -0,0 +1,385 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from django.contrib.auth.models import User
+from django.core.exceptions import ImproperlyConfigured
+from django.test.client import RequestFactory
+
+from mock import Mock, patch
+
+from django_browserid import metrics, views
+from django_browserid.base import CachedVerifier, get_audience, MockVerifier
+from django_browserid.circuit import get_circuit_breaker
+from django_browserid.tests import mock_browserid, TestCase
+from django_browserid.util import LRUCache
+
+
+snapshots = []
+
+
+def callback(snapshot):
+    snapshots.append(snapshot)
+
+
+class HistogramTests(TestCase):
+    def test_bucket_bounds(self):
+        """Every value should be below its bucket's bound, within about 3%."""
+        for value in (1e-6, 0.0042, 0.5, 1, 3.3, 1000):
+            bound = metrics.bucket_upper_bound(metrics.bucket_index(value))
+            self.assertTrue(value < bound <= value * 1.07, (value, bound))
+
+    def test_bucket_index_bisect(self):
+        """
+        Values bucketed by bisection should land in the same bucket as
+        values outside the bisected range, whose index is computed.
+        """
+        bounds = [metrics.bucket_upper_bound(index) for index in range(-400, 400)]
+        for index, bound in enumerate(bounds[1:], -399):
+            self.assertEqual(metrics.bucket_index(bound), index + 1)
+            self.assertEqual(metrics.bucket_index(bound * 0.999), index)
+
+    def test_zero(self):
+        self.assertEqual(metrics.bucket_index(0), metrics.ZERO_BUCKET)
+        self.assertEqual(metrics.bucket_index(-1), metrics.ZERO_BUCKET)
+        self.assertEqual(metrics.bucket_upper_bound(metrics.ZERO_BUCKET), 0)
+
+    def test_percentile(self):
+        registry = metrics.Registry()
+        for i in range(1, 101):
+            registry.observe('latency', i / 1000.0)
+        histogram = registry.snapshot().histograms['latency']
+
+        self.assertEqual(histogram.count, 100)
+        self.assertAlmostEqual(histogram.total, 5.05)
+        self.assertTrue(0.050 <= histogram.percentile(50) <= 0.052)
+        self.assertTrue(0.099 <= histogram.percentile(99) <= 0.102)
+        self.assertTrue(0.100 <= histogram.percentile(100) <= 0.103)
+        self.assertEqual(metrics.Histogram().percentile(50), None)
+
+    def test_cumulative_counts(self):
+        histogram = metrics.Histogram()
+        histogram.buckets = {metrics.bucket_index(v): 1 for v in (0.001, 0.02, 0.3, 20)}
+        self.assertEqual(histogram.cumulative_counts((0.01, 0.5, 1)), [1, 3, 3])
+
+
+class RegistryTests(TestCase):
+    def test_threads(self):
+        """Metrics recorded in each thread should be merged."""
+        registry = metrics.Registry()
+        barrier = threading.Event()
+
+        def record():
+            for i in range(100):
+                registry.incr('count')
+                registry.observe('latency', 0.01)
+            barrier.wait()
+
+        threads = [threading.Thread(target=record) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        registry.incr('count', 5)
+
+        while len(registry._shards) < 5:
+            pass
+        snapshot = registry.snapshot()
+        barrier.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(snapshot.counters, {'count': 405})
+        self.assertEqual(snapshot.histograms['latency'].count, 400)
+
+        # Shards of finished threads are folded together, keeping their
+        # metrics.
+        snapshot = registry.snapshot()
+        self.assertEqual(len(registry._shards), 1)
+        self.assertEqual(snapshot.counters, {'count': 405})
+        self.assertEqual(registry.snapshot().counters, {'count': 405})
+
+    def test_flush(self):
+        """Each flush should send what was recorded since the last one."""
+        sink = Mock()
+        registry = metrics.Registry(sink)
+        registry.incr('count', 2)
+        registry.observe('latency', 0.5)
+        registry.flush()
+        registry.incr('count')
+        registry.flush()
+        registry.flush()
+
+        self.assertEqual(sink.send.call_count, 2)
+        first, second = [call[0][0] for call in sink.send.call_args_list]
+        self.assertEqual(first.counters, {'count': 2})
+        self.assertEqual(first.histograms['latency'].count, 1)
+        self.assertEqual(second.counters, {'count': 1})
+        self.assertEqual(second.histograms, {})
+
+    @patch('django_browserid.metrics.logger')
+    def test_flush_error(self, logger):
+        """Errors in the sink should be logged rather than raised."""
+        registry = metrics.Registry(Mock(send=Mock(side_effect=IOError)))
+        registry.incr('count')
+        registry.flush()
+        self.assertTrue(logger.exception.called)
+
+
+class GetRegistryTests(TestCase):
+    def setUp(self):
+        del snapshots[:]
+
+    def test_disabled(self):
+        with self.settings(BROWSERID_METRICS=False):
+            self.assertEqual(metrics.get_registry(), None)
+            metrics.incr('count')
+            metrics.observe('latency', 1)
+
+    def test_enabled(self):
+        callback_path = 'django_browserid.tests.test_metrics.callback'
+        with self.settings(BROWSERID_METRICS=True,
+                           BROWSERID_METRICS_SINK='django_browserid.metrics.CallbackSink',
+                           BROWSERID_METRICS_CALLBACK=callback_path):
+            registry = metrics.get_registry()
+            self.assertTrue(metrics.get_registry() is registry)
+            self.assertTrue(metrics._flusher.is_alive())
+
+            metrics.incr('count')
+            with metrics.timer('latency'):
+                pass
+            metrics.flush_metrics()
+
+        snapshot, = snapshots
+        self.assertEqual(snapshot.counters, {'count': 1})
+        self.assertEqual(snapshot.histograms['latency'].count, 1)
+        self.assertEqual(metrics._flusher, None)
+
+    def test_fork(self):
+        """A new registry should be created in forked processes."""
+        with self.settings(BROWSERID_METRICS=True):
+            registry = metrics.get_registry()
+            with patch('django_browserid.metrics.os.getpid', return_value=-1):
+                self.assertFalse(metrics.get_registry() is registry)
+
+    def test_reset_after_fork(self):
+        """After a fork, the child should record into a registry of its own."""
+        with self.settings(BROWSERID_METRICS=True):
+            registry = metrics.get_registry()
+            registry.incr('count')
+            metrics._reset_after_fork()
+            metrics.incr('count')
+            self.assertFalse(metrics.get_registry() is registry)
+            self.assertEqual(metrics.get_registry().snapshot().counters, {'count': 1})
+
+    def test_registry_fork(self):
+        """
+        A registry should notice a fork when it is next read, without
+        checking on every call, and forget what the parent recorded.
+        """
+        on_fork = Mock()
+        registry = metrics.Registry(on_fork=on_fork)
+        registry.incr('count')
+        with patch('django_browserid.metrics.os.getpid', return_value=-1) as getpid:
+            registry.incr('count')
+            self.assertFalse(getpid.called)
+            self.assertEqual(registry.snapshot().counters, {})
+        self.assertEqual(on_fork.call_count, 1)
+
+
+class SinkTests(TestCase):
+    def snapshot(self):
+        registry = metrics.Registry()
+        registry.incr('login.success', 3)
+        registry.observe('verification.duration', 0.02)
+        registry.observe('verification.duration', 0.2)
+        return registry.snapshot()
+
+    def test_statsd(self):
+        sink = metrics.StatsdSink(host='statsd', port=9125, prefix='app')
+        sink.socket = Mock()
+        sink.send(self.snapshot())
+
+        packet, address = sink.socket.sendto.call_args[0]
+        self.assertEqual(address, ('statsd', 9125))
+        lines = packet.decode('utf-8').split('\n')
+        self.assertEqual(lines[:2], ['app.login.success:3|c',
+                                     'app.verification.duration.count:2|c'])
+        self.assertTrue(lines[2].startswith('app.verification.duration.p50:20.'))
+        self.assertTrue(lines[5].startswith('app.verification.duration.max:20'))
+
+    def test_statsd_settings(self):
+        with self.settings(BROWSERID_METRICS_STATSD_HOST='statsd',
+                           BROWSERID_METRICS_STATSD_PORT=9125):
+            sink = metrics.StatsdSink()
+        self.assertEqual(sink.address, ('statsd', 9125))
+        self.assertEqual(sink.prefix, 'browserid')
+
+    def test_prometheus(self):
+        sink = metrics.PrometheusSink()
+        sink.send(self.snapshot())
+        sink.send(self.snapshot())
+        self.assertEqual(sink.render().split('\n')[:6], [
+            '# TYPE browserid_login_success_total counter',
+            'browserid_login_success_total 6',
+            '# TYPE browserid_verification_duration_seconds histogram',
+            'browserid_verification_duration_seconds_bucket{le="0.005"} 0',
+            'browserid_verification_duration_seconds_bucket{le="0.01"} 0',
+            'browserid_verification_duration_seconds_bucket{le="0.025"} 2',
+        ])
+        self.assertTrue('browserid_verification_duration_seconds_bucket{le="+Inf"} 4\n'
+                        in sink.render())
+        self.assertTrue('browserid_verification_duration_seconds_count 4\n' in sink.render())
+
+
+class RecordingTests(TestCase):
+    def verify(self, email):
+        request = RequestFactory().post('/browserid/login/', {'assertion': 'asdf'})
+        with self.settings(BROWSERID_METRICS=True):
+            with mock_browserid(email), patch('django_browserid.views.auth.login'):
+                views.Verify.as_view()(request)
+            return metrics.get_registry().snapshot()
+
+    def test_success(self):
+        snapshot = self.verify('new@example.com')
+        self.assertEqual(snapshot.counters, {
+            'verification.ok': 1,
+            'user.created': 1,
+            'login.success': 1,
+        })
+        self.assertEqual(snapshot.histograms['verification.duration'].count, 1)
+
+    def test_failure(self):
+        snapshot = self.verify(None)
+        self.assertEqual(snapshot.counters, {'verification.failure': 1, 'login.failure': 1})
+
+    def test_error(self):
+        with patch('django_browserid.base.MockVerifier.verify', side_effect=ValueError):
+            snapshot = self.verify('a@example.com')
+        self.assertEqual(snapshot.counters, {'verification.error': 1, 'login.failure': 1})
+
+    def test_inactive(self):
+        User.objects.create_user('inactive', 'inactive@example.com', is_active=False)
+        snapshot = self.verify('inactive@example.com')
+        self.assertEqual(snapshot.counters['login.inactive'], 1)
+        self.assertEqual(snapshot.counters['login.failure'], 1)
+
+    def test_audience_misconfigured(self):
+        request = RequestFactory().get('/', SERVER_NAME='example.net')
+        with self.settings(BROWSERID_METRICS=True, BROWSERID_AUDIENCES=['http://example.com']):
+            with self.assertRaises(ImproperlyConfigured):
+                get_audience(request)
+            snapshot = metrics.get_registry().snapshot()
+        self.assertEqual(snapshot.counters, {'audience.misconfigured': 1})
+        self.assertEqual(snapshot.counters, {'audience.misconfigured': 1})
+
+    def test_verification_cache(self):
+        expires = int((time.time() + 60) * 1000)
+        verifier = CachedVerifier(MockVerifier('a@example.com', expires=expires), LRUCache())
+        with self.settings(BROWSERID_METRICS=True):
+            verifier.verify('asdf', 'http://example.com')
+            verifier.verify('asdf', 'http://example.com')
+            snapshot = metrics.get_registry().snapshot()
+        self.assertEqual(snapshot.counters, {'verification_cache.hits': 1,
+                                             'verification_cache.misses': 1})
+
+
+class MultiprocessTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, pid, counters, gauges=None):
+        registry = metrics.Registry()
+        for name, value in counters.items():
+            registry.incr(name, value)
+        registry.observe('verification.duration', 0.02)
+        sink = metrics.FileSink(self.directory)
+        sink.path = os.path.join(self.directory, 'browserid-{0}.json'.format(pid))
+        with patch('django_browserid.metrics.collect_gauges', return_value=gauges or {}):
+            sink.send(registry.snapshot())
+
+    def test_read_metrics_dir(self):
+        """Metrics from every process should be merged."""
+        self.write(os.getpid(), {'login.success': 2}, {'circuit.open': 1})
+        self.write(12345678, {'login.success': 3, 'login.failure': 1}, {'circuit.open': 0})
+        open(os.path.join(self.directory, 'browserid-1.json'), 'w').write('{')
+
+        with patch('django_browserid.metrics.logger') as logger:
+            snapshot, gauges = metrics.read_metrics_dir(self.directory)
+        self.assertTrue(logger.warning.called)
+
+        self.assertEqual(snapshot.counters, {'login.success': 5, 'login.failure': 1})
+        self.assertEqual(snapshot.histograms['verification.duration'].count, 2)
+        # Gauges of processes that no longer exist are dropped.
+        self.assertEqual(gauges, {os.getpid(): {'circuit.open': 1}})
+
+    def test_file_sink_accumulates(self):
+        sink = metrics.FileSink(self.directory)
+        sink.send(metrics.Snapshot({'login.success': 1}))
+        sink.send(metrics.Snapshot({'login.success': 2}))
+
+        self.assertEqual(os.listdir(self.directory), ['browserid-{0}.json'.format(os.getpid())])
+        snapshot, gauges = metrics.read_metrics_dir(self.directory)
+        self.assertEqual(snapshot.counters, {'login.success': 3})
+
+    def test_no_directory(self):
+        with self.settings(BROWSERID_METRICS_DIR=None):
+            with self.assertRaises(ImproperlyConfigured):
+                metrics.FileSink()
+
+    def test_render_prometheus(self):
+        """Rendering should flush this process's metrics and include all processes."""
+        self.write(12345678, {'login.success': 3})
+        with self.settings(BROWSERID_METRICS=True, BROWSERID_METRICS_DIR=self.directory):
+            self.assertTrue(isinstance(metrics.get_registry().sink, metrics.FileSink))
+            metrics.incr('login.success')
+            output = metrics.render_prometheus()
+        self.assertTrue('\nbrowserid_login_success_total 4\n' in output)
+        self.assertTrue('browserid_verification_duration_seconds_count 1\n' in output)
+
+    def test_render_prometheus_sink(self):
+        """A configured PrometheusSink should be flushed and rendered."""
+        with self.settings(BROWSERID_METRICS=True,
+                           BROWSERID_METRICS_SINK='django_browserid.metrics.PrometheusSink'):
+            sink = metrics.get_registry().sink
+            sink.send(metrics.Snapshot({'login.success': 2}))
+            metrics.incr('login.success')
+            with patch.object(sink, 'render', wraps=sink.render) as render:
+                output = metrics.render_prometheus()
+            self.assertTrue(render.called)
+        self.assertTrue('\nbrowserid_login_success_total 3\n' in output)
+
+    def test_render_prometheus_single_process(self):
+        with self.settings(BROWSERID_METRICS=True, BROWSERID_CIRCUIT_BREAKER=True):
+            metrics.incr('login.failure')
+            output = metrics.render_prometheus()
+        self.assertTrue('browserid_login_failure_total 1\n' in output)
+        self.assertTrue('browserid_circuit_open{{pid="{0}"}} 0\n'.format(os.getpid()) in output)
+
+
+class GaugeTests(TestCase):
+    def test_circuit_breaker_disabled(self):
+        with self.settings(BROWSERID_CIRCUIT_BREAKER=False):
+            self.assertEqual(metrics.collect_gauges(), {})
+
+    def test_circuit_breaker(self):
+        with self.settings(BROWSERID_CIRCUIT_BREAKER=True):
+            get_circuit_breaker()._open(time.time())
+            gauges = metrics.collect_gauges()
+        self.assertEqual(gauges['circuit.open'], 1)
+        self.assertEqual(gauges['circuit.half_open'], 0)
+
+    def test_format_gauges(self):
+        output = metrics.format_prometheus(metrics.Snapshot(), gauges={
+            2: {'circuit.open': 0},
+            1: {'circuit.open': 1},
+        })
+        self.assertEqual(output, '# TYPE browserid_circuit_open gauge\n'
+                                 'browserid_circuit_open{pid="1"} 1\n'
+                                 'browserid_circuit_open{pid="2"} 0\n')
@@ -0,0 +1,160 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+from django.core.cache import caches
+
+from mock import Mock, patch
+
+from django_browserid.replay import (BloomFilter, CacheReplayStore, get_remaining_lifetime,
+                                     get_replay_store, mark_assertion_used, MemoryReplayStore)
+from django_browserid.tests import TestCase
+
+
+class BloomFilterTests(TestCase):
+    def test_no_false_negatives(self):
+        bloom_filter = BloomFilter(capacity=1000, error_rate=0.01)
+        keys = [str(i) for i in range(1000)]
+        for key in keys:
+            bloom_filter.add(key)
+        self.assertTrue(all(key in bloom_filter for key in keys))
+        self.assertEqual(bloom_filter.count, 1000)
+
+    def test_error_rate(self):
+        bloom_filter = BloomFilter(capacity=1000, error_rate=0.01)
+        for i in range(1000):
+            bloom_filter.add(str(i))
+        false_positives = sum(str(i) in bloom_filter for i in range(1000, 11000))
+        self.assertTrue(false_positives < 300)
+
+    def test_size(self):
+        """The filter's size should only depend on its capacity."""
+        self.assertEqual(len(BloomFilter(capacity=10000, error_rate=1e-6).bits), 35944)
+
+
+class MemoryReplayStoreTests(TestCase):
+    def setUp(self):
+        self.store = MemoryReplayStore(max_age=300, bucket_seconds=30, capacity=100)
+
+        patcher = patch('django_browserid.replay.time.time', return_value=1000)
+        self.time = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_add(self):
+        self.assertTrue(self.store.add('a', 60))
+        self.assertFalse(self.store.add('a', 60))
+        self.assertTrue(self.store.add('b', 60))
+
+    def test_expiry(self):
+        """Keys should be forgotten after their timeout."""
+        self.store.add('a', 60)
+        self.time.return_value = 1059
+        self.assertFalse(self.store.add('a', 60))
+        self.time.return_value = 1080
+        self.assertTrue(self.store.add('a', 60))
+
+    @patch('django_browserid.replay.logger')
+    def test_max_age(self, logger):
+        """
+        Keys that would outlive max_age should be rejected, since they could
+        be replayed once forgotten. Keys without a timeout should be kept
+        for max_age.
+        """
+        self.assertFalse(self.store.add('a', 10000))
+        self.assertTrue(logger.warning.called)
+        self.assertTrue(self.store.add('b'))
+        self.time.return_value = 1299
+        self.assertFalse(self.store.add('b', 60))
+        self.time.return_value = 1330
+        self.assertTrue(self.store.add('b', 60))
+
+    def test_bounded(self):
+        """
+        The number of filters should be bounded by max_age, whatever the
+        number of keys.
+        """
+        for i in range(5000):
+            self.time.return_value = 1000 + i
+            self.store.add(str(i), 300)
+        self.assertTrue(len(self.store) <= 12)
+
+    @patch('django_browserid.replay.logger')
+    def test_over_capacity(self, logger):
+        for i in range(101):
+            self.store.add(str(i), 60)
+        self.assertTrue(logger.warning.called)
+
+
+class CacheReplayStoreTests(TestCase):
+    def test_add(self):
+        store = CacheReplayStore('default', max_age=300)
+        self.addCleanup(caches['default'].clear)
+
+        with patch.object(store.cache, 'add', wraps=store.cache.add) as add:
+            self.assertTrue(store.add('a', 60.5))
+            add.assert_called_with('browserid:replay:a', 1, 61)
+            self.assertFalse(store.add('a', 60))
+
+            add.reset_mock()
+            with patch('django_browserid.replay.logger'):
+                self.assertFalse(store.add('b', 10000))
+            self.assertFalse(add.called)
+            store.add('b')
+            add.assert_called_with('browserid:replay:b', 1, 300)
+            store.add('c', 0)
+            add.assert_called_with('browserid:replay:c', 1, 1)
+
+
+class GetReplayStoreTests(TestCase):
+    def test_disabled(self):
+        self.assertEqual(get_replay_store(), None)
+        self.assertTrue(mark_assertion_used('asdf', 'qwer'))
+        self.assertTrue(mark_assertion_used('asdf', 'qwer'))
+
+    def test_memory(self):
+        with self.settings(BROWSERID_REPLAY_PROTECTION=True, BROWSERID_REPLAY_MAX_AGE=60):
+            store = get_replay_store()
+            self.assertTrue(isinstance(store, MemoryReplayStore))
+            self.assertEqual(store.max_age, 60)
+            self.assertTrue(get_replay_store() is store)
+
+    def test_cache(self):
+        with self.settings(BROWSERID_REPLAY_PROTECTION=True,
+                           BROWSERID_REPLAY_CACHE_ALIAS='default'):
+            self.assertTrue(isinstance(get_replay_store(), CacheReplayStore))
+
+    def test_custom(self):
+        with self.settings(BROWSERID_REPLAY_PROTECTION=True,
+                           BROWSERID_REPLAY_STORE='django_browserid.replay.MemoryReplayStore',
+                           BROWSERID_REPLAY_CACHE_ALIAS='default'):
+            self.assertTrue(isinstance(get_replay_store(), MemoryReplayStore))
+
+    def test_mark_assertion_used(self):
+        with self.settings(BROWSERID_REPLAY_PROTECTION=True):
+            self.assertTrue(mark_assertion_used('asdf', 'qwer'))
+            self.assertFalse(mark_assertion_used('asdf', 'qwer'))
+            self.assertTrue(mark_assertion_used('asdf', 'other'))
+
+    @patch('django_browserid.replay.time.time', return_value=1000)
+    def test_mark_assertion_used_long_lived(self, time):
+        """
+        Assertions that expire after BROWSERID_REPLAY_MAX_AGE should be
+        rejected.
+        """
+        with self.settings(BROWSERID_REPLAY_PROTECTION=True):
+            with patch('django_browserid.replay.logger'):
+                result = Mock(_response={'expires': '1301000'})
+                self.assertFalse(mark_assertion_used('asdf', 'qwer', result))
+            result = Mock(_response={'expires': '1300000'})
+            self.assertTrue(mark_assertion_used('asdf', 'qwer', result))
+
+
+class GetRemainingLifetimeTests(TestCase):
+    @patch('django_browserid.replay.time.time', return_value=1000)
+    def test_expires(self, time):
+        self.assertEqual(get_remaining_lifetime(Mock(_response={'expires': '1060000'})), 60)
+        self.assertEqual(get_remaining_lifetime(Mock(_response={'expires': '900000'})), 0)
+
+    def test_unknown(self):
+        self.assertEqual(get_remaining_lifetime(None), None)
+        self.assertEqual(get_remaining_lifetime(Mock(_response={})), None)
+        self.assertEqual(get_remaining_lifetime(Mock(_response={'expires': 'asdf'})), None)
@@ -0,0 +1,178 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+import socket
+
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.utils.six import StringIO
+
+import requests
+from mock import patch
+
+from django_browserid.base import RemoteVerifier
+from django_browserid.standin import check_assertion, mint_assertion, StandInServer
+from django_browserid.tests import TestCase
+
+
+class AssertionTests(TestCase):
+    def test_round_trip(self):
+        assertion = mint_assertion('a@example.com', 'secret', audience='http://testserver')
+        result = check_assertion(assertion, 'http://testserver', 'secret')
+        self.assertEqual(result['status'], 'okay')
+        self.assertEqual(result['email'], 'a@example.com')
+        self.assertEqual(result['audience'], 'http://testserver')
+
+    def test_any_audience(self):
+        assertion = mint_assertion('a@example.com', 'secret')
+        self.assertEqual(check_assertion(assertion, 'http://other', 'secret')['status'], 'okay')
+
+    def test_failures(self):
+        assertion = mint_assertion('a@example.com', 'secret', audience='http://testserver')
+        with patch('django_browserid.standin.time.time', return_value=0):
+            expired = mint_assertion('a@example.com', 'secret')
+
+        for assertion, audience, reason in (
+                (assertion, 'http://other', 'audience mismatch'),
+                (assertion + 'x', 'http://testserver', 'bad signature'),
+                (expired, 'http://testserver', 'assertion has expired'),
+                ('asdf', 'http://testserver', 'malformed assertion'),
+                ('a.b', 'http://testserver', 'malformed assertion'),
+                (assertion, None, 'need assertion and audience')):
+            self.assertEqual(check_assertion(assertion, audience, 'secret'),
+                             {'status': 'failure', 'reason': reason})
+
+    def test_emails(self):
+        result = check_assertion('a@example.com', 'http://testserver', 'secret')
+        self.assertEqual(result['email'], 'a@example.com')
+        result = check_assertion('a@example.com', 'http://testserver', 'secret',
+                                 accept_emails=False)
+        self.assertEqual(result['status'], 'failure')
+
+
+class StandInServerTests(TestCase):
+    def start(self, **kwargs):
+        server = StandInServer(secret='secret', **kwargs).start()
+        self.addCleanup(server.stop)
+        return server
+
+    def verify(self, server, assertion):
+        with self.settings(BROWSERID_VERIFICATION_URLS=[server.url]):
+            return RemoteVerifier().verify(assertion, 'http://testserver')
+
+    def test_verify(self):
+        server = self.start(accept_emails=False)
+        result = self.verify(server, server.mint_assertion('a@example.com'))
+        self.assertTrue(result)
+        self.assertEqual(result.email, 'a@example.com')
+        self.assertFalse(self.verify(server, 'a@example.com'))
+
+    def test_mint(self):
+        server = self.start()
+        response = requests.post(server.url.replace('/verify', '/mint'),
+                                 data={'email': 'b@example.com'})
+        self.assertEqual(self.verify(server, response.text).email, 'b@example.com')
+
+    def test_json_request(self):
+        server = self.start()
+        response = requests.post(server.url, json={'assertion': 'a@example.com',
+                                                   'audience': 'http://testserver'})
+        self.assertEqual(response.json()['email'], 'a@example.com')
+
+    def test_bad_ttl(self):
+        """A ttl that isn't an integer should be rejected with a 400."""
+        server = self.start()
+        response = requests.post(server.url.replace('/verify', '/mint'),
+                                 data={'email': 'b@example.com', 'ttl': 'soon'})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['status'], 'failure')
+
+    def test_bad_assertion_type(self):
+        """An assertion that isn't a string should be rejected with a 400."""
+        server = self.start()
+        for assertion in (5, ['a@example.com']):
+            response = requests.post(server.url, json={'assertion': assertion,
+                                                       'audience': 'http://testserver'})
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.json()['status'], 'failure')
+
+    def test_malformed_requests(self):
+        """Malformed requests should be answered with a 400."""
+        server = self.start()
+        mint_url = server.url.replace('/verify', '/mint')
+        for url, kwargs in (
+                (mint_url, {'json': ['b@example.com']}),
+                (mint_url, {'json': {'email': ['b@example.com']}}),
+                (server.url, {'json': 'a@example.com'}),
+                (server.url, {'data': b'assertion=\xff', 'headers': {
+                    'Content-Type': 'application/x-www-form-urlencoded'}}),
+                (server.url, {'data': b'{"assertion": "\xff"}', 'headers': {
+                    'Content-Type': 'application/json'}}),
+                (server.url, {'data': '{', 'headers': {'Content-Type': 'application/json'}})):
+            response = requests.post(url, **kwargs)
+            self.assertEqual(response.status_code, 400, kwargs)
+            self.assertEqual(response.json()['status'], 'failure')
+
+    def test_bad_content_length(self):
+        server = self.start()
+        sock = socket.create_connection(server.server_address)
+        self.addCleanup(sock.close)
+        sock.sendall(b'POST /verify HTTP/1.1\r\nHost: localhost\r\n'
+                     b'Content-Length: lots\r\n\r\n')
+        response = sock.makefile('rb').readline()
+        self.assertTrue(b' 400 ' in response)
+
+    def test_not_found(self):
+        server = self.start()
+        response = requests.post(server.url.replace('/verify', '/other'))
+        self.assertEqual(response.status_code, 404)
+
+    def test_errors(self):
+        server = self.start(error_rate=1)
+        with patch('django_browserid.base.logger'):
+            result = self.verify(server, 'a@example.com')
+        self.assertFalse(result)
+        self.assertTrue('Could not parse' in result.reason)
+
+    def test_malformed(self):
+        server = self.start(malformed_rate=1)
+        with patch('django_browserid.base.logger'):
+            result = self.verify(server, 'a@example.com')
+        self.assertFalse(result)
+        self.assertTrue('Could not parse' in result.reason)
+
+    @patch('django_browserid.standin.time.sleep')
+    def test_latency(self, sleep):
+        server = self.start(latency=0.01, slow_rate=1, slow_latency=0.02)
+        self.verify(server, 'a@example.com')
+        sleep.assert_called_with(0.02)
+
+
+class CommandTests(TestCase):
+    def test_mint(self):
+        stdout = StringIO()
+        call_command('browserid_verifier', mint='a@example.com', secret='secret',
+                     audience='http://testserver', stdout=stdout)
+        result = check_assertion(stdout.getvalue().strip(), 'http://testserver', 'secret')
+        self.assertEqual(result['email'], 'a@example.com')
+
+    def test_mint_requires_secret(self):
+        with self.assertRaises(CommandError) as cm:
+            call_command('browserid_verifier', mint='a@example.com')
+        self.assertEqual(str(cm.exception), '--mint requires --secret.')
+
+    @patch('django_browserid.management.commands.browserid_verifier.StandInServer')
+    def test_serve(self, StandInServer):
+        StandInServer.return_value.url = 'http://127.0.0.1:9000/verify'
+        StandInServer.return_value.serve_forever.side_effect = KeyboardInterrupt
+        stdout = StringIO()
+        call_command('browserid_verifier', port=9000, latency=20, error_rate=0.1, strict=True,
+                     stdout=stdout)
+
+        kwargs = StandInServer.call_args[1]
+        self.assertEqual(kwargs['port'], 9000)
+        self.assertEqual(kwargs['latency'], 0.02)
+        self.assertEqual(kwargs['error_rate'], 0.1)
+        self.assertFalse(kwargs['accept_emails'])
+        self.assertTrue(StandInServer.return_value.server_close.called)
+        self.assertTrue('http://127.0.0.1:9000/verify' in stdout.getvalue())
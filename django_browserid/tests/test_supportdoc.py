@@ -0,0 +1,211 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+import requests
+from mock import Mock, patch
+
+from django_browserid.compat import pybrowserid_found
+from django_browserid.tests import TestCase
+
+if pybrowserid_found:
+    from browserid.errors import ConnectionError, InvalidIssuerError
+    from django_browserid import supportdoc
+
+
+def _response(status_code=200, text='{"public-key": "key"}', **headers):
+    return Mock(spec=requests.Response, status_code=status_code, text=text, headers=headers)
+
+
+class PyBrowserIDTestCase(TestCase):
+    def setUp(self):
+        if not pybrowserid_found:
+            self.skipTest('PyBrowserID required for test but not installed.')
+
+
+class GetCacheTTLTests(PyBrowserIDTestCase):
+    def test_no_headers(self):
+        """If there are no caching headers, use the max TTL."""
+        self.assertEqual(supportdoc.get_cache_ttl(_response(), 3600), 3600)
+
+    def test_max_age(self):
+        response = _response(**{'Cache-Control': 'public, max-age=120'})
+        self.assertEqual(supportdoc.get_cache_ttl(response, 3600), 120)
+
+        # Never cache for longer than the max TTL.
+        self.assertEqual(supportdoc.get_cache_ttl(response, 60), 60)
+
+    def test_no_cache(self):
+        for value in ('no-cache', 'no-store', 'private, no-cache, max-age=100'):
+            response = _response(**{'Cache-Control': value})
+            self.assertEqual(supportdoc.get_cache_ttl(response, 3600), 0)
+
+    def test_expires(self):
+        response = _response(Date='Mon, 01 Jan 2024 00:00:00 GMT',
+                             Expires='Mon, 01 Jan 2024 00:05:00 GMT')
+        self.assertEqual(supportdoc.get_cache_ttl(response, 3600), 300)
+
+        response = _response(Date='Mon, 01 Jan 2024 00:00:00 GMT',
+                             Expires='Sun, 31 Dec 2023 00:00:00 GMT')
+        self.assertEqual(supportdoc.get_cache_ttl(response, 3600), 0)
+
+
+class CachingSupportDocumentManagerTests(PyBrowserIDTestCase):
+    def setUp(self):
+        super(CachingSupportDocumentManagerTests, self).setUp()
+        self.manager = supportdoc.CachingSupportDocumentManager(max_ttl=3600, stale_ttl=300)
+
+        patcher = patch.object(self.manager, 'fetch_support_document')
+        self.fetch = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.fetch.return_value = ({'public-key': 'key'}, 60)
+
+        patcher = patch('django_browserid.supportdoc.time.time', return_value=1000)
+        self.time = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch('django_browserid.util.time.time', new=self.time)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_fresh(self):
+        """Fresh documents should be returned without fetching them again."""
+        self.assertEqual(self.manager.get_key('example.com'), 'key')
+        self.time.return_value = 1059
+        self.assertEqual(self.manager.get_key('example.com'), 'key')
+        self.assertEqual(self.fetch.call_count, 1)
+
+    def test_stale_while_revalidate(self):
+        """
+        Expired documents within the stale TTL should be returned right away
+        while they are refreshed in the background.
+        """
+        self.manager.get_key('example.com')
+        self.time.return_value = 1100
+        self.fetch.return_value = ({'public-key': 'newkey'}, 60)
+
+        with patch('django_browserid.supportdoc.threading.Thread') as Thread:
+            self.assertEqual(self.manager.get_key('example.com'), 'key')
+            # A refresh that is already running shouldn't be started twice.
+            self.assertEqual(self.manager.get_key('example.com'), 'key')
+        self.assertEqual(Thread.call_count, 1)
+        self.assertEqual(self.fetch.call_count, 1)
+
+        # Run the refresh.
+        Thread.call_args[1]['target'](*Thread.call_args[1]['args'])
+        self.assertEqual(self.manager.get_key('example.com'), 'newkey')
+        self.assertEqual(self.fetch.call_count, 2)
+        self.assertEqual(self.manager._refreshing, set())
+
+    def test_refresh_error(self):
+        """If a background refresh fails, keep the stale document."""
+        self.manager.get_key('example.com')
+        self.fetch.side_effect = ConnectionError()
+        self.time.return_value = 1100
+        self.manager._refresh('example.com')
+        self.assertEqual(self.manager.cache.get('example.com')[2],
+                         {'public-key': 'key'})
+
+    def test_not_cacheable(self):
+        """Documents with a TTL of 0 should be fetched on every use."""
+        self.fetch.return_value = ({'public-key': 'key'}, 0)
+        self.assertEqual(self.manager.get_key('example.com'), 'key')
+        self.assertEqual(self.manager.cache.get('example.com'), None)
+
+        self.fetch.return_value = ({'public-key': 'newkey'}, 0)
+        with patch('django_browserid.supportdoc.threading.Thread') as Thread:
+            self.assertEqual(self.manager.get_key('example.com'), 'newkey')
+        self.assertFalse(Thread.called)
+        self.assertEqual(self.fetch.call_count, 2)
+
+    def test_refresh_not_cacheable(self):
+        """A refresh returning a TTL of 0 should drop the stale document."""
+        self.manager.get_key('example.com')
+        self.time.return_value = 1100
+        self.fetch.return_value = ({'public-key': 'newkey'}, 0)
+        self.manager._refresh('example.com')
+        self.assertEqual(self.manager.cache.get('example.com'), None)
+
+    def test_too_stale(self):
+        """Documents past the stale TTL should be fetched synchronously."""
+        self.manager.get_key('example.com')
+        self.time.return_value = 1000 + 60 + 300
+        self.fetch.return_value = ({'public-key': 'newkey'}, 60)
+        self.assertEqual(self.manager.get_key('example.com'), 'newkey')
+
+    def test_errors_cached(self):
+        """Errors should be cached for error_ttl seconds and then retried."""
+        error = InvalidIssuerError()
+        self.fetch.side_effect = error
+        for i in range(2):
+            with self.assertRaises(InvalidIssuerError):
+                self.manager.get_support_document('example.com')
+        self.assertEqual(self.fetch.call_count, 1)
+
+        self.time.return_value = 1000 + self.manager.error_ttl
+        self.fetch.side_effect = None
+        self.assertEqual(self.manager.get_key('example.com'), 'key')
+
+    def test_max_size(self):
+        manager = supportdoc.CachingSupportDocumentManager(max_size=2)
+        with patch.object(manager, 'fetch_support_document', return_value=({}, 60)):
+            for hostname in ('a.com', 'b.com', 'c.com'):
+                manager.get_support_document(hostname)
+        self.assertEqual(len(manager.cache), 2)
+
+
+class FetchSupportDocumentTests(PyBrowserIDTestCase):
+    def setUp(self):
+        super(FetchSupportDocumentTests, self).setUp()
+        self.manager = supportdoc.CachingSupportDocumentManager(max_ttl=3600)
+
+        patcher = patch('django_browserid.supportdoc.get_session')
+        self.get = patcher.start().return_value.get
+        self.addCleanup(patcher.stop)
+
+    def test_well_known(self):
+        self.get.return_value = _response(**{'Cache-Control': 'max-age=100'})
+        self.assertEqual(self.manager.fetch_support_document('example.com'),
+                         ({'public-key': 'key'}, 100))
+        self.assertEqual(self.get.call_args[0][0], 'https://example.com/.well-known/browserid')
+
+    def test_pk_fallback(self):
+        """If there is no support document, fall back to /pk."""
+        self.get.side_effect = [_response(status_code=404), _response(text='"key"')]
+        self.assertEqual(self.manager.fetch_support_document('example.com'),
+                         ({'public-key': 'key'}, 3600))
+        self.assertEqual(self.get.call_args[0][0], 'https://example.com/pk')
+
+    def test_not_supported(self):
+        self.get.return_value = _response(status_code=404)
+        with self.assertRaises(InvalidIssuerError):
+            self.manager.fetch_support_document('example.com')
+
+    def test_malformed(self):
+        self.get.return_value = _response(text='{asdf')
+        with self.assertRaises(InvalidIssuerError):
+            self.manager.fetch_support_document('example.com')
+
+    def test_connection_error(self):
+        self.get.side_effect = requests.exceptions.ConnectionError()
+        with self.assertRaises(ConnectionError):
+            self.manager.fetch_support_document('example.com')
+
+
+class GetSupportDocumentManagerTests(PyBrowserIDTestCase):
+    def test_shared(self):
+        """The manager should be shared and configured from settings."""
+        with self.settings(BROWSERID_SUPPORT_DOCUMENT_MAX_TTL=10,
+                           BROWSERID_SUPPORT_DOCUMENT_STALE_TTL=20,
+                           BROWSERID_SUPPORT_DOCUMENT_CACHE_SIZE=30):
+            manager = supportdoc.get_support_document_manager()
+            self.assertTrue(supportdoc.get_support_document_manager() is manager)
+            self.assertEqual(manager.max_ttl, 10)
+            self.assertEqual(manager.stale_ttl, 20)
+            self.assertEqual(manager.cache.max_size, 30)
+
+        self.assertTrue(supportdoc.get_support_document_manager() is not manager)
+
+    def test_local_verifier(self):
+        """LocalVerifier should use the shared manager."""
+        from django_browserid.base import LocalVerifier
+        self.assertTrue(LocalVerifier().pybid_verifier.supportdocs is
+                        supportdoc.get_support_document_manager())
@@ -0,0 +1,141 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+from django.contrib.auth.models import User
+from django.test.client import RequestFactory
+
+from mock import patch
+
+from django_browserid import timing, views
+from django_browserid.tests import mock_browserid, TestCase
+
+
+collector = timing.MemoryCollector()
+
+
+def broken_hook(trace):
+    raise ValueError()
+
+
+class TimingTests(TestCase):
+    def setUp(self):
+        collector.clear()
+
+    def test_disabled(self):
+        """Without a hook, nothing should be timed."""
+        with timing.trace('test') as trace:
+            with timing.phase('phase') as phase:
+                phase.outcome = 'failure'
+        self.assertTrue(trace is phase is timing._null_phase)
+        self.assertEqual(phase.outcome, None)
+
+    def test_unbound_trace(self):
+        """
+        Unbound traces should only record phases timed with their own phase
+        method, or by functions run with their call method.
+        """
+        def login():
+            with timing.phase('login'):
+                return 'user'
+
+        with self.settings(BROWSERID_TIMING_HOOK='django_browserid.tests.test_timing.collector'):
+            with timing.trace('test', bind=False) as trace:
+                self.assertTrue(timing.phase('phase') is timing._null_phase)
+                with trace.phase('verify'):
+                    pass
+                self.assertEqual(trace.call(login), 'user')
+            self.assertTrue(timing.phase('phase') is timing._null_phase)
+
+        self.assertEqual(list(collector.traces), [trace])
+        self.assertEqual([phase.name for phase in trace.phases], ['verify', 'login'])
+
+    def test_phase_outside_trace(self):
+        with self.settings(BROWSERID_TIMING_HOOK='django_browserid.tests.test_timing.collector'):
+            self.assertTrue(timing.phase('phase') is timing._null_phase)
+
+    def test_trace(self):
+        with self.settings(BROWSERID_TIMING_HOOK='django_browserid.tests.test_timing.collector'):
+            with timing.trace('test') as trace:
+                with timing.phase('outer'):
+                    with timing.phase('inner') as phase:
+                        phase.outcome = 'failure'
+                with self.assertRaises(ValueError):
+                    with timing.phase('broken'):
+                        raise ValueError()
+
+        self.assertEqual(list(collector.traces), [trace])
+        self.assertEqual([(phase.name, phase.outcome) for phase in trace.phases],
+                         [('inner', 'failure'), ('outer', 'ok'), ('broken', 'error')])
+        self.assertTrue(trace.duration >= trace.phases[1].duration >= trace.phases[0].duration)
+        self.assertEqual(timing.phase('phase'), timing._null_phase)
+
+    @patch('django_browserid.timing.logger')
+    def test_broken_hook(self, logger):
+        """Errors in the hook should be logged rather than raised."""
+        with self.settings(BROWSERID_TIMING_HOOK='django_browserid.tests.test_timing.broken_hook'):
+            with timing.trace('test'):
+                pass
+        self.assertTrue(logger.exception.called)
+
+    def test_summary(self):
+        with self.settings(BROWSERID_TIMING_HOOK='django_browserid.tests.test_timing.collector'):
+            for outcome in ('ok', 'failure', 'ok'):
+                with timing.trace('test') as trace:
+                    trace.outcome = outcome
+                    with timing.phase('phase'):
+                        pass
+
+        summary = collector.summary()
+        self.assertEqual(sorted(summary), ['phase', 'test'])
+        self.assertEqual(summary['test']['count'], 3)
+        self.assertEqual(summary['test']['outcomes'], {'ok': 2, 'failure': 1})
+        self.assertEqual(summary['phase']['outcomes'], {'ok': 3})
+        self.assertTrue(summary['test']['max'] <= summary['test']['total'])
+
+
+class VerifyTimingTests(TestCase):
+    def setUp(self):
+        collector.clear()
+
+    def verify(self, email):
+        request = RequestFactory().post('/browserid/login/', {'assertion': 'asdf'})
+        with self.settings(BROWSERID_TIMING_HOOK='django_browserid.tests.test_timing.collector'):
+            with mock_browserid(email), patch('django_browserid.views.auth.login'):
+                return views.Verify.as_view()(request)
+
+    def phases(self):
+        trace, = collector.traces
+        return trace.outcome, [(phase.name, phase.outcome) for phase in trace.phases]
+
+    def test_new_user(self):
+        self.verify('new@example.com')
+        self.assertEqual(self.phases(), ('success', [
+            ('get_audience', 'ok'),
+            ('verify', 'ok'),
+            ('replay_check', 'ok'),
+            ('get_users', 'ok'),
+            ('create_user', 'ok'),
+            ('user_created', 'ok'),
+            ('authenticate', 'ok'),
+            ('login', 'ok'),
+        ]))
+
+    def test_existing_user(self):
+        User.objects.create_user('existing', 'existing@example.com')
+        self.verify('existing@example.com')
+        self.assertEqual(self.phases(), ('success', [
+            ('get_audience', 'ok'),
+            ('verify', 'ok'),
+            ('replay_check', 'ok'),
+            ('get_users', 'ok'),
+            ('authenticate', 'ok'),
+            ('login', 'ok'),
+        ]))
+
+    def test_failure(self):
+        self.verify(None)
+        self.assertEqual(self.phases(), ('failure', [
+            ('get_audience', 'ok'),
+            ('verify', 'failure'),
+            ('authenticate', 'ok'),
+        ]))
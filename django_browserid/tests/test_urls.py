@@ -30,3 +30,15 @@ class UrlTests(TestCase):
 
         # Reset urls back to normal.
         reload_module(urls)
+
+    def test_metrics_view(self):
+        """The metrics view should only be routed if BROWSERID_METRICS_VIEW is True."""
+        self.assertFalse('browserid.metrics' in [p.name for p in urls.urlpatterns])
+        with self.settings(BROWSERID_METRICS_VIEW=True):
+            reload_module(urls)
+
+        pattern, = [p for p in urls.urlpatterns if p.name == 'browserid.metrics']
+        self.assertEqual(pattern.callback.__name__, 'Metrics')
+        self.assertEqual(pattern.resolve('browserid/metrics/').url_name, 'browserid.metrics')
+
+        reload_module(urls)
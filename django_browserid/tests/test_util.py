@@ -1,12 +1,19 @@
 import json
 
 from django.core.exceptions import ImproperlyConfigured
+from django.middleware.csrf import get_token, rotate_token
+from django.test.client import RequestFactory
 from django.test.utils import override_settings
 from django.utils import six
 from django.utils.functional import lazy
 
+from mock import Mock, patch
+
 from django_browserid.tests import TestCase
-from django_browserid.util import import_from_setting, LazyEncoder, same_origin
+from django_browserid import util
+from django_browserid.util import (assertion_digest, get_csrf_token, import_from_setting,
+                                   json_dumps, LazyEncoder, LRUCache, origin,
+                                   resolve_promises, same_origin)
 
 
 def _lazy_string():
@@ -21,6 +28,75 @@ class TestLazyEncoder(TestCase):
         self.assertEqual('["foo", "blah"]', thing_json)
 
 
+def bytes_json_dumps(data):
+    return json.dumps(data, sort_keys=True).encode('utf-8')
+
+
+class JSONDumpsTests(TestCase):
+    def test_resolve_promises(self):
+        data = {lazy_string: ['foo', lazy_string, (1, {'a': lazy_string})], 'b': None}
+        resolved = resolve_promises(data)
+        self.assertEqual(resolved, {'blah': ['foo', 'blah', [1, {'a': 'blah'}]], 'b': None})
+        self.assertTrue(isinstance(resolved['blah'][1], six.text_type))
+
+    def test_lazy(self):
+        self.assertEqual(json.loads(json_dumps(['foo', lazy_string])), ['foo', 'blah'])
+
+    def test_default_single_pass(self):
+        """
+        The default serializer should resolve Promises while encoding,
+        instead of copying the data first.
+        """
+        with patch('django_browserid.util.resolve_promises') as resolve_promises:
+            self.assertEqual(json.loads(json_dumps({'a': [lazy_string]})), {'a': ['blah']})
+        self.assertFalse(resolve_promises.called)
+
+    def test_orjson(self):
+        """
+        orjson should be used if installed, falling back to json for data it
+        doesn't support.
+        """
+        orjson = Mock()
+        orjson.dumps.return_value = b'[1]'
+        with patch('django_browserid.util.orjson', orjson):
+            self.assertEqual(json_dumps([1]), '[1]')
+            orjson.dumps.side_effect = TypeError
+            self.assertEqual(json_dumps({1: 2}), '{"1": 2}')
+
+    def test_matches_lazy_encoder(self):
+        data = {'email': 'a@example.com', 'redirect': lazy_string, 'count': 2}
+        self.assertEqual(json.loads(json_dumps(data)),
+                         json.loads(json.dumps(data, cls=LazyEncoder)))
+
+    def test_unserializable(self):
+        with self.assertRaises(TypeError):
+            json_dumps({'a': object()})
+
+    def test_custom_serializer(self):
+        """
+        BROWSERID_JSON_SERIALIZER should be used with resolved data, and
+        bytes output should be decoded.
+        """
+        path = 'django_browserid.tests.test_util.bytes_json_dumps'
+        with self.settings(BROWSERID_JSON_SERIALIZER=path):
+            output = json_dumps({'b': lazy_string, 'a': 1})
+        self.assertEqual(output, u'{"a": 1, "b": "blah"}')
+        self.assertTrue(isinstance(output, six.text_type))
+        self.assertEqual(util.get_json_serializer(), util.default_json_dumps)
+
+
+class GetCsrfTokenTests(TestCase):
+    def test_session_csrf(self):
+        request = RequestFactory().get('/')
+        request.csrf_token = 'asdf'
+        self.assertEqual(get_csrf_token(request), 'asdf')
+
+    def test_django_csrf(self):
+        request = RequestFactory().get('/')
+        rotate_token(request)
+        self.assertEqual(get_csrf_token(request), get_token(request))
+
+
 import_value = 1
 
 
@@ -77,3 +153,89 @@ class SameOriginTests(TestCase):
         self.assertFalse(same_origin('http://example.com', 'http://example.org'))
         self.assertFalse(same_origin('https://example.com', 'http://example.com'))
         self.assertFalse(same_origin('http://example.com:443', 'http://example.com:80'))
+
+    def test_default_port(self):
+        self.assertTrue(same_origin('http://example.com', 'http://example.com:80'))
+        self.assertTrue(same_origin('https://example.com:443/path', 'https://example.com'))
+        self.assertFalse(same_origin('https://example.com:80', 'https://example.com'))
+
+
+class OriginTests(TestCase):
+    def test_origin(self):
+        self.assertEqual(origin('https://Example.com/path?query#fragment'),
+                         ('https', 'example.com', 443))
+        self.assertEqual(origin('http://example.com'), ('http', 'example.com', 80))
+        self.assertEqual(origin('http://example.com:8000'), ('http', 'example.com', 8000))
+        self.assertEqual(origin('ftp://example.com'), ('ftp', 'example.com', None))
+
+    def test_memoized(self):
+        """Repeated URLs should only be parsed once."""
+        url = 'http://memoized.example.com'
+        with patch('django_browserid.util.urlparse', wraps=util.urlparse) as urlparse:
+            origin(url)
+            origin(url)
+        self.assertEqual(urlparse.call_count, 1)
+
+    def test_bounded(self):
+        """Only ORIGIN_CACHE_SIZE URLs should be remembered."""
+        urls = ['http://{0}.example.com'.format(i) for i in range(util.ORIGIN_CACHE_SIZE + 1)]
+        for url in urls:
+            origin(url)
+        with patch('django_browserid.util.urlparse', wraps=util.urlparse) as urlparse:
+            origin(urls[0])
+        self.assertEqual(urlparse.call_count, 1)
+
+
+class AssertionDigestTests(TestCase):
+    def test_audience(self):
+        """The digest should depend on both the assertion and audience."""
+        digest = assertion_digest('asdf', 'http://example.com')
+        self.assertEqual(digest, assertion_digest('asdf', 'http://example.com'))
+        self.assertNotEqual(digest, assertion_digest('asdf', 'http://example.org'))
+        self.assertNotEqual(digest, assertion_digest('qwer', 'http://example.com'))
+        self.assertNotEqual(digest, assertion_digest('asdf'))
+
+
+class LRUCacheTests(TestCase):
+    def test_get_set(self):
+        cache = LRUCache()
+        self.assertEqual(cache.get('foo'), None)
+        self.assertEqual(cache.get('foo', 'default'), 'default')
+        cache.set('foo', 'bar')
+        self.assertEqual(cache.get('foo'), 'bar')
+
+    def test_evict_least_recently_used(self):
+        """When full, evict the item that was used least recently."""
+        cache = LRUCache(max_size=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('c'), 3)
+
+    @patch('django_browserid.util.time.time')
+    def test_timeout(self, time):
+        """Items should not be returned once their timeout has passed."""
+        cache = LRUCache()
+        time.return_value = 100
+        cache.set('foo', 'bar', 10)
+
+        time.return_value = 109
+        self.assertEqual(cache.get('foo'), 'bar')
+        time.return_value = 110
+        self.assertEqual(cache.get('foo'), None)
+        self.assertEqual(len(cache), 0)
+
+    def test_delete_clear(self):
+        cache = LRUCache()
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.delete('a')
+        cache.delete('missing')
+        self.assertEqual(cache.get('a'), None)
+        cache.clear()
+        self.assertEqual(len(cache), 0)
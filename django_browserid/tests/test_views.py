@@ -1,14 +1,15 @@
 # This Source Code Form is subject to the terms of the Mozilla Public
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
+from django.conf import settings
 from django.contrib import auth
 from django.middleware.csrf import get_token, rotate_token
-from django.test.client import RequestFactory
+from django.test.client import Client, RequestFactory
 from django.utils import six
 
 from mock import Mock, patch
 
-from django_browserid import views
+from django_browserid import helpers, views
 from django_browserid.tests import mock_browserid, TestCase
 
 
@@ -200,6 +201,39 @@ class VerifyTests(TestCase):
         _get_next.assert_called_with(view.request)
 
 
+class VerifyCsrfTests(TestCase):
+    """
+    Login requests should be protected against CSRF whether the JavaScript
+    fetched the token from the CsrfToken view or read it from the cookie.
+    """
+    def setUp(self):
+        self.client = Client(enforce_csrf_checks=True)
+
+    def _login(self, **headers):
+        with mock_browserid('a@example.com'), patch('django_browserid.views.auth.login'):
+            return self.client.post('/browserid/login/', {'assertion': 'asdf'}, **headers)
+
+    def test_no_token(self):
+        self.client.get('/browserid/csrf/')
+        response = self._login()
+        self.assertEqual(response.status_code, 403)
+        self.assertFalse(response['Content-Type'].startswith('application/json'))
+
+    def test_fetched_token(self):
+        token = self.client.get('/browserid/csrf/').content.decode('ascii')
+        response = self._login(HTTP_X_CSRFTOKEN=token)
+        self.assertEqual(response.status_code, 200)
+
+    def test_cookie_token(self):
+        request = RequestFactory().get('/')
+        with self.settings(BROWSERID_CSRF_COOKIE=True):
+            helpers.browserid_info(request)
+        self.client.cookies[settings.CSRF_COOKIE_NAME] = request.META['CSRF_COOKIE']
+
+        response = self._login(HTTP_X_CSRFTOKEN=request.META['CSRF_COOKIE'])
+        self.assertEqual(response.status_code, 200)
+
+
 class LogoutTests(TestCase):
     def setUp(self):
         self.factory = RequestFactory()
@@ -277,3 +311,45 @@ class CsrfTokenTests(TestCase):
         request = self.factory.get('/browserid/csrf/')
         response = self.view.get(request)
         self.assertTrue('max-age=0' in response['Cache-Control'])
+
+
+class MetricsViewTests(TestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.view = views.Metrics()
+
+    def get(self, **extra):
+        request = self.factory.get('/browserid/metrics/', **extra)
+        with patch('django_browserid.views.metrics.render_prometheus', return_value='metrics'):
+            return self.view.get(request)
+
+    def test_allowed_ip(self):
+        with self.settings(BROWSERID_METRICS_ALLOWED_IPS=['10.0.0.1']):
+            response = self.get(REMOTE_ADDR='10.0.0.1')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, b'metrics')
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        self.assertTrue('max-age=0' in response['Cache-Control'])
+
+    def test_default_allowed_ips(self):
+        """
+        No addresses, not even loopback ones, which proxied requests come
+        from, should be allowed unless configured.
+        """
+        self.assertEqual(self.get(REMOTE_ADDR='127.0.0.1').status_code, 403)
+        self.assertEqual(self.get(REMOTE_ADDR='::1').status_code, 403)
+        self.assertEqual(self.get(REMOTE_ADDR='10.0.0.1').status_code, 403)
+
+    def test_token(self):
+        with self.settings(BROWSERID_METRICS_TOKEN='secret'):
+            response = self.get(REMOTE_ADDR='10.0.0.1', HTTP_AUTHORIZATION='Bearer secret')
+            self.assertEqual(response.status_code, 200)
+            response = self.get(REMOTE_ADDR='10.0.0.1', HTTP_AUTHORIZATION='Bearer wrong')
+            self.assertEqual(response.status_code, 403)
+
+    def test_staff(self):
+        request = self.factory.get('/browserid/metrics/', REMOTE_ADDR='10.0.0.1')
+        request.user = Mock(is_staff=True)
+        self.assertTrue(self.view.is_allowed(request))
+        request.user = Mock(is_staff=False)
+        self.assertFalse(self.view.is_allowed(request))
@@ -0,0 +1,218 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+Per-phase timing of the login process.
+
+Each request to the :class:`django_browserid.views.Verify` view is recorded
+as a :class:`Trace` made up of :class:`Phase` timings, such as verifying the
+assertion or looking up the user, which is passed to the hook named by the
+BROWSERID_TIMING_HOOK setting. Without a hook, nothing is timed.
+"""
+import logging
+import threading
+import time
+from collections import deque
+
+from django.conf import settings
+from django.core.signals import setting_changed
+
+from django_browserid.util import import_from_setting
+
+
+logger = logging.getLogger(__name__)
+
+
+class Phase(object):
+    """
+    Timing of one phase of a login.
+
+    ``outcome`` is ``'ok'`` unless the phase raised an exception, in which
+    case it is ``'error'``, or the code being timed reported a different
+    outcome, such as ``'failure'`` for an assertion that didn't verify.
+    """
+    def __init__(self, trace, name):
+        self.trace = trace
+        self.name = name
+        self.outcome = 'ok'
+        self.duration = None
+
+    def __enter__(self):
+        self._start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.duration = time.time() - self._start
+        if exc_type is not None:
+            self.outcome = 'error'
+        self.trace.phases.append(self)
+
+    def __repr__(self):
+        return '<Phase {0} {1} {2:.6f}>'.format(self.name, self.outcome, self.duration or 0)
+
+
+class Trace(Phase):
+    """
+    Timing of a whole login, with the timings of its phases in ``phases``, in
+    the order they finished.
+
+    Unless ``bind`` is False, the trace is the current trace of its thread
+    while it runs, so that :func:`phase` records phases into it.
+    """
+    def __init__(self, hook, name, bind=True):
+        super(Trace, self).__init__(self, name)
+        self.hook = hook
+        self.bind = bind
+        self.phases = []
+
+    def __enter__(self):
+        if self.bind:
+            _local.trace = self
+        return super(Trace, self).__enter__()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.duration = time.time() - self._start
+        if exc_type is not None:
+            self.outcome = 'error'
+        if self.bind:
+            _local.trace = None
+        try:
+            self.hook(self)
+        except Exception:
+            # Timing must never break logins.
+            logger.exception('Error in BROWSERID_TIMING_HOOK.')
+
+    def phase(self, name):
+        """Return a context manager timing a phase of this trace."""
+        return Phase(self, name)
+
+    def call(self, func, *args, **kwargs):
+        """
+        Call ``func`` with this trace as the current trace of the calling
+        thread, so that the phases it times with :func:`phase` are recorded
+        into it.
+        """
+        previous = getattr(_local, 'trace', None)
+        _local.trace = self
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _local.trace = previous
+
+
+class NullPhase(object):
+    """Stands in for :class:`Phase` and :class:`Trace` when not timing."""
+    outcome = property(lambda self: None, lambda self, value: None)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+    def phase(self, name):
+        return self
+
+    def call(self, func, *args, **kwargs):
+        return func(*args, **kwargs)
+
+_null_phase = NullPhase()
+_local = threading.local()
+
+
+def phase(name):
+    """
+    Return a context manager timing a phase of the current login, if one is
+    being traced.
+    """
+    trace = getattr(_local, 'trace', None)
+    if trace is None:
+        return _null_phase
+    return Phase(trace, name)
+
+
+def trace(name, bind=True):
+    """
+    Return a context manager timing a login and passing the resulting
+    :class:`Trace` to the timing hook, if one is configured.
+
+    :param bind:
+        If False, don't make the trace the current trace of the thread.
+        Phases must then be timed with :meth:`Trace.phase` and
+        :meth:`Trace.call`. Asynchronous code, which runs several logins in
+        one thread, must not bind traces.
+    """
+    hook = get_timing_hook()
+    if hook is None:
+        return _null_phase
+    return Trace(hook, name, bind)
+
+
+_timing_hook = None
+_timing_hook_loaded = False
+
+
+def get_timing_hook():
+    """
+    Return the callable imported from the BROWSERID_TIMING_HOOK setting, or
+    None if the setting isn't set.
+    """
+    global _timing_hook, _timing_hook_loaded
+    if not _timing_hook_loaded:
+        if getattr(settings, 'BROWSERID_TIMING_HOOK', None):
+            _timing_hook = import_from_setting('BROWSERID_TIMING_HOOK')
+        else:
+            _timing_hook = None
+        _timing_hook_loaded = True
+    return _timing_hook
+
+
+def _reset_timing_hook(setting, **kwargs):
+    global _timing_hook_loaded
+    if setting == 'BROWSERID_TIMING_HOOK':
+        _timing_hook_loaded = False
+setting_changed.connect(_reset_timing_hook)
+
+
+class MemoryCollector(object):
+    """
+    Timing hook that keeps the most recent ``max_traces`` traces in memory
+    and summarizes them. Useful in tests and for debugging; point
+    BROWSERID_TIMING_HOOK at an instance of it.
+    """
+    def __init__(self, max_traces=1000):
+        self.traces = deque(maxlen=max_traces)
+        self._lock = threading.Lock()
+
+    def __call__(self, trace):
+        with self._lock:
+            self.traces.append(trace)
+
+    def clear(self):
+        with self._lock:
+            self.traces.clear()
+
+    def summary(self):
+        """
+        Return a dict mapping each phase name, and the name of the traces
+        themselves, to a dict with the number of times it was recorded, the
+        total and maximum duration in seconds, and a dict counting each
+        outcome.
+        """
+        with self._lock:
+            traces = list(self.traces)
+
+        summary = {}
+        for trace in traces:
+            for timing in [trace] + trace.phases:
+                stats = summary.setdefault(timing.name, {
+                    'count': 0,
+                    'total': 0.0,
+                    'max': 0.0,
+                    'outcomes': {},
+                })
+                stats['count'] += 1
+                stats['total'] += timing.duration
+                stats['max'] = max(stats['max'], timing.duration)
+                stats['outcomes'][timing.outcome] = stats['outcomes'].get(timing.outcome, 0) + 1
+        return summary
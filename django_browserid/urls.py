@@ -3,6 +3,7 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 import logging
 
+from django.conf import settings
 from django.conf.urls import url
 from django.core.exceptions import ImproperlyConfigured
 
@@ -27,3 +28,7 @@ urlpatterns = [
     url(r'^browserid/logout/$', views.Logout.as_view(), name='browserid.logout'),
     url(r'^browserid/csrf/$', views.CsrfToken.as_view(), name='browserid.csrf'),
 ]
+
+if getattr(settings, 'BROWSERID_METRICS_VIEW', False):
+    urlpatterns.append(
+        url(r'^browserid/metrics/$', views.Metrics.as_view(), name='browserid.metrics'))
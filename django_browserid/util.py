@@ -1,19 +1,38 @@
 # This Source Code Form is subject to the terms of the Mozilla Public
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
+import hashlib
 import json
 import sys
+import threading
+import time
+from collections import OrderedDict
 
 from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.middleware.csrf import get_token
+from django.utils import six
 from django.utils.functional import Promise
 from django.utils.six.moves.urllib.parse import urlparse
 
+from django_browserid.compat import lru_cache
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 try:
     from django.utils.encoding import force_unicode as force_text
 except ImportError:
     from django.utils.encoding import force_text  # Python 3
 
+try:
+    from django.utils.encoding import smart_bytes
+except ImportError:
+    from django.utils.encoding import smart_str as smart_bytes
+
 
 class LazyEncoder(json.JSONEncoder):
     """
@@ -26,6 +45,105 @@ class LazyEncoder(json.JSONEncoder):
         return super(LazyEncoder, self).default(obj)
 
 
+# Types that resolve_promises can return as-is without further checks.
+_plain_json_types = frozenset(six.string_types + six.integer_types +
+                              (six.text_type, bytes, float, bool, type(None)))
+
+
+def resolve_promises(obj):
+    """
+    Return a copy of obj with Promises, such as the results of ugettext_lazy
+    and reverse_lazy, in it or in any dicts, lists and tuples inside it
+    replaced by unicode strings. Other values are returned unchanged.
+    """
+    if obj.__class__ in _plain_json_types:
+        return obj
+    elif isinstance(obj, Promise):
+        return force_text(obj)
+    elif isinstance(obj, dict):
+        return {resolve_promises(key): resolve_promises(value) for key, value in obj.items()}
+    elif isinstance(obj, (list, tuple)):
+        return [resolve_promises(item) for item in obj]
+    return obj
+
+
+def _resolve_promise(obj):
+    if isinstance(obj, Promise):
+        return force_text(obj)
+    raise TypeError('{0!r} is not JSON serializable'.format(obj))
+
+
+# Shared encoder for default_json_dumps; encoders keep no per-call state.
+_lazy_encoder = LazyEncoder()
+
+
+def default_json_dumps(data):
+    """
+    Serialize data, which may contain Promises, to JSON. Uses orjson if it
+    is installed and supports the data, and otherwise a shared
+    :class:`LazyEncoder`. Promises are resolved as the encoder reaches
+    them, so data without any is serialized in a single pass.
+    """
+    if orjson is not None:
+        try:
+            return orjson.dumps(data, default=_resolve_promise)
+        except TypeError:
+            # orjson is stricter than json, e.g. about non-string keys.
+            pass
+    return _lazy_encoder.encode(data)
+
+
+_json_serializer = None
+
+
+def get_json_serializer():
+    """
+    Return the function used by :func:`json_dumps`, imported from the
+    BROWSERID_JSON_SERIALIZER setting if it is set and
+    :func:`default_json_dumps` otherwise.
+    """
+    global _json_serializer
+    if _json_serializer is None:
+        if getattr(settings, 'BROWSERID_JSON_SERIALIZER', None):
+            _json_serializer = import_from_setting('BROWSERID_JSON_SERIALIZER')
+        else:
+            _json_serializer = default_json_dumps
+    return _json_serializer
+
+
+def json_dumps(data):
+    """
+    Serialize data to a JSON string. Promises are resolved before the data is
+    passed to a serializer named by BROWSERID_JSON_SERIALIZER, so serializers
+    only need to handle the basic JSON types.
+    """
+    serializer = get_json_serializer()
+    if serializer is not default_json_dumps:
+        data = resolve_promises(data)
+    output = serializer(data)
+    if isinstance(output, bytes):
+        output = output.decode('utf-8')
+    return output
+
+
+def _reset_json_serializer(setting, **kwargs):
+    global _json_serializer
+    if setting == 'BROWSERID_JSON_SERIALIZER':
+        _json_serializer = None
+setting_changed.connect(_reset_json_serializer)
+
+
+def get_csrf_token(request):
+    """
+    Return the CSRF token for a request. Supports both standard Django CSRF
+    and the django-session-csrf library, which store the token in different
+    places.
+    """
+    if hasattr(request, 'csrf_token'):
+        return request.csrf_token
+    return get_token(request)
+
+
 def import_from_setting(setting):
     """
     Attempt to load a module attribute from a module as specified by a setting.
@@ -56,10 +174,108 @@ def import_from_setting(setting):
         raise ImproperlyConfigured('Module {0} does not define `{1}`.'.format(module, attr))
 
 
+#: Ports implied by URL schemes that don't specify one.
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+#: Maximum number of URLs whose origins are remembered by :func:`origin`.
+ORIGIN_CACHE_SIZE = 1024
+
+
+def _parse_origin(url):
+    parsed = urlparse(url)
+    return parsed.scheme, parsed.hostname, parsed.port or DEFAULT_PORTS.get(parsed.scheme)
+
+
+if lru_cache is not None:
+    _cached_origin = lru_cache(maxsize=ORIGIN_CACHE_SIZE)(_parse_origin)
+else:
+    _origin_cache = {}
+
+    def _cached_origin(url):
+        try:
+            return _origin_cache[url]
+        except KeyError:
+            result = _parse_origin(url)
+            if len(_origin_cache) >= ORIGIN_CACHE_SIZE:
+                _origin_cache.clear()
+            _origin_cache[url] = result
+            return result
+
+
+def origin(url):
+    """
+    Return the origin of a URL as a ``(scheme, host, port)`` tuple. The host
+    is lowercased and the port defaults to 80 for http and 443 for https.
+
+    Results for the most recently used URLs are remembered, so calling this
+    repeatedly with the same URLs is cheap.
+    """
+    return _cached_origin(url)
+
+
 def same_origin(url1, url2):
     """
     Checks if two URLs share the same origin, IE the same protocol,
     host, and port.
     """
-    p1, p2 = urlparse(url1), urlparse(url2)
-    return (p1.scheme, p1.hostname, p1.port) == (p2.scheme, p2.hostname, p2.port)
+    return origin(url1) == origin(url2)
+
+
+def assertion_digest(assertion, audience=None):
+    """
+    Return a hex digest identifying an assertion and, optionally, the
+    audience it is being verified against. Useful as a cache key, since
+    assertions themselves are too long for most cache backends.
+    """
+    digest = hashlib.sha256(smart_bytes(assertion))
+    if audience is not None:
+        digest.update(b'\0' + smart_bytes(audience))
+    return digest.hexdigest()
+
+
+class LRUCache(object):
+    """
+    Thread-safe, in-process cache holding at most ``max_size`` items, evicting
+    the least recently used item when full.
+
+    Implements the ``get``/``set``/``delete`` subset of Django's cache API, so
+    it can be used interchangeably with a Django cache backend. Timeouts are
+    in seconds; a timeout of None means the item never expires.
+    """
+    def __init__(self, max_size=1000):
+        self.max_size = max_size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, expires = self._items.pop(key)
+            except KeyError:
+                return default
+
+            if expires is not None and expires <= time.time():
+                return default
+
+            # Re-insert to mark the key as most recently used.
+            self._items[key] = (value, expires)
+            return value
+
+    def set(self, key, value, timeout=None):
+        expires = None if timeout is None else time.time() + timeout
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = (value, expires)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def __len__(self):
+        return len(self._items)
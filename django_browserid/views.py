@@ -5,15 +5,17 @@ import logging
 
 from django.conf import settings
 from django.contrib import auth
-from django.http import HttpResponse
-from django.middleware.csrf import get_token
+from django.http import HttpResponse, HttpResponseForbidden
 from django.shortcuts import resolve_url
+from django.utils.crypto import constant_time_compare
 from django.utils.http import is_safe_url
 from django.views.decorators.cache import never_cache
 from django.views.generic import View
 
+from django_browserid import metrics, timing
 from django_browserid.base import sanity_checks
 from django_browserid.http import JSONResponse
+from django_browserid.util import get_csrf_token
 
 
 logger = logging.getLogger(__name__)
@@ -68,7 +70,8 @@ class Verify(JSONView):
 
     def login_success(self):
         """Log the user into the site."""
-        auth.login(self.request, self.user)
+        with timing.phase('login'):
+            auth.login(self.request, self.user)
 
         return JSONResponse({
             'email': self.user.email,
@@ -87,16 +90,26 @@ class Verify(JSONView):
         Send the given assertion to the remote verification service and,
         depending on the result, trigger login success or failure.
         """
-        assertion = self.request.POST.get('assertion')
-        if not assertion:
+        with timing.trace('browserid.login') as trace:
+            assertion = self.request.POST.get('assertion')
+            if not assertion:
+                trace.outcome = 'failure'
+                metrics.incr('login.failure')
+                return self.login_failure()
+
+            with timing.phase('authenticate'):
+                self.user = auth.authenticate(request=self.request, assertion=assertion)
+            if self.user and self.user.is_active:
+                trace.outcome = 'success'
+                metrics.incr('login.success')
+                return self.login_success()
+
+            if self.user:
+                metrics.incr('login.inactive')
+            trace.outcome = 'failure'
+            metrics.incr('login.failure')
             return self.login_failure()
 
-        self.user = auth.authenticate(request=self.request, assertion=assertion)
-        if self.user and self.user.is_active:
-            return self.login_success()
-
-        return self.login_failure()
-
     def dispatch(self, request, *args, **kwargs):
         """
         Run some sanity checks on the request prior to dispatching it.
@@ -109,15 +122,7 @@ class CsrfToken(JSONView):
     """Fetch a CSRF token for the frontend JavaScript."""
     @never_cache
     def get(self, request):
-        # Different CSRF libraries store the CSRF token in different
-        # places. Here we support both standard Django CSRF and the
-        # django-session-csrf library.
-        if hasattr(request, 'csrf_token'):
-            csrf_token = request.csrf_token
-        else:
-            csrf_token = get_token(request)
-
-        return HttpResponse(csrf_token)
+        return HttpResponse(get_csrf_token(request))
 
 
 class Logout(JSONView):
@@ -137,3 +142,36 @@ class Logout(JSONView):
         return JSONResponse({
             'redirect': _get_next(self.request) or self.redirect_url
         })
+
+
+class Metrics(View):
+    """
+    Expose django-browserid's metrics in the Prometheus text format. See
+    :func:`django_browserid.metrics.render_prometheus`.
+
+    Access is limited to requests with an ``Authorization: Bearer`` header
+    matching BROWSERID_METRICS_TOKEN, staff users, and requests from the
+    addresses in BROWSERID_METRICS_ALLOWED_IPS, which is empty by default.
+    """
+    content_type = 'text/plain; version=0.0.4; charset=utf-8'
+
+    def is_allowed(self, request):
+        """Return True if the request may read the metrics."""
+        allowed_ips = getattr(settings, 'BROWSERID_METRICS_ALLOWED_IPS', ())
+        if request.META.get('REMOTE_ADDR') in allowed_ips:
+            return True
+
+        token = getattr(settings, 'BROWSERID_METRICS_TOKEN', None)
+        authorization = request.META.get('HTTP_AUTHORIZATION', '')
+        if token and authorization.startswith('Bearer '):
+            if constant_time_compare(authorization[len('Bearer '):], token):
+                return True
+
+        user = getattr(request, 'user', None)
+        return bool(user and user.is_staff)
+
+    @never_cache
+    def get(self, request):
+        if not self.is_allowed(request):
+            return HttpResponseForbidden()
+        return HttpResponse(metrics.render_prometheus(), content_type=self.content_type)
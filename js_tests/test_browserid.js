@@ -28,6 +28,10 @@ suite('api.js', function() {
         // Reset requestDeferred in case someone set it.
         django_browserid._requestDeferred = null;
 
+        // Forget CSRF tokens from previous tests.
+        django_browserid._csrfToken = null;
+        django_browserid._usedInfoCsrfToken = false;
+
         // Mock our CSRF view to return 'csrfToken'.
         server.respondWith('GET', '/browserid/csrf/', [200, {}, 'csrfToken']);
     });
@@ -154,4 +158,154 @@ suite('api.js', function() {
         server.respond();
         django_browserid.getInfo.restore();
     });
+
+    test('getCsrfToken() should reuse a fetched token.', function(done) {
+        sinon.stub(django_browserid, 'getInfo', function() {
+            return {csrfUrl: '/browserid/csrf/'};
+        });
+
+        django_browserid.getCsrfToken();
+        server.respond();
+        django_browserid.getCsrfToken().then(function(token) {
+            chai.assert.equal(token, 'csrfToken');
+            chai.assert.equal(server.requests.length, 1);
+            done();
+        });
+
+        django_browserid.getInfo.restore();
+    });
+
+    test('getCsrfToken() should use the token from the info tag if available.', function(done) {
+        sinon.stub(django_browserid, 'getInfo', function() {
+            return {csrfUrl: '/browserid/csrf/', csrfToken: 'infoToken'};
+        });
+
+        django_browserid.getCsrfToken().then(function(token) {
+            chai.assert.equal(token, 'infoToken');
+            chai.assert.equal(server.requests.length, 0);
+            done();
+        });
+
+        django_browserid.getInfo.restore();
+    });
+
+    test('verifyAssertion() should use the CSRF cookie if available.', function(done) {
+        sinon.stub(django_browserid, 'getInfo', function() {
+            return {
+                csrfUrl: '/browserid/csrf/',
+                csrfCookieName: 'csrftoken',
+                loginUrl: '/browserid/login/'
+            };
+        });
+        document.cookie = 'csrftoken=cookieToken; path=/';
+
+        server.respondWith('POST', '/browserid/login/', function(request) {
+            chai.assert.equal(request.requestHeaders['X-CSRFToken'], 'cookieToken');
+            request.respond.apply(request, jsonResponse({redirect: '/asdf/'}));
+        });
+
+        django_browserid.verifyAssertion('assertion', 'nextUrl').then(function(verifyResult) {
+            // The login should be a single request.
+            chai.assert.equal(server.requests.length, 1);
+            chai.assert.deepEqual(verifyResult, {redirect: '/asdf/'});
+            done();
+        });
+
+        server.respond();
+        document.cookie = 'csrftoken=; path=/; expires=Thu, 01 Jan 1970 00:00:00 GMT';
+        django_browserid.getInfo.restore();
+    });
+
+    test('getCsrfToken() should fetch a token if the CSRF cookie is missing.', function(done) {
+        sinon.stub(django_browserid, 'getInfo', function() {
+            return {csrfUrl: '/browserid/csrf/', csrfCookieName: 'missingcookie'};
+        });
+
+        django_browserid.getCsrfToken().then(function(token) {
+            chai.assert.equal(token, 'csrfToken');
+            chai.assert.equal(server.requests.length, 1);
+            done();
+        });
+
+        server.respond();
+        django_browserid.getInfo.restore();
+    });
+
+    test('A rejected CSRF token should be replaced and the request retried.', function(done) {
+        sinon.stub(django_browserid, 'getInfo', function() {
+            return {
+                csrfUrl: '/browserid/csrf/',
+                csrfToken: 'staleToken',
+                logoutUrl: '/browserid/logout/'
+            };
+        });
+
+        server.respondWith('POST', '/browserid/logout/', function(request) {
+            if (request.requestHeaders['X-CSRFToken'] === 'staleToken') {
+                request.respond(403, {'Content-Type': 'text/html'}, 'CSRF verification failed.');
+            } else {
+                request.respond.apply(request, jsonResponse({redirect: '/asdf/'}));
+            }
+        });
+
+        django_browserid.logout('nextUrl').then(function(logoutData) {
+            chai.assert.deepEqual(logoutData, {redirect: '/asdf/'});
+            chai.assert.equal(server.requests.length, 3);
+            chai.assert.equal(server.requests[2].requestHeaders['X-CSRFToken'], 'csrfToken');
+            done();
+        });
+
+        server.respond();
+        server.respond();
+        django_browserid.getInfo.restore();
+    });
+
+    test('Failed logins should not be retried.', function(done) {
+        sinon.stub(django_browserid, 'getInfo', function() {
+            return {csrfUrl: '/browserid/csrf/', loginUrl: '/browserid/login/'};
+        });
+
+        server.respondWith('POST', '/browserid/login/', function(request) {
+            request.respond(403, {'Content-Type': 'application/json'},
+                            JSON.stringify({redirect: '/failure/'}));
+        });
+
+        django_browserid.verifyAssertion('assertion', 'nextUrl').fail(function(jqXHR) {
+            chai.assert.equal(jqXHR.status, 403);
+            chai.assert.equal(server.requests.length, 2);
+            done();
+        });
+
+        server.respond();
+        django_browserid.getInfo.restore();
+    });
+
+    test('The CSRF token should be forgotten after logging in.', function(done) {
+        sinon.stub(django_browserid, 'getInfo', function() {
+            return {
+                csrfUrl: '/browserid/csrf/',
+                csrfToken: 'infoToken',
+                loginUrl: '/browserid/login/'
+            };
+        });
+
+        server.respondWith('POST', '/browserid/login/', function(request) {
+            request.respond.apply(request, jsonResponse({redirect: '/asdf/'}));
+        });
+
+        django_browserid.verifyAssertion('assertion', 'nextUrl').then(function() {
+            chai.assert.equal(server.requests[0].requestHeaders['X-CSRFToken'], 'infoToken');
+            chai.assert.equal(django_browserid._csrfToken, null);
+
+            // The embedded token is stale now, so a new one is fetched.
+            django_browserid.getCsrfToken().then(function(token) {
+                chai.assert.equal(token, 'csrfToken');
+                done();
+            });
+            server.respond();
+        });
+
+        server.respond();
+        django_browserid.getInfo.restore();
+    });
 });